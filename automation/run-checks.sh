@@ -108,6 +108,10 @@ test_otopi() {
 	group_end
 }
 
+group_start unittests
+python3 -m unittest discover -s automation/tests -v
+group_end
+
 prepare_test_repo
 test_otopi 0 packager-install-testpackage2 ODEBUG/packagesAction=str:install ODEBUG/packages=str:testpackage2
 test_otopi 0 packager-query-testpackages ODEBUG/packagesAction=str:queryPackages ODEBUG/packages=str:testpackage\*
@@ -0,0 +1,161 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""Local rpm repositories for tests."""
+
+
+import http.server
+import os
+import shutil
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+def available():
+    """True if packages and repositories can be built."""
+    return all(
+        shutil.which(command) is not None
+        for command in ('rpmbuild', 'createrepo_c')
+    )
+
+
+def build(directory, names, version, release='1'):
+    """Build empty noarch packages into directory.
+
+    All packages are built as sub packages of a single spec, so building
+    many packages is fast.
+
+    Returns list of package file names.
+
+    """
+    topdir = tempfile.mkdtemp()
+    try:
+        spec = os.path.join(topdir, 'otopi-test.spec')
+        with open(spec, 'w') as f:
+            f.write(
+                (
+                    'Name: otopi-test\n'
+                    'Version: {version}\n'
+                    'Release: {release}\n'
+                    'Summary: otopi test packages\n'
+                    'License: LGPLv2+\n'
+                    'BuildArch: noarch\n'
+                    '%description\n'
+                    'otopi test packages\n'
+                ).format(version=version, release=release)
+            )
+            for name in names:
+                f.write(
+                    (
+                        '%package -n {name}\n'
+                        'Summary: {name}\n'
+                        '%description -n {name}\n'
+                        '{name}\n'
+                        '%files -n {name}\n'
+                    ).format(name=name)
+                )
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        subprocess.check_output(
+            (
+                'rpmbuild',
+                '-bb',
+                '--define', '_topdir %s' % topdir,
+                '--define', '_rpmdir %s' % directory,
+                '--define', '_build_name_fmt %%{NAME}-%%{VERSION}-'
+                '%%{RELEASE}.%%{ARCH}.rpm',
+                spec,
+            ),
+            stderr=subprocess.STDOUT,
+        )
+    finally:
+        shutil.rmtree(topdir)
+    return [
+        os.path.join(
+            directory,
+            '%s-%s-%s.noarch.rpm' % (name, version, release),
+        )
+        for name in names
+    ]
+
+
+def createrepo(directory):
+    """Create or update repository metadata of directory."""
+    subprocess.check_output(
+        ('createrepo_c', '--update', directory),
+        stderr=subprocess.STDOUT,
+    )
+
+
+class SlowServer(object):
+    """HTTP server of a repository directory with slow package reads.
+
+    Packages are sent in chunks with a delay before each chunk, so
+    downloads take a while and report progress meanwhile.
+
+    dnf uses packages of file:// repositories in place, they are never
+    downloaded into the cache, so a local HTTP server is used instead.
+
+    """
+
+    CHUNK = 256
+
+    def __init__(self, directory, chunkDelay):
+        self.requests = []
+        self.chunkDelay = chunkDelay
+        server = self
+
+        class _Handler(http.server.SimpleHTTPRequestHandler):
+
+            def translate_path(self, path):
+                return os.path.join(
+                    directory,
+                    os.path.normpath(
+                        urllib.parse.unquote(
+                            urllib.parse.urlparse(path).path
+                        )
+                    ).lstrip('/'),
+                )
+
+            def copyfile(self, source, outputfile):
+                if not self.path.endswith('.rpm'):
+                    return super(_Handler, self).copyfile(source, outputfile)
+                server.requests.append(self.path)
+                while True:
+                    time.sleep(server.chunkDelay)
+                    buf = source.read(server.CHUNK)
+                    if not buf:
+                        break
+                    outputfile.write(buf)
+                    outputfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0),
+            _Handler,
+        )
+        self._httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:%d/' % self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def duration(self, name):
+        """Minimum seconds to serve file."""
+        return (os.path.getsize(name) // self.CHUNK + 1) * self.chunkDelay
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
@@ -0,0 +1,81 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""backup store retention tests."""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), '..', '..', 'src'),
+)
+
+from otopi import backupstore  # noqa: E402
+
+
+class PruneTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _backup(self, store, name, content):
+        path = os.path.join(self._dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        store.add(path)
+
+    def test_size_keeps_newest(self):
+        store = backupstore.BackupStore(
+            os.path.join(self._dir, 'store'),
+            maxBytes=10,
+        )
+        self._backup(store, 'a', 'a' * 100)
+        self._backup(store, 'a', 'b' * 100)
+        self._backup(store, 'c', 'c' * 100)
+        store.prune()
+        self.assertEqual(
+            [(os.path.basename(e['path']), e['size']) for e in store.list()],
+            [('a', 100), ('c', 100)],
+        )
+        restored = store.restore(
+            store.list(os.path.join(self._dir, 'a'))[0],
+            os.path.join(self._dir, 'restored'),
+        )
+        with open(restored) as f:
+            self.assertEqual(f.read(), 'b' * 100)
+
+    def test_size_drops_oldest(self):
+        store = backupstore.BackupStore(
+            os.path.join(self._dir, 'store'),
+            maxBytes=250,
+        )
+        for content in ('a', 'b', 'c'):
+            self._backup(store, 'a', content * 100)
+        store.prune()
+        self.assertEqual(len(store.list()), 2)
+        self.assertEqual(
+            sum(
+                len(files) for __, __, files in os.walk(
+                    os.path.join(self._dir, 'store', 'objects')
+                )
+            ),
+            2,
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
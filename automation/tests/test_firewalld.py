@@ -0,0 +1,301 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""firewalld plugin tests."""
+
+
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+
+_SRC = os.path.join(os.path.dirname(__file__), '..', '..', 'src')
+sys.path.insert(0, _SRC)
+
+
+from otopi import constants  # noqa: E402
+from otopi import plugin  # noqa: E402
+
+
+def _loadPlugin():
+    name = 'otopi_test_firewalld'
+    spec = importlib.util.spec_from_file_location(
+        name,
+        os.path.join(_SRC, 'plugins', 'otopi', 'network', 'firewalld.py'),
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+firewalld = _loadPlugin()
+
+
+_HEADER = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+
+class ZoneContentTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+        class _Plugin(firewalld.Plugin):
+            FIREWALLD_ZONES_DIR = self._dir
+            FIREWALLD_DEFAULT_ZONES_DIR = self._dir
+
+            def __init__(self):
+                pass
+
+        self._plugin = _Plugin()
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _content(self, content, add=(), remove=()):
+        with open(os.path.join(self._dir, 'public.xml'), 'w') as f:
+            f.write(_HEADER + content)
+        return self._plugin._get_zone_content(
+            zone='public',
+            add=list(add),
+            remove=list(remove),
+        )
+
+    def test_append_last(self):
+        self.assertEqual(
+            self._content(
+                (
+                    '<zone>\n'
+                    '  <short>Public</short>\n'
+                    '  <service name="ssh"/>\n'
+                    '</zone>\n'
+                ),
+                add=('foo', 'bar'),
+            ),
+            _HEADER + (
+                '<zone>\n'
+                '  <short>Public</short>\n'
+                '  <service name="ssh" />\n'
+                '  <service name="foo" />\n'
+                '  <service name="bar" />\n'
+                '</zone>\n'
+            ),
+        )
+
+    def test_insert_before(self):
+        self.assertEqual(
+            self._content(
+                (
+                    '<zone>\n'
+                    '  <short>Public</short>\n'
+                    '  <service name="ssh"/>\n'
+                    '  <interface name="eth0"/>\n'
+                    '</zone>\n'
+                ),
+                add=('foo',),
+            ),
+            _HEADER + (
+                '<zone>\n'
+                '  <short>Public</short>\n'
+                '  <service name="ssh" />\n'
+                '  <service name="foo" />\n'
+                '  <interface name="eth0" />\n'
+                '</zone>\n'
+            ),
+        )
+
+    def test_replace_last(self):
+        self.assertEqual(
+            self._content(
+                (
+                    '<zone>\n'
+                    '  <short>Public</short>\n'
+                    '  <service name="ssh"/>\n'
+                    '  <service name="old"/>\n'
+                    '</zone>\n'
+                ),
+                add=('foo',),
+                remove=('old',),
+            ),
+            _HEADER + (
+                '<zone>\n'
+                '  <short>Public</short>\n'
+                '  <service name="ssh" />\n'
+                '  <service name="foo" />\n'
+                '</zone>\n'
+            ),
+        )
+
+
+# logs invocations, answers zone and service queries
+_STUB = """#!/bin/sh
+dir="$(dirname "$0")"
+echo "$(basename "$0") $*" >> "${dir}/calls"
+case "$*" in
+    --list-all-zones) cat "${dir}/zones" ;;
+    "--permanent --get-services") echo "http ssh" ;;
+esac
+exit 0
+"""
+
+_ZONES = (
+    'block\n'
+    '  interfaces: \n'
+    '  services: \n'
+    '\n'
+    'internal\n'
+    '  interfaces: eth1\n'
+    '  services: ssh\n'
+    '\n'
+    'public (active)\n'
+    '  interfaces: eth0\n'
+    '  services: http ssh\n'
+)
+
+
+class _Command(object):
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def get(self, command, optional=False):
+        path = shutil.which(command, path=self._directory)
+        if path is None and not optional:
+            raise RuntimeError('missing %s' % command)
+        return path
+
+
+class _Services(object):
+
+    def __init__(self, running):
+        self._running = running
+
+    def status(self, name):
+        return self._running
+
+
+class _Context(object):
+
+    def __init__(self, directory, running):
+        self.environment = {
+            constants.NetEnv.FIREWALLD_ZONE_FILES: False,
+        }
+        self.command = _Command(directory)
+        self.services = _Services(running)
+
+    def registerPlugin(self, plugin):
+        pass
+
+
+class CommandsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        for command in ('firewall-cmd', 'firewall-offline-cmd'):
+            stub = os.path.join(self._dir, command)
+            with open(stub, 'w') as f:
+                f.write(_STUB)
+            os.chmod(stub, 0o755)
+        with open(os.path.join(self._dir, 'zones'), 'w') as f:
+            f.write(_ZONES)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _plugin(self, running=True, services=()):
+        test = self
+
+        class _Plugin(firewalld.Plugin):
+            FIREWALLD_SERVICES_DIR = test._dir
+
+            def __init__(self):
+                plugin.PluginBase.__init__(
+                    self,
+                    context=_Context(test._dir, running),
+                )
+                self._enabled = True
+                self._enabled_services = list(services)
+                self._disabled_zones_services = {}
+                self._firewalld_version = 0x000800
+                self._zones = None
+
+        return _Plugin()
+
+    def _calls(self):
+        with open(os.path.join(self._dir, 'calls')) as f:
+            return f.read().splitlines()
+
+    def test_closeup(self):
+        self._plugin(services=('foo', 'bar', 'ssh'))._closeup()
+        calls = self._calls()
+        self.assertEqual(
+            calls,
+            [
+                'firewall-cmd --permanent --get-services',
+                (
+                    'firewall-cmd --permanent '
+                    '--new-service-from-file=%s/foo.xml --name=foo'
+                ) % self._dir,
+                (
+                    'firewall-cmd --permanent '
+                    '--new-service-from-file=%s/bar.xml --name=bar'
+                ) % self._dir,
+                'firewall-cmd --list-all-zones',
+                (
+                    'firewall-cmd --zone internal --permanent '
+                    '--add-service foo --add-service bar --add-service ssh'
+                ),
+                (
+                    'firewall-cmd --zone public --permanent '
+                    '--add-service foo --add-service bar --add-service ssh'
+                ),
+                'firewall-cmd --reload',
+            ],
+        )
+
+    def test_closeup_known(self):
+        self._plugin(services=('http',))._closeup()
+        calls = self._calls()
+        self.assertFalse(
+            [c for c in calls if '--new-service-from-file' in c]
+        )
+        self.assertEqual(
+            len([c for c in calls if '--add-service' in c]),
+            2,
+        )
+        self.assertEqual(calls[-1], 'firewall-cmd --reload')
+        self.assertEqual(calls.count('firewall-cmd --reload'), 1)
+
+    def test_configure_offline(self):
+        self.assertTrue(
+            self._plugin(running=False)._configure(
+                {
+                    'public': ['foo', 'bar'],
+                    'internal': ['foo'],
+                    'block': [],
+                },
+                add=False,
+            )
+        )
+        self.assertEqual(
+            self._calls(),
+            [
+                'firewall-offline-cmd --zone internal --remove-service foo',
+                (
+                    'firewall-offline-cmd --zone public '
+                    '--remove-service foo --remove-service bar'
+                ),
+            ],
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
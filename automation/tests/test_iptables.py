@@ -0,0 +1,209 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""iptables plugin tests, using a stub iptables-restore."""
+
+
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+
+_SRC = os.path.join(os.path.dirname(__file__), '..', '..', 'src')
+sys.path.insert(0, _SRC)
+
+
+from otopi import constants  # noqa: E402
+from otopi import plugin  # noqa: E402
+from otopi import transaction  # noqa: E402
+
+
+def _loadPlugin():
+    name = 'otopi_test_iptables'
+    spec = importlib.util.spec_from_file_location(
+        name,
+        os.path.join(_SRC, 'plugins', 'otopi', 'network', 'iptables.py'),
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except ImportError:
+        del sys.modules[name]
+        return None
+    return module
+
+
+iptables = _loadPlugin()
+
+
+# logs arguments, and stdin of --test, exits with the code in rc
+_STUB = '''#!/bin/sh
+dir="$(dirname "$0")"
+echo "$*" >> "${dir}/calls"
+[ "$1" = "--test" ] && cat > "${dir}/stdin"
+exit "$(cat "${dir}/rc")"
+'''
+
+_RULES = (
+    '*filter\n'
+    ':INPUT ACCEPT [0:0]\n'
+    '-A INPUT -p tcp --dport 22 -j ACCEPT\n'
+    'COMMIT\n'
+)
+
+
+class _Command(object):
+
+    def __init__(self, directory):
+        self._directory = directory
+
+    def detect(self, command):
+        pass
+
+    def get(self, command, optional=False):
+        path = shutil.which(command, path=self._directory)
+        if path is None and not optional:
+            raise RuntimeError('missing %s' % command)
+        return path
+
+
+class _Services(object):
+
+    def __init__(self, active):
+        self._active = active
+        self.calls = []
+
+    def exists(self, name):
+        return False
+
+    def status(self, name):
+        return self._active
+
+    def startup(self, name, state):
+        self.calls.append(('startup', name, state))
+
+    def state(self, name, state):
+        self.calls.append(('state', name, state))
+
+
+class _Context(object):
+
+    def __init__(self, directory, active):
+        self.environment = {
+            constants.NetEnv.IPTABLES_ENABLE: True,
+            constants.NetEnv.IPTABLES_RULES: _RULES,
+            constants.NetEnv.IPTABLES_RESTORE: True,
+            constants.CoreEnv.MAIN_TRANSACTION: transaction.Transaction(),
+            constants.CoreEnv.MODIFIED_FILES: [],
+        }
+        self.command = _Command(directory)
+        self.services = _Services(active)
+
+    def registerPlugin(self, plugin):
+        pass
+
+
+@unittest.skipIf(iptables is None, 'distro is not available')
+class IptablesRestoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._bin = os.path.join(self._dir, 'bin')
+        os.mkdir(self._bin)
+        stub = os.path.join(self._bin, 'iptables-restore')
+        with open(stub, 'w') as f:
+            f.write(_STUB)
+        os.chmod(stub, 0o755)
+        self._rc(0)
+        self._rules = os.path.join(self._dir, 'iptables')
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _rc(self, rc):
+        with open(os.path.join(self._bin, 'rc'), 'w') as f:
+            f.write('%d\n' % rc)
+
+    def _calls(self):
+        path = os.path.join(self._bin, 'calls')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return f.read().splitlines()
+
+    def _plugin(self, active=False):
+        test = self
+
+        class _Plugin(iptables.Plugin):
+            REDHAT_IPTABLES = test._rules
+
+            def __init__(self):
+                plugin.PluginBase.__init__(
+                    self,
+                    context=_Context(test._bin, active),
+                )
+                self._enabled = True
+
+        return _Plugin()
+
+    def _store(self, p):
+        # as the main transaction, prepared before STAGE_MISC
+        main = p.environment[constants.CoreEnv.MAIN_TRANSACTION]
+        with main:
+            p._store_iptables()
+
+    def test_prepare_validates(self):
+        p = self._plugin()
+        self._store(p)
+        self.assertEqual(self._calls(), ['--test'])
+        with open(os.path.join(self._bin, 'stdin')) as f:
+            self.assertEqual(f.read(), _RULES)
+        with open(self._rules) as f:
+            self.assertEqual(f.read(), _RULES)
+
+    def test_invalid_aborts(self):
+        self._rc(1)
+        p = self._plugin()
+        with self.assertRaisesRegex(RuntimeError, 'Invalid iptables rules'):
+            self._store(p)
+        self.assertEqual(self._calls(), ['--test'])
+        self.assertFalse(os.path.exists(self._rules))
+
+    def test_missing(self):
+        os.unlink(os.path.join(self._bin, 'iptables-restore'))
+        p = self._plugin()
+        with self.assertRaisesRegex(RuntimeError, 'iptablesRestore'):
+            self._store(p)
+        self.assertFalse(os.path.exists(self._rules))
+
+    def test_closeup_active(self):
+        p = self._plugin(active=True)
+        p._closeup()
+        self.assertEqual(self._calls(), [self._rules])
+        self.assertEqual(p.services.calls, [('startup', 'iptables', True)])
+
+    def test_closeup_inactive(self):
+        p = self._plugin(active=False)
+        p._closeup()
+        self.assertEqual(self._calls(), [])
+        self.assertEqual(
+            p.services.calls,
+            [
+                ('startup', 'iptables', True),
+                ('state', 'iptables', False),
+                ('state', 'iptables', True),
+            ],
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
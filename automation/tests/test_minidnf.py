@@ -0,0 +1,371 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""minidnf tests."""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), '..', '..', 'src'),
+)
+
+try:
+    from otopi import minidnf
+except ImportError:
+    minidnf = None
+
+import rpmrepo  # noqa: E402
+
+
+_REPOS = (
+    minidnf is not None and
+    rpmrepo.available() and
+    os.geteuid() == 0
+)
+
+
+@unittest.skipIf(minidnf is None, 'dnf is not available')
+class CoalesceRpmsTest(unittest.TestCase):
+
+    def _coalesce(self, rpms):
+        return [
+            (ti['nevra'], ti['action'])
+            for ti in minidnf._coalesce_rpms(
+                [
+                    {'nevra': nevra, 'action': action}
+                    for nevra, action in rpms
+                ]
+            )
+        ]
+
+    def test_install_upgrade(self):
+        # reverted upgrade foo-1 to foo-2, then reverted install foo-1
+        self.assertEqual(
+            self._coalesce([
+                ('foo-2-1.noarch', 'Downgraded'),
+                ('foo-1-1.noarch', 'Downgrade'),
+                ('foo-1-1.noarch', 'Removed'),
+            ]),
+            [
+                ('foo-2-1.noarch', 'Removed'),
+            ],
+        )
+
+    def test_upgrade_remove(self):
+        # reverted removal of foo-2, then reverted upgrade foo-1 to foo-2
+        self.assertEqual(
+            self._coalesce([
+                ('foo-2-1.noarch', 'Install'),
+                ('foo-1-1.noarch', 'Downgrade'),
+                ('foo-2-1.noarch', 'Downgraded'),
+            ]),
+            [
+                ('foo-1-1.noarch', 'Install'),
+            ],
+        )
+
+    def test_install_remove(self):
+        self.assertEqual(
+            self._coalesce([
+                ('foo-1-1.noarch', 'Install'),
+                ('foo-1-1.noarch', 'Removed'),
+                ('bar-1-1.noarch', 'Removed'),
+            ]),
+            [
+                ('bar-1-1.noarch', 'Removed'),
+            ],
+        )
+
+    def test_upgrades(self):
+        # reverted upgrade foo-2 to foo-3, then foo-1 to foo-2
+        self.assertEqual(
+            self._coalesce([
+                ('foo-3-1.noarch', 'Downgraded'),
+                ('foo-2-1.noarch', 'Downgrade'),
+                ('foo-2-1.noarch', 'Downgraded'),
+                ('foo-1-1.noarch', 'Downgrade'),
+            ]),
+            [
+                ('foo-3-1.noarch', 'Downgraded'),
+                ('foo-1-1.noarch', 'Downgrade'),
+            ],
+        )
+
+
+if minidnf is not None:
+    class _MiniDNF(minidnf.MiniDNF):
+        """MiniDNF using a bundle of unsigned test packages.
+
+        The bundle may be an URL.
+
+        """
+
+        def _addBundle(self, base):
+            super(_MiniDNF, self)._addBundle(base)
+            repo = base.repos[self.BUNDLE_REPO]
+            repo.gpgcheck = False
+            if '://' in self._bundleDir:
+                repo.baseurl = [self._bundleDir]
+
+
+def _checkForSafeUpdateSubjects(mini, packages):
+    """checkForSafeUpdate as it was, a subject query per package."""
+    missingRollback = []
+    upgradeAvailable = False
+    plist = []
+
+    with mini.transaction():
+        mini.installUpdate(packages)
+
+        if mini.buildTransaction():
+            upgradeAvailable = True
+
+            for p in mini.queryTransaction():
+                plist.append((p['display_name'], p['operation']))
+
+            for package in mini.queryTransaction():
+                installed = False
+                reinstall_available = False
+                for query in mini.queryPackages(
+                    patterns=(package['display_name'],),
+                    showdups=True,
+                ):
+                    if query['operation'] == 'installed':
+                        installed = True
+                    if query['operation'] == 'reinstall_available':
+                        reinstall_available = True
+                if installed and not reinstall_available:
+                    missingRollback.append(package['display_name'])
+    return {
+        'upgradeAvailable': upgradeAvailable,
+        'missingRollback': set(missingRollback),
+        'packageOperations': plist,
+    }
+
+
+@unittest.skipIf(not _REPOS, 'dnf, rpmbuild, createrepo_c or root missing')
+class CheckForSafeUpdateTest(unittest.TestCase):
+
+    # OTOPI_TEST_PACKAGES=1000 for a benchmark
+    PACKAGES = int(os.environ.get('OTOPI_TEST_PACKAGES', '100'))
+
+    @classmethod
+    def setUpClass(cls):
+        cls._dir = tempfile.mkdtemp()
+        cls._names = ['otopi-test-%04d' % i for i in range(cls.PACKAGES)]
+        both = os.path.join(cls._dir, 'both')
+        os.mkdir(both)
+        for version in ('1', '2'):
+            repo = os.path.join(cls._dir, 'v%s' % version)
+            for rpm in rpmrepo.build(repo, cls._names, version):
+                shutil.copy(rpm, both)
+            rpmrepo.createrepo(repo)
+        rpmrepo.createrepo(both)
+
+        mini = cls._mini('v1')
+        with mini.transaction():
+            mini.install(cls._names)
+            if mini.buildTransaction():
+                mini.processTransaction()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls._dir)
+
+    @classmethod
+    def _mini(cls, repo):
+        return _MiniDNF(
+            installRoot=os.path.join(cls._dir, 'root'),
+            cacheDir=os.path.join(cls._dir, 'cache'),
+            bundleDir=os.path.join(cls._dir, repo),
+            bundleOnly=True,
+        )
+
+    def _compare(self, repo):
+        mini = self._mini(repo)
+        # load metadata before timing
+        with mini.transaction():
+            pass
+        start = time.monotonic()
+        ret = mini.checkForSafeUpdate(self._names)
+        single = time.monotonic() - start
+        start = time.monotonic()
+        expected = _checkForSafeUpdateSubjects(mini, self._names)
+        subjects = time.monotonic() - start
+        sys.stderr.write(
+            '\ncheckForSafeUpdate of %d packages: %.2f seconds, '
+            'subject queries: %.2f seconds\n' % (
+                self.PACKAGES,
+                single,
+                subjects,
+            )
+        )
+        self.assertEqual(ret['upgradeAvailable'], expected['upgradeAvailable'])
+        self.assertEqual(ret['missingRollback'], expected['missingRollback'])
+        self.assertEqual(
+            sorted(ret['packageOperations']),
+            sorted(expected['packageOperations']),
+        )
+        return ret
+
+    def test_rollback_available(self):
+        ret = self._compare('both')
+        self.assertTrue(ret['upgradeAvailable'])
+        self.assertEqual(ret['missingRollback'], set())
+
+    def test_rollback_missing(self):
+        ret = self._compare('v2')
+        self.assertTrue(ret['upgradeAvailable'])
+        self.assertEqual(
+            ret['missingRollback'],
+            set('%s-1-1.noarch' % name for name in self._names),
+        )
+
+
+@unittest.skipIf(not _REPOS, 'dnf, rpmbuild, createrepo_c or root missing')
+class PrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._names = ['otopi-prefetch-%d' % i for i in range(3)]
+        repo = os.path.join(self._dir, 'repo')
+        self._rpms = rpmrepo.build(repo, self._names, '1')
+        rpmrepo.createrepo(repo)
+        self._server = rpmrepo.SlowServer(repo, chunkDelay=0.05)
+        self._mini = _MiniDNF(
+            installRoot=os.path.join(self._dir, 'root'),
+            cacheDir=os.path.join(self._dir, 'cache'),
+            bundleDir=self._server.url,
+            bundleOnly=True,
+        )
+        # load metadata
+        with self._mini.transaction():
+            pass
+
+    def tearDown(self):
+        self._mini.cancelPrefetch()
+        del self._mini
+        self._server.close()
+        shutil.rmtree(self._dir)
+
+    def _cached(self):
+        return sorted(
+            name
+            for __, __, files in os.walk(os.path.join(self._dir, 'cache'))
+            for name in files
+            if name.endswith('.rpm')
+        )
+
+    def _download(self):
+        return min(self._server.duration(rpm) for rpm in self._rpms)
+
+    def _install(self):
+        with self._mini.transaction():
+            self._mini.install(self._names)
+            self.assertTrue(self._mini.buildTransaction())
+            self._mini.processTransaction()
+
+    def test_background(self):
+        start = time.monotonic()
+        self._mini.prefetch(self._names)
+        with self._mini.transaction():
+            self._mini.install(self._names)
+            self.assertTrue(self._mini.buildTransaction())
+            self._mini.queryTransaction()
+        # not blocked by downloads
+        self.assertLess(time.monotonic() - start, self._download())
+
+        self._mini.waitPrefetch()
+        self.assertEqual(
+            self._cached(),
+            sorted(os.path.basename(rpm) for rpm in self._rpms),
+        )
+        self._install()
+        # installed from cache
+        self.assertEqual(len(self._server.requests), len(self._names))
+
+    def test_cancel(self):
+        self._mini.prefetch(self._names)
+        time.sleep(self._download() / 2)
+        start = time.monotonic()
+        self._mini.cancelPrefetch()
+        self.assertLess(time.monotonic() - start, self._download() / 2)
+        self._install()
+
+
+@unittest.skipIf(not _REPOS, 'dnf, rpmbuild, createrepo_c or root missing')
+class BundleTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._names = ['otopi-bundle-%d' % i for i in range(3)]
+        self._installed = 'otopi-bundle-installed'
+        repo = os.path.join(self._dir, 'repo')
+        rpmrepo.build(repo, self._names + [self._installed], '1')
+        rpmrepo.createrepo(repo)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+    def _mini(self, root, bundle):
+        return _MiniDNF(
+            installRoot=os.path.join(self._dir, root),
+            cacheDir=os.path.join(self._dir, 'cache-%s' % root),
+            bundleDir=os.path.join(self._dir, bundle),
+            bundleOnly=True,
+        )
+
+    def _install(self, mini, names, bundle=None):
+        with mini.transaction():
+            self.assertTrue(mini.install(names, ignoreErrors=True))
+            self.assertTrue(mini.buildTransaction())
+            if bundle is not None:
+                mini.exportBundle(os.path.join(self._dir, bundle))
+            mini.processTransaction()
+
+    def test_export_import(self):
+        mini = self._mini('export', 'repo')
+        self._install(mini, [self._installed])
+        self._install(mini, self._names, bundle='bundle')
+
+        self.assertEqual(
+            sorted(
+                name
+                for name in os.listdir(os.path.join(self._dir, 'bundle'))
+                if name.endswith('.rpm')
+            ),
+            sorted('%s-1-1.noarch.rpm' % name for name in self._names),
+        )
+
+        mini = self._mini('import', 'bundle')
+        self._install(mini, self._names)
+        with mini.transaction():
+            # only the install set of the exporting host is exported
+            self.assertFalse(
+                mini.install([self._installed], ignoreErrors=True)
+            )
+        self.assertEqual(
+            sorted(
+                p['name']
+                for p in mini.queryPackages(patterns=self._names)
+                if p['operation'] == 'installed'
+            ),
+            sorted(self._names),
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
@@ -0,0 +1,245 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""netinfo tests."""
+
+
+import ctypes
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import unittest
+import unittest.mock
+
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), '..', '..', 'src'),
+)
+
+from otopi import netinfo  # noqa: E402
+
+
+def _attr(attrtype, payload):
+    length = struct.calcsize(netinfo._RTATTR) + len(payload)
+    return (
+        struct.pack(netinfo._RTATTR, length, attrtype) +
+        payload +
+        b'\0' * (netinfo._align(length) - length)
+    )
+
+
+def _message(msgtype, payload):
+    return struct.pack(
+        netinfo._NLMSGHDR,
+        struct.calcsize(netinfo._NLMSGHDR) + len(payload),
+        msgtype,
+        0,
+        1,
+        0,
+    ) + payload
+
+
+def _newaddr(family, attrs):
+    return _message(
+        netinfo._RTM_NEWADDR,
+        struct.pack(netinfo._IFADDRMSG, family, 24, 0, 0, 1) +
+        b''.join(_attr(t, p) for t, p in attrs),
+    )
+
+
+class _NetlinkSocket(object):
+
+    def __init__(self, replies):
+        self._replies = list(replies)
+        self.sent = []
+
+    def bind(self, address):
+        pass
+
+    def send(self, data):
+        self.sent.append(data)
+
+    def recv(self, size):
+        return self._replies.pop(0)
+
+    def close(self):
+        pass
+
+
+class NetlinkTest(unittest.TestCase):
+
+    def _addresses(self, replies):
+        s = _NetlinkSocket(replies)
+        with unittest.mock.patch.object(
+            netinfo.socket,
+            'socket',
+            lambda *args: s,
+        ):
+            ret = netinfo._netlinkAddresses()
+        self.assertEqual(len(s.sent), 1)
+        return ret
+
+    def test_parse(self):
+        self.assertEqual(
+            self._addresses(
+                [
+                    _newaddr(
+                        socket.AF_INET,
+                        [
+                            (
+                                netinfo._IFA_ADDRESS,
+                                socket.inet_aton('192.0.2.2'),
+                            ),
+                            (
+                                netinfo._IFA_LOCAL,
+                                socket.inet_aton('192.0.2.1'),
+                            ),
+                        ],
+                    ) +
+                    _newaddr(
+                        socket.AF_INET6,
+                        [
+                            (
+                                netinfo._IFA_ADDRESS,
+                                socket.inet_pton(
+                                    socket.AF_INET6,
+                                    '2001:db8::1',
+                                ),
+                            ),
+                        ],
+                    ),
+                    # dump continues in another datagram
+                    _newaddr(
+                        socket.AF_INET,
+                        [
+                            (
+                                netinfo._IFA_ADDRESS,
+                                socket.inet_aton('127.0.0.1'),
+                            ),
+                        ],
+                    ) +
+                    _message(netinfo._NLMSG_DONE, struct.pack('=i', 0)),
+                ]
+            ),
+            ['192.0.2.1', '2001:db8::1', '127.0.0.1'],
+        )
+
+    def test_error(self):
+        with self.assertRaises(OSError):
+            self._addresses(
+                [_message(netinfo._NLMSG_ERROR, struct.pack('=i', -1))]
+            )
+
+    def test_invalid(self):
+        with self.assertRaises(OSError):
+            self._addresses([struct.pack(netinfo._NLMSGHDR, 4, 0, 0, 1, 0)])
+
+
+class ProcTest(unittest.TestCase):
+
+    IF_INET6 = (
+        '00000000000000000000000000000001 01 80 10 80       lo\n'
+        '20010db8000000000000000000000001 02 40 00 80     eth0\n'
+    )
+
+    def _ioctl(self, fd, request, arg):
+        self.assertEqual(request, netinfo._SIOCGIFCONF)
+        ifreqSize = 40 if struct.calcsize('P') == 8 else 32
+        length, address = struct.unpack('iL', arg)
+        data = b''
+        for name, ipv4 in (('lo', '127.0.0.1'), ('eth0', '192.0.2.1')):
+            ifreq = (
+                name.encode().ljust(16, b'\0') +
+                struct.pack('=H', socket.AF_INET) +
+                b'\0\0' +
+                socket.inet_aton(ipv4)
+            )
+            data += ifreq.ljust(ifreqSize, b'\0')
+        self.assertLessEqual(len(data), length)
+        ctypes.memmove(address, data, len(data))
+        return struct.pack('iL', len(data), address)
+
+    def test_fallback(self):
+        def _netlink():
+            raise OSError('netlink is not available')
+
+        with unittest.mock.patch.object(
+            netinfo,
+            '_netlinkAddresses',
+            _netlink,
+        ), unittest.mock.patch.object(
+            netinfo.os.path,
+            'exists',
+            lambda path: path == '/proc/net/if_inet6',
+        ), unittest.mock.patch(
+            'builtins.open',
+            unittest.mock.mock_open(read_data=self.IF_INET6),
+        ), unittest.mock.patch.object(
+            netinfo.fcntl,
+            'ioctl',
+            self._ioctl,
+        ):
+            self.assertEqual(
+                netinfo.interfaceAddresses(),
+                ['::1', '2001:db8::1', '127.0.0.1', '192.0.2.1'],
+            )
+
+
+class _Resolver(netinfo.Resolver):
+
+    def __init__(self, timeout):
+        super(_Resolver, self).__init__(timeout=timeout)
+        self.release = threading.Event()
+        self.calls = []
+
+    def _forward(self, name):
+        self.calls.append(name)
+        self.release.wait()
+        if name == 'fail':
+            raise RuntimeError('lookup failed')
+        return ['192.0.2.1']
+
+
+class ResolverTest(unittest.TestCase):
+
+    def test_timeout(self):
+        r = _Resolver(timeout=0.1)
+        start = time.monotonic()
+        self.assertEqual(r.forward(['host']), {'host': None})
+        self.assertLess(time.monotonic() - start, 1)
+
+        r.release.set()
+        r.timeout = 5
+        self.assertEqual(r.forward(['host']), {'host': ['192.0.2.1']})
+        # pending lookup is not started again
+        self.assertEqual(r.calls, ['host'])
+
+    def test_cache(self):
+        r = _Resolver(timeout=5)
+        r.release.set()
+        for i in range(2):
+            self.assertEqual(r.forward(['host']), {'host': ['192.0.2.1']})
+        self.assertEqual(r.calls, ['host'])
+
+    def test_failure(self):
+        r = _Resolver(timeout=5)
+        r.release.set()
+        start = time.monotonic()
+        self.assertEqual(
+            r.forward(['fail', 'host']),
+            {'fail': [], 'host': ['192.0.2.1']},
+        )
+        self.assertLess(time.monotonic() - start, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
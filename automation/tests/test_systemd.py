@@ -0,0 +1,234 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""systemd services provider tests."""
+
+
+import importlib.util
+import logging
+import os
+import sys
+import unittest
+
+
+_SRC = os.path.join(os.path.dirname(__file__), '..', '..', 'src')
+sys.path.insert(0, _SRC)
+
+
+def _loadPlugin():
+    name = 'otopi_test_systemd'
+    spec = importlib.util.spec_from_file_location(
+        name,
+        os.path.join(_SRC, 'plugins', 'otopi', 'services', 'systemd.py'),
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+systemd = _loadPlugin()
+
+
+class _Command(object):
+
+    def get(self, command, optional=False):
+        return command
+
+
+class _Plugin(systemd.Plugin):
+
+    command = _Command()
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, units, statuses):
+        self._units = None
+        self._unitsTime = 0
+        self._bus = None
+        self._busError = None
+        self._busDisconnected = ()
+        self._listUnits = units
+        self._statuses = list(statuses)
+        self.executed = []
+        self.commands = []
+
+    def execute(self, args, raiseOnError=True):
+        self.executed.append(args[1])
+        if args[1] == 'list-unit-files':
+            return 0, [
+                '%s.service enabled' % u[0] for u in self._listUnits
+            ], []
+        if args[1] == 'list-units':
+            return 0, [
+                '%s.service loaded %s running %s' % (u[0], u[1], u[0])
+                for u in self._listUnits
+            ], []
+        if args[1] == 'show':
+            states = dict(self._listUnits)
+            states['foo'] = self._statuses.pop(0)
+            out = []
+            for unit in args[4:]:
+                out += [
+                    'Id=%s' % unit,
+                    'LoadState=loaded',
+                    'ActiveState=%s' % states[unit[:-len('.service')]],
+                    '',
+                ]
+            return 0, out, []
+        if args[1] == 'status':
+            return 0 if self._statuses.pop(0) == 'active' else 3, [], []
+        if args[1] in ('enable', 'disable', 'start', 'stop'):
+            self.commands.append(args[1:])
+            return 0, [], []
+        raise AssertionError('unexpected %s' % (args,))
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def test_status_live(self):
+        p = _Plugin(units=[('foo', 'active')], statuses=['active', 'failed'])
+        self.assertTrue(p.status('foo'))
+        self.assertFalse(p.status('foo'))
+        self.assertEqual(p.executed, ['status', 'status'])
+
+    def test_settled_from_snapshot(self):
+        p = _Plugin(
+            units=[('foo', 'active'), ('bar', 'inactive')],
+            statuses=[],
+        )
+        for i in range(2):
+            self.assertEqual(
+                p.statusMany(['foo', 'bar']),
+                {'foo': True, 'bar': False},
+            )
+        self.assertEqual(p.executed, ['list-unit-files', 'list-units'])
+
+    def test_snapshot_expires(self):
+        p = _Plugin(units=[('foo', 'active')], statuses=[])
+        p._SNAPSHOT_LIFETIME = -1
+        p.statusMany(['foo'])
+        p.statusMany(['foo'])
+        self.assertEqual(
+            p.executed,
+            ['list-unit-files', 'list-units'] * 2,
+        )
+
+    def test_transition_observed(self):
+        p = _Plugin(
+            units=[('foo', 'activating')],
+            statuses=['activating', 'active'],
+        )
+        self.assertFalse(p.status('foo'))
+        self.assertTrue(p.status('foo'))
+
+    def test_transition_observed_many(self):
+        p = _Plugin(
+            units=[('foo', 'activating'), ('bar', 'active')],
+            statuses=['activating', 'active'],
+        )
+        self.assertEqual(
+            p.statusMany(['foo', 'bar']),
+            {'foo': False, 'bar': True},
+        )
+        self.assertEqual(
+            p.statusMany(['foo', 'bar']),
+            {'foo': True, 'bar': True},
+        )
+
+
+class _BusError(Exception):
+
+    def get_dbus_name(self):
+        return self.args[0]
+
+
+class _Bus(object):
+    """systemdbus.SystemdBus stand-in."""
+
+    def __init__(self, sysv=(), failed=(), error=None):
+        self._sysv = sysv
+        self._failed = failed
+        self._error = error
+        self.calls = []
+
+    def properties(self, names, props):
+        return dict((name, {'Id': name}) for name in names)
+
+    def jobs(self, method, names):
+        self.calls.append((method, names))
+        if self._error is not None:
+            raise _BusError(self._error)
+        return dict(
+            (name, 'failed' if name in self._failed else 'done')
+            for name in names
+        )
+
+    def enable(self, names, state):
+        self.calls.append(('enable', names, state))
+        return [name for name in names if name in self._sysv]
+
+
+class BusTest(unittest.TestCase):
+
+    def _plugin(self, bus):
+        p = _Plugin(units=[], statuses=[])
+        p._bus = bus
+        p._busError = _BusError
+        p._busDisconnected = ('org.freedesktop.DBus.Error.NoReply',)
+        return p
+
+    def test_jobs(self):
+        bus = _Bus()
+        p = self._plugin(bus)
+        p.stateMany(['foo', 'bar'], True)
+        p.stateMany(['foo'], False)
+        self.assertEqual(
+            bus.calls,
+            [
+                ('StartUnit', ['foo.service', 'bar.service']),
+                ('StopUnit', ['foo.service']),
+            ],
+        )
+        self.assertEqual(p.commands, [])
+
+    def test_job_failed(self):
+        p = self._plugin(_Bus(failed=('bar.service',)))
+        with self.assertRaisesRegex(RuntimeError, "'bar'"):
+            p.stateMany(['foo', 'bar'], True)
+
+    def test_sysv_fallback(self):
+        bus = _Bus(sysv=('bar.service',))
+        p = self._plugin(bus)
+        p.startupMany(['foo', 'bar'], True)
+        self.assertEqual(
+            bus.calls,
+            [('enable', ['foo.service', 'bar.service'], True)],
+        )
+        self.assertEqual(p.commands, [('enable', 'bar.service')])
+
+    def test_native_only(self):
+        p = self._plugin(_Bus())
+        p.startupMany(['foo'], False)
+        self.assertEqual(p.commands, [])
+
+    def test_disconnected(self):
+        p = self._plugin(_Bus(error='org.freedesktop.DBus.Error.NoReply'))
+        p.stateMany(['foo'], True)
+        self.assertEqual(p.commands, [('start', 'foo.service')])
+        self.assertIsNone(p._bus)
+
+    def test_request_failed(self):
+        bus = _Bus(error='org.freedesktop.systemd1.NoSuchUnit')
+        p = self._plugin(bus)
+        p.stateMany(['foo'], True)
+        self.assertEqual(p.commands, [('start', 'foo.service')])
+        self.assertIs(p._bus, bus)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
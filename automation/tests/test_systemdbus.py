@@ -0,0 +1,193 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""systemd D-Bus backend tests, using a mock systemd on a session bus."""
+
+
+import os
+import subprocess
+import sys
+import unittest
+
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), '..', '..', 'src'),
+)
+
+try:
+    import dbus
+    import dbus.mainloop.glib
+    import dbusmock
+    from otopi import systemdbus
+except ImportError:
+    dbusmock = None
+
+
+# JobRemoved of StartUnit is emitted before the reply, of StopUnit a
+# while after it, so both signals received while queueing and signals
+# received while waiting are covered, of RestartUnit never. Units named
+# fail* fail. Method code runs in exec(), so the lambda gets its names
+# as defaults.
+_JOB = '''
+self.jobCount = getattr(self, 'jobCount', 0) + 1
+ret = dbus.ObjectPath('/org/freedesktop/systemd1/job/%d' % self.jobCount)
+signal = (
+    'org.freedesktop.systemd1.Manager',
+    'JobRemoved',
+    'uoss',
+    [
+        dbus.UInt32(self.jobCount),
+        ret,
+        args[0],
+        'failed' if args[0].startswith('fail') else 'done',
+    ],
+)
+'''
+
+_START = _JOB + '''
+self.EmitSignal(*signal)
+'''
+
+_STOP = _JOB + '''
+from gi.repository import GLib
+GLib.timeout_add(
+    100,
+    lambda self=self, signal=signal: self.EmitSignal(*signal),
+)
+'''
+
+_LOAD = '''
+ret = dbus.ObjectPath(
+    '/org/freedesktop/systemd1/unit/' +
+    args[0].replace('.', '_2e').replace('-', '_2d')
+)
+'''
+
+
+def _unitPath(name):
+    return '/org/freedesktop/systemd1/unit/' + name.replace(
+        '.', '_2e'
+    ).replace('-', '_2d')
+
+
+@unittest.skipIf(dbusmock is None, 'dbus, PyGObject or dbusmock missing')
+class SystemdBusTest(
+    dbusmock.DBusTestCase if dbusmock else unittest.TestCase
+):
+
+    UNITS = {
+        'native.service': '',
+        'sysv.service': '/etc/rc.d/init.d/sysv',
+        'fail.service': '',
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.start_session_bus()
+
+    def setUp(self):
+        self._server = self.spawn_server(
+            systemdbus.SystemdBus.SERVICE,
+            systemdbus.SystemdBus.PATH,
+            systemdbus.SystemdBus.MANAGER,
+            system_bus=False,
+            stdout=subprocess.PIPE,
+        )
+        bus = dbus.SessionBus(mainloop=dbus.mainloop.glib.DBusGMainLoop())
+        self._mock = dbus.Interface(
+            bus.get_object(
+                systemdbus.SystemdBus.SERVICE,
+                systemdbus.SystemdBus.PATH,
+            ),
+            dbusmock.MOCK_IFACE,
+        )
+        self._mock.AddMethods(
+            systemdbus.SystemdBus.MANAGER,
+            [
+                ('Subscribe', '', '', ''),
+                ('StartUnit', 'ss', 'o', _START),
+                ('StopUnit', 'ss', 'o', _STOP),
+                ('RestartUnit', 'ss', 'o', _JOB),
+                ('LoadUnit', 's', 'o', _LOAD),
+                ('EnableUnitFiles', 'asbb', 'ba(sss)', 'ret = (False, [])'),
+                ('DisableUnitFiles', 'asb', 'a(sss)', 'ret = []'),
+                ('Reload', '', '', ''),
+            ],
+        )
+        for name, source in self.UNITS.items():
+            self._mock.AddObject(
+                _unitPath(name),
+                systemdbus.SystemdBus.UNIT,
+                {
+                    'Id': name,
+                    'LoadState': 'loaded',
+                    'ActiveState': 'inactive',
+                    'SourcePath': source,
+                },
+                [],
+            )
+        self._bus = systemdbus.SystemdBus(bus=bus)
+
+    def tearDown(self):
+        self._server.terminate()
+        self._server.wait()
+        self._server.stdout.close()
+
+    def _calls(self, method):
+        return [
+            [str(a) for a in args[0]] if args else []
+            for __, name, args in self._mock.GetCalls()
+            if name == method
+        ]
+
+    def test_start(self):
+        self.assertEqual(
+            self._bus.jobs('StartUnit', ['native.service', 'sysv.service']),
+            {'native.service': 'done', 'sysv.service': 'done'},
+        )
+
+    def test_stop_waits(self):
+        self.assertEqual(
+            self._bus.jobs('StopUnit', ['native.service', 'fail.service']),
+            {'native.service': 'done', 'fail.service': 'failed'},
+        )
+
+    def test_timeout(self):
+        self._bus.JOB_TIMEOUT = 1
+        with self.assertRaises(RuntimeError):
+            self._bus.jobs('RestartUnit', ['native.service'])
+
+    def test_properties(self):
+        self.assertEqual(
+            self._bus.properties(['native.service'], props=('Id',)),
+            {'native.service': {'Id': 'native.service'}},
+        )
+
+    def test_enable_sysv(self):
+        self.assertEqual(
+            self._bus.enable(['native.service', 'sysv.service'], True),
+            ['sysv.service'],
+        )
+        self.assertEqual(
+            self._calls('EnableUnitFiles'),
+            [['native.service']],
+        )
+        self.assertEqual(len(self._calls('Reload')), 1)
+
+    def test_disable_sysv_only(self):
+        self.assertEqual(
+            self._bus.enable(['sysv.service'], False),
+            ['sysv.service'],
+        )
+        self.assertEqual(self._calls('DisableUnitFiles'), [])
+        self.assertEqual(self._calls('Reload'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
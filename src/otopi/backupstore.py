@@ -0,0 +1,292 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""Content addressed backup store.
+
+Backed up content is stored once per digest under the objects directory,
+an index records the path, time and digest of each backup.
+
+"""
+
+
+import contextlib
+import datetime
+import errno
+import fcntl
+import gettext
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+
+from . import base
+from . import util
+
+
+def _(m):
+    return gettext.dgettext(message=m, domain='otopi')
+
+
+@util.export
+class BackupStore(base.Base):
+    """Content addressed backup store."""
+
+    INDEX = 'index'
+    LOCK = 'lock'
+    OBJECTS = 'objects'
+
+    # linux/fs.h
+    _FICLONE = 0x40049409
+    _CHUNK_SIZE = 1024 * 1024
+
+    @property
+    def directory(self):
+        return self._directory
+
+    def __init__(self, directory, keep=None, maxBytes=None):
+        """Constructor.
+
+        Keyword arguments:
+        directory -- store directory, created if missing.
+        keep -- number of backups to keep per file, None for all.
+        maxBytes -- maximum size of stored objects, None for unlimited.
+
+        """
+        super(BackupStore, self).__init__()
+        self._directory = directory
+        self._keep = keep
+        self._maxBytes = maxBytes
+        self._objects = os.path.join(self._directory, self.OBJECTS)
+        self._index = os.path.join(self._directory, self.INDEX)
+        if not os.path.exists(self._objects):
+            os.makedirs(self._objects, 0o700)
+
+    def __str__(self):
+        return _("Backup store at '{directory}'").format(
+            directory=self._directory
+        )
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(os.path.join(self._directory, self.LOCK), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _objectPath(self, digest):
+        return os.path.join(self._objects, digest[:2], digest[2:])
+
+    def _digest(self, name):
+        h = hashlib.sha256()
+        with open(name, 'rb') as f:
+            while True:
+                buf = f.read(self._CHUNK_SIZE)
+                if not buf:
+                    break
+                h.update(buf)
+        return h.hexdigest()
+
+    def _clone(self, source, destination):
+        """Copy source into destination, reflink if possible."""
+        with open(source, 'rb') as src:
+            with open(destination, 'wb') as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), self._FICLONE, src.fileno())
+                except OSError:
+                    shutil.copyfileobj(src, dst, self._CHUNK_SIZE)
+                dst.flush()
+                os.fsync(dst.fileno())
+
+    def _readIndex(self):
+        entries = []
+        if os.path.exists(self._index):
+            with open(self._index, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entries.append(json.loads(line))
+        return entries
+
+    def _writeIndex(self, entries):
+        fd, tmpname = tempfile.mkstemp(
+            suffix='.tmp',
+            prefix='%s.' % self.INDEX,
+            dir=self._directory,
+        )
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for entry in entries:
+                    f.write('%s\n' % json.dumps(entry, sort_keys=True))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpname, self._index)
+        except Exception:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+
+    def add(self, name):
+        """Backup a file.
+
+        Keyword arguments:
+        name -- file to backup.
+
+        Returns:
+        Index entry, a dictionary with path, timestamp, digest, size,
+        mode, uid and gid.
+
+        """
+        st = os.stat(name)
+        digest = self._digest(name)
+        entry = {
+            'path': os.path.abspath(name),
+            'timestamp': datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
+            'digest': digest,
+            'size': st.st_size,
+            'mode': st.st_mode & 0o7777,
+            'uid': st.st_uid,
+            'gid': st.st_gid,
+        }
+        with self._locked():
+            objectPath = self._objectPath(digest)
+            if os.path.exists(objectPath):
+                self.logger.debug(
+                    "backup '%s' already stored as '%s'",
+                    name,
+                    digest,
+                )
+            else:
+                objectDir = os.path.dirname(objectPath)
+                if not os.path.exists(objectDir):
+                    os.mkdir(objectDir, 0o700)
+                fd, tmpname = tempfile.mkstemp(
+                    suffix='.tmp',
+                    dir=objectDir,
+                )
+                os.close(fd)
+                try:
+                    self._clone(name, tmpname)
+                    os.rename(tmpname, objectPath)
+                except Exception:
+                    if os.path.exists(tmpname):
+                        os.unlink(tmpname)
+                    raise
+            with open(self._index, 'a') as f:
+                f.write('%s\n' % json.dumps(entry, sort_keys=True))
+                f.flush()
+                os.fsync(f.fileno())
+        return entry
+
+    def list(self, name=None):
+        """List backups.
+
+        Keyword arguments:
+        name -- file to list backups of, None for all files.
+
+        Returns:
+        Index entries, oldest first.
+
+        """
+        with self._locked():
+            entries = self._readIndex()
+        if name is not None:
+            path = os.path.abspath(name)
+            entries = [e for e in entries if e['path'] == path]
+        return entries
+
+    def restore(self, entry, destination=None):
+        """Restore a backup.
+
+        Keyword arguments:
+        entry -- index entry as returned by add() or list().
+        destination -- file to restore to, default is original path.
+
+        Returns:
+        Restored file name.
+
+        """
+        if destination is None:
+            destination = entry['path']
+        objectPath = self._objectPath(entry['digest'])
+        if not os.path.exists(objectPath):
+            raise OSError(
+                errno.ENOENT,
+                _("Backup of '{file}' at {timestamp} is missing").format(
+                    file=entry['path'],
+                    timestamp=entry['timestamp'],
+                ),
+                objectPath,
+            )
+        fd, tmpname = tempfile.mkstemp(
+            suffix='.tmp',
+            prefix='%s.' % os.path.basename(destination),
+            dir=os.path.dirname(os.path.abspath(destination)),
+        )
+        os.close(fd)
+        try:
+            self._clone(objectPath, tmpname)
+            os.chown(tmpname, entry['uid'], entry['gid'])
+            os.chmod(tmpname, entry['mode'])
+            os.rename(tmpname, destination)
+        except Exception:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+        self.logger.debug(
+            "restored '%s' at %s to '%s'",
+            entry['path'],
+            entry['timestamp'],
+            destination,
+        )
+        return destination
+
+    def prune(self):
+        """Apply retention policy.
+
+        Keep the newest backups of each file, then drop the oldest
+        backups until the stored objects fit the size limit, and
+        remove objects no longer referenced. The newest backup of each
+        file is never dropped, even if the size limit is exceeded.
+
+        """
+        with self._locked():
+            entries = self._readIndex()
+            kept = list(entries)
+            if self._keep is not None:
+                counts = {}
+                kept = []
+                for entry in reversed(entries):
+                    counts[entry['path']] = counts.get(entry['path'], 0) + 1
+                    if counts[entry['path']] <= self._keep:
+                        kept.insert(0, entry)
+            if self._maxBytes is not None:
+                newest = dict((e['path'], e) for e in kept)
+                for entry in list(kept):
+                    sizes = dict((e['digest'], e['size']) for e in kept)
+                    if sum(sizes.values()) <= self._maxBytes:
+                        break
+                    if newest[entry['path']] is not entry:
+                        kept.remove(entry)
+
+            if len(kept) != len(entries):
+                self.logger.debug(
+                    'pruning %s backups from %s',
+                    len(entries) - len(kept),
+                    self._directory,
+                )
+                self._writeIndex(kept)
+
+            referenced = set(e['digest'] for e in kept)
+            for d in os.listdir(self._objects):
+                for o in os.listdir(os.path.join(self._objects, d)):
+                    if d + o not in referenced:
+                        os.unlink(os.path.join(self._objects, d, o))
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
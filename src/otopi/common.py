@@ -8,6 +8,8 @@
 
 import builtins
 import gettext
+import grp
+import pwd
 
 
 from . import constants
@@ -18,6 +20,9 @@ def _(m):
     return gettext.dgettext(message=m, domain='otopi')
 
 
+_nssCache = {}
+
+
 @util.export
 def parseTypedValue(value):
     """Parse type:value string into python object."""
@@ -124,4 +129,45 @@ def toUStr(o):
     return o.__class__.__name__
 
 
+@util.export
+def getpwnam(name):
+    """Cached pwd.getpwnam().
+
+    Results are cached for the life of the process or until
+    clearNSSCache() is called.
+
+    """
+    key = ('passwd', name)
+    ret = _nssCache.get(key)
+    if ret is None:
+        ret = _nssCache[key] = pwd.getpwnam(name)
+    return ret
+
+
+@util.export
+def getgrnam(name):
+    """Cached grp.getgrnam().
+
+    Results are cached for the life of the process or until
+    clearNSSCache() is called.
+
+    """
+    key = ('group', name)
+    ret = _nssCache.get(key)
+    if ret is None:
+        ret = _nssCache[key] = grp.getgrnam(name)
+    return ret
+
+
+@util.export
+def clearNSSCache():
+    """Clear user and group lookup cache.
+
+    Call when users or groups may have been added, for example after
+    packages were installed.
+
+    """
+    _nssCache.clear()
+
+
 # vim: expandtab tabstop=4 shiftwidth=4
@@ -24,6 +24,11 @@ class Defaults(object):
         )
     )
     PACKAGER_KEEP_ALIVE_INTERVAL = 30
+    PACKAGER_DNF_EXPIRE_POLICY = 'always'
+    PACKAGER_DNF_EXPIRE_AGE = 600
+    BACKUP_DIR = '/var/lib/otopi/backup'
+    BACKUP_KEEP = 5
+    TRANSACTION_JOURNAL_DIR = '/var/lib/otopi/journal'
 
 
 @util.export
@@ -118,6 +123,12 @@ class CoreEnv(object):
     INTERNAL_PACKAGES_TRANSACTION = 'CORE/internalPackageTransaction'
     MAIN_TRANSACTION = 'CORE/mainTransaction'
     MODIFIED_FILES = 'CORE/modifiedFiles'
+    BACKUP_LEGACY = 'CORE/backupLegacy'
+    BACKUP_DIR = 'CORE/backupDir'
+    BACKUP_KEEP = 'CORE/backupKeep'
+    BACKUP_MAX_BYTES = 'CORE/backupMaxBytes'
+    TRANSACTION_JOURNAL_DIR = 'CORE/transactionJournalDir'
+    TIMING_REPORT = 'CORE/timingReport'
     LOG_FILE_NAME_PREFIX = 'CORE/logFileNamePrefix'
     LOG_DIR = 'CORE/logDir'
     LOG_FILE_NAME = 'CORE/logFileName'
@@ -151,6 +162,7 @@ class SysEnv(object):
     REBOOT_ALLOW = 'SYSTEM/rebootAllow'
     REBOOT_DEFER_TIME = 'SYSTEM/rebootDeferTime'
     COMMAND_PATH = 'SYSTEM/commandPath'
+    SYSTEMD_DBUS = 'SYSTEM/systemdDBus'
 
 
 @util.export
@@ -160,10 +172,14 @@ class NetEnv(object):
     SSH_USER = 'NETWORK/sshUser'
     IPTABLES_ENABLE = 'NETWORK/iptablesEnable'
     IPTABLES_RULES = 'NETWORK/iptablesRules'
+    IPTABLES_RESTORE = 'NETWORK/iptablesRestore'
     FIREWALLD_ENABLE = 'NETWORK/firewalldEnable'
     FIREWALLD_AVAILABLE = 'NETWORK/firewalldAvailable'
     FIREWALLD_SERVICE_PREFIX = 'NETWORK_FIREWALLD_SERVICE/'
     FIREWALLD_DISABLE_SERVICES = 'NETWORK/firewalldDisableServices'
+    FIREWALLD_ZONE_FILES = 'NETWORK/firewalldZoneFiles'
+    RESOLVER = 'NETWORK/resolver'
+    RESOLVE_TIMEOUT = 'NETWORK/resolveTimeout'
 
 
 @util.export
@@ -176,8 +192,16 @@ class PackEnv(object):
     YUM_ROLLBACK = 'PACKAGER/yumRollback'
     DNFPACKAGER_ENABLED = 'PACKAGER/dnfpackagerEnabled'
     DNFPACKAGER_EXPIRE_CACHE = 'PACKAGER/dnfExpireCache'
+    DNF_EXPIRE_POLICY = 'PACKAGER/dnfExpirePolicy'
+    DNF_EXPIRE_AGE = 'PACKAGER/dnfExpireAge'
     DNF_DISABLED_PLUGINS = 'PACKAGER/dnfDisabledPlugins'
     DNF_ROLLBACK = 'PACKAGER/dnfRollback'
+    DNF_PREFETCH = 'PACKAGER/dnfPrefetch'
+    DNF_CACHE_DIR = 'PACKAGER/dnfCacheDir'
+    INSTALL_ROOT = 'PACKAGER/installRoot'
+    DNF_BUNDLE = 'PACKAGER/dnfBundle'
+    DNF_BUNDLE_ONLY = 'PACKAGER/dnfBundleOnly'
+    DNF_BUNDLE_EXPORT = 'PACKAGER/dnfBundleExport'
 
 
 @util.export
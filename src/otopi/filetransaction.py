@@ -6,17 +6,22 @@
 """File transaction element."""
 
 
+import ctypes
 import datetime
+import errno
 import gettext
-import grp
+import itertools
+import logging
 import os
-import pwd
 import shutil
+import stat
 import subprocess
 import tempfile
 
 
+from . import backupstore
 from . import common
+from . import journal
 from . import transaction
 from . import util
 
@@ -25,6 +30,138 @@ def _(m):
     return gettext.dgettext(message=m, domain='otopi')
 
 
+def _encodeContent(content, binary=False):
+    if binary:
+        return content
+
+    if isinstance(content, list) or isinstance(content, tuple):
+        ret = u'\n'.join([common.toUStr(i) for i in content])
+        if content:
+            ret += '\n'
+    else:
+        ret = common.toStr(content)
+        if not ret.endswith('\n'):
+            ret += '\n'
+    return ret.encode("utf-8")
+
+
+@util.export
+class SourceFile(object):
+    """File transaction content read from a file at prepare time."""
+
+    def __init__(self, name):
+        """Constructor.
+
+        Keyword arguments:
+        name -- name of file to read content from.
+
+        """
+        self.name = name
+
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def _contentChunks(content, binary=False):
+    if callable(content):
+        content = content()
+
+    if isinstance(content, SourceFile):
+        with open(content.name, 'rb') as f:
+            while True:
+                chunk = f.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    elif hasattr(content, '__next__'):
+        for chunk in content:
+            if not binary and not isinstance(chunk, bytes):
+                chunk = common.toUStr(chunk).encode('utf-8')
+            yield chunk
+    else:
+        yield _encodeContent(content=content, binary=binary)
+
+
+def _restorecon(logger, what):
+    RESTORECON = '/sbin/restorecon'
+    if os.path.exists(RESTORECON):
+        try:
+            logger.debug(
+                'Executing restorecon for %s',
+                what
+            )
+            p = subprocess.Popen(
+                (RESTORECON, '-r', what),
+                executable=RESTORECON,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                close_fds=True,
+            )
+            stdout, stderr = p.communicate()
+            logger.debug(
+                'restorecon result rc=%s, stdout=%s, stderr=%s',
+                p.returncode,
+                stdout,
+                stderr,
+            )
+            if p.returncode != 0:
+                logger.warning(
+                    _(
+                        "Failed to restore SELinux attributes "
+                        "for '{file}'"
+                    ).format(
+                        file=what,
+                    )
+                )
+        except Exception:
+            logger.warning(
+                _(
+                    "Failed to restore SELinux attributes "
+                    "for '{file}'"
+                ).format(
+                    file=what,
+                )
+            )
+            logger.debug('Exception', exc_info=True)
+            raise
+
+
+_AT_FDCWD = -100
+_RENAME_EXCHANGE = (1 << 1)
+
+
+def _renameExchange(source, destination):
+    """Atomically exchange two paths using renameat2(2).
+
+    Raises OSError if exchange is not supported by libc, kernel or
+    filesystem.
+
+    """
+    renameat2 = getattr(
+        ctypes.CDLL(None, use_errno=True),
+        'renameat2',
+        None
+    )
+    if renameat2 is None:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS), source)
+    renameat2.argtypes = (
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_uint,
+    )
+    if renameat2(
+        _AT_FDCWD,
+        os.fsencode(source),
+        _AT_FDCWD,
+        os.fsencode(destination),
+        _RENAME_EXCHANGE,
+    ) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), source)
+
+
 @util.export
 class FileTransaction(transaction.TransactionElement):
     """File transaction element."""
@@ -74,6 +211,7 @@ class FileTransaction(transaction.TransactionElement):
         return ret
 
     _atomicMove = _defaultAtomicMove
+    _backupStore = None
 
     @property
     def name(self):
@@ -94,6 +232,21 @@ class FileTransaction(transaction.TransactionElement):
     def getAtomicMove(clz, function):
         return clz._atomicMove
 
+    @classmethod
+    def registerBackupStore(clz, store):
+        """Register backup store.
+
+        Keyword arguments:
+        store -- backupstore.BackupStore, None to backup next to the
+            file as name.YYYYmmddHHMMSS.
+
+        """
+        clz._backupStore = store
+
+    @classmethod
+    def getBackupStore(clz):
+        return clz._backupStore
+
     def __init__(
         self,
         name,
@@ -119,7 +272,10 @@ class FileTransaction(transaction.TransactionElement):
 
         Keyword arguments:
         name -- name of file.
-        content -- content of file (string or list of lines).
+        content -- content of file (string or list of lines), an iterator
+            of chunks, a SourceFile, or a callable returning any of these.
+            Content is evaluated only when transaction is prepared, chunks
+            are written as-is.
         binary -- True if the content is binary data. If False, the content is
             encoded to allow comparing with file content or writing to file.
         mode -- mode of file.
@@ -136,20 +292,8 @@ class FileTransaction(transaction.TransactionElement):
         """
         super(FileTransaction, self).__init__()
         self._name = name
-
-        if binary:
-            self._content = content
-        else:
-            if isinstance(content, list) or isinstance(content, tuple):
-                self._content = u'\n'.join([common.toUStr(i) for i in content])
-                if content:
-                    self._content += '\n'
-            else:
-                self._content = common.toStr(content)
-                if not self._content.endswith('\n'):
-                    self._content += '\n'
-            self._content = self._content.encode("utf-8")
-
+        self._content = content
+        self._binary = binary
         self._mode = mode
         self._dmode = dmode
         self._owner = -1
@@ -160,15 +304,17 @@ class FileTransaction(transaction.TransactionElement):
         self._visibleButUnsafe = visibleButUnsafe
         self._modifiedList = modifiedList
         if owner is not None:
-            self._owner, self._group = pwd.getpwnam(owner)[2:4]
+            self._owner, self._group = common.getpwnam(owner)[2:4]
         if group is not None:
-            self._group = grp.getgrnam(group)[2]
+            self._group = common.getgrnam(group)[2]
         if downer is not None:
-            self._downer, self._group = pwd.getpwnam(downer)[2:4]
+            self._downer, self._group = common.getpwnam(downer)[2:4]
         if dgroup is not None:
-            self._dgroup = grp.getgrnam(dgroup)[2]
+            self._dgroup = common.getgrnam(dgroup)[2]
         self._tmpname = None
         self._backup = None
+        self._backupStore = None
+        self._backupEntry = None
         self._originalFileWasMissing = not os.path.exists(self._name)
         self._prepared = False
         self._originalDiffer = True
@@ -179,17 +325,53 @@ class FileTransaction(transaction.TransactionElement):
             file=self._name
         )
 
+    def _compare(self, chunks):
+        """Compare content chunks with current file.
+
+        Returns:
+        (offset, chunks) -- offset of first differing chunk and the
+            remaining chunks, offset is None if content is the same.
+
+        """
+        offset = 0
+        with open(self._name, 'rb') as f:
+            for chunk in chunks:
+                if f.read(len(chunk)) != chunk:
+                    return offset, itertools.chain((chunk,), chunks)
+                offset += len(chunk)
+            if f.read(1):
+                return offset, chunks
+        return None, None
+
+    def _write(self, fd, offset, chunks):
+        def _writeChunk(chunk):
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(fd, view):]
+
+        if offset:
+            # the same prefix was consumed while comparing
+            with open(self._name, 'rb') as f:
+                while offset:
+                    buf = f.read(min(offset, _CHUNK_SIZE))
+                    offset -= len(buf)
+                    _writeChunk(buf)
+        for chunk in chunks:
+            _writeChunk(chunk)
+
     def prepare(self):
+        chunks = _contentChunks(content=self._content, binary=self._binary)
+        offset = 0
         if self._originalFileWasMissing:
             self.logger.debug("file '%s' missing" % self._name)
         else:
             self.logger.debug("file '%s' exists" % self._name)
-            with open(self._name, 'rb') as f:
-                if f.read() == self._content:
-                    self.logger.debug(
-                        "file '%s' already has content" % self._name
-                    )
-                    self._originalDiffer = False
+            offset, chunks = self._compare(chunks)
+            if offset is None:
+                self.logger.debug(
+                    "file '%s' already has content" % self._name
+                )
+                self._originalDiffer = False
 
         if self._originalDiffer:
             mydir = os.path.dirname(self._name)
@@ -210,23 +392,33 @@ class FileTransaction(transaction.TransactionElement):
                 #
                 # backup the file
                 #
-                self._backup = "%s.%s" % (
-                    self._name,
-                    datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-                )
-                self.logger.debug(
-                    "backup '%s'->'%s'" % (
+                self._backupStore = type(self)._backupStore
+                if self._backupStore is not None:
+                    self._backupEntry = self._backupStore.add(self._name)
+                    self.logger.debug(
+                        "backup '%s'->'%s'" % (
+                            self._name,
+                            self._backupEntry['digest'],
+                        )
+                    )
+                else:
+                    self._backup = "%s.%s" % (
                         self._name,
-                        self._backup
+                        datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+                    )
+                    self.logger.debug(
+                        "backup '%s'->'%s'" % (
+                            self._name,
+                            self._backup
+                        )
+                    )
+                    shutil.copyfile(self._name, self._backup)
+                    shutil.copystat(self._name, self._backup)
+                    os.chown(
+                        self._backup,
+                        currentStat.st_uid,
+                        currentStat.st_gid
                     )
-                )
-                shutil.copyfile(self._name, self._backup)
-                shutil.copystat(self._name, self._backup)
-                os.chown(
-                    self._backup,
-                    currentStat.st_uid,
-                    currentStat.st_gid
-                )
 
             fd = -1
             try:
@@ -250,9 +442,10 @@ class FileTransaction(transaction.TransactionElement):
                         self._mode
                     )
 
-                os.write(fd, self._content)
+                self._write(fd, offset, chunks)
                 os.fsync(fd)
 
+                self.journalUpdate()
                 if self._visibleButUnsafe:
                     type(self)._atomicMove(
                         source=self._tmpname,
@@ -274,6 +467,11 @@ class FileTransaction(transaction.TransactionElement):
                 if self._originalFileWasMissing:
                     if os.path.exists(self._name):
                         os.unlink(self._name)
+                elif self._backupEntry is not None:
+                    self._backupStore.restore(
+                        entry=self._backupEntry,
+                        destination=self._name,
+                    )
                 elif (
                     self._backup is not None and
                     os.path.exists(self._backup)
@@ -302,51 +500,378 @@ class FileTransaction(transaction.TransactionElement):
             if self._modifiedList is not None:
                 self._modifiedList.append(self._name)
 
-            RESTORECON = '/sbin/restorecon'
-            if os.path.exists(RESTORECON):
-                what = (
+            _restorecon(
+                logger=self.logger,
+                what=(
                     self._name if self._createdDirectory is None
                     else self._createdDirectory
+                ),
+            )
+
+    def journal(self):
+        if not self._originalDiffer:
+            return None
+        return {
+            'type': 'file',
+            'name': self._name,
+            'tmpname': self._tmpname,
+            'visibleButUnsafe': self._visibleButUnsafe,
+            'originalFileWasMissing': self._originalFileWasMissing,
+            'backup': self._backup,
+            'backupStore': (
+                self._backupStore.directory
+                if self._backupEntry is not None
+                else None
+            ),
+            'backupEntry': self._backupEntry,
+        }
+
+    @classmethod
+    def recover(clz, record, commit):
+        """Commit or abort element out of its journal record.
+
+        Keyword arguments:
+        record -- record as returned by journal().
+        commit -- True to commit, False to abort.
+
+        """
+        logger = logging.getLogger(__name__)
+        name = record['name']
+        # None if interrupted before the temporary file was created
+        tmpname = record['tmpname']
+        if tmpname is None:
+            if commit:
+                logger.warning(
+                    _("Cannot commit '{file}', it was not prepared").format(
+                        file=name,
+                    )
+                )
+        elif commit:
+            if not record['visibleButUnsafe'] and os.path.exists(tmpname):
+                logger.debug("recover: committing '%s'", name)
+                clz._atomicMove(
+                    source=tmpname,
+                    destination=name,
                 )
+                _restorecon(logger=logger, what=name)
+        elif record['visibleButUnsafe']:
+            logger.debug("recover: aborting '%s'", name)
+            if record['originalFileWasMissing']:
+                if os.path.exists(name):
+                    os.unlink(name)
+            elif record['backupEntry'] is not None:
+                backupstore.BackupStore(
+                    directory=record['backupStore'],
+                ).restore(
+                    entry=record['backupEntry'],
+                    destination=name,
+                )
+            elif (
+                record['backup'] is not None and
+                os.path.exists(record['backup'])
+            ):
+                clz._atomicMove(
+                    source=record['backup'],
+                    destination=name,
+                )
+        elif os.path.exists(tmpname):
+            logger.debug("recover: aborting '%s'", name)
+            os.unlink(tmpname)
+
+
+@util.export
+class TreeTransaction(transaction.TransactionElement):
+    """Directory tree transaction element."""
+
+    @property
+    def name(self):
+        return self._name
+
+    def __init__(
+        self,
+        name,
+        content,
+        binary=False,
+        mode=0o644,
+        dmode=0o755,
+        owner=None,
+        group=None,
+        enforcePermissions=False,
+        removeUnmanaged=False,
+        modifiedList=None,
+    ):
+        """Constructor.
+
+        Diff content against the current tree, if no change, does nothing.
+        Stage the new tree as temporary directory at same parent directory,
+        unchanged files are hard linked from the current tree.
+        When commit exchange the staged tree with the current tree, the
+        current tree is kept as backup.
+
+        Keyword arguments:
+        name -- name of directory.
+        content -- dictionary of relative file name to content, each
+            content is in the format accepted by FileTransaction and is
+            evaluated when transaction is prepared.
+        binary -- True if the content is binary data.
+        mode -- mode of new files.
+        dmode -- mode of new directories.
+        owner -- owner (name) of new files and directories.
+        group -- group (name) of new files and directories.
+        enforcePermissions -- if True permissions are enforced also
+            if previous file was exists.
+        removeUnmanaged -- if True files which are not in content are
+            removed from the tree, otherwise they are kept.
+        modifiedList -- a list to add file names if were changed.
+
+        """
+        super(TreeTransaction, self).__init__()
+        self._name = os.path.normpath(name)
+        self._source = content
+        self._binary = binary
+        self._content = {}
+        self._mode = mode
+        self._dmode = dmode
+        self._owner = -1
+        self._group = -1
+        self._enforcePermissions = enforcePermissions
+        self._removeUnmanaged = removeUnmanaged
+        self._modifiedList = modifiedList
+        if owner is not None:
+            self._owner, self._group = common.getpwnam(owner)[2:4]
+        if group is not None:
+            self._group = common.getgrnam(group)[2]
+        self._stagename = None
+        self._backup = None
+        self._liveDirs = {}
+        self._changes = []
+        self._prepared = False
+
+    def __str__(self):
+        return _("Tree transaction for '{tree}'").format(
+            tree=self._name
+        )
+
+    def _scan(self):
+        dirs = {}
+        files = {}
+        if os.path.isdir(self._name):
+            dirs[os.curdir] = os.lstat(self._name)
+            for root, dirnames, filenames in os.walk(self._name):
+                rel = os.path.relpath(root, self._name)
+                for d in dirnames:
+                    path = os.path.join(root, d)
+                    if os.path.islink(path):
+                        filenames.append(d)
+                    else:
+                        dirs[
+                            os.path.normpath(os.path.join(rel, d))
+                        ] = os.lstat(path)
+                for f in filenames:
+                    files[
+                        os.path.normpath(os.path.join(rel, f))
+                    ] = os.lstat(os.path.join(root, f))
+        return dirs, files
+
+    def _differ(self, rel, st):
+        if (
+            not stat.S_ISREG(st.st_mode) or
+            st.st_size != len(self._content[rel])
+        ):
+            return True
+        if self._enforcePermissions and (
+            stat.S_IMODE(st.st_mode) != self._mode or
+            self._owner not in (-1, st.st_uid) or
+            self._group not in (-1, st.st_gid)
+        ):
+            return True
+        with open(os.path.join(self._name, rel), 'rb') as f:
+            return f.read() != self._content[rel]
+
+    def _setDirAttributes(self, path, st):
+        if st is not None and not self._enforcePermissions:
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+            os.chown(path, st.st_uid, st.st_gid)
+        else:
+            os.chmod(path, self._dmode)
+            os.chown(path, self._owner, self._group)
+
+    def _mkdir(self, rel):
+        path = os.path.join(self._stagename, rel)
+        if not os.path.isdir(path):
+            self._mkdir(os.path.dirname(rel))
+            os.mkdir(path)
+            self._setDirAttributes(path, self._liveDirs.get(rel))
+
+    def _carry(self, rel, st):
+        source = os.path.join(self._name, rel)
+        destination = os.path.join(self._stagename, rel)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(source), destination)
+            os.lchown(destination, st.st_uid, st.st_gid)
+        else:
+            try:
+                os.link(source, destination)
+            except OSError:
+                shutil.copy2(source, destination)
+                os.chown(destination, st.st_uid, st.st_gid)
+
+    def _write(self, rel, st):
+        destination = os.path.join(self._stagename, rel)
+        if st is not None and not self._enforcePermissions:
+            mode = stat.S_IMODE(st.st_mode)
+            owner, group = st.st_uid, st.st_gid
+        else:
+            mode = self._mode
+            owner, group = self._owner, self._group
+        fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            os.chown(destination, owner, group)
+            os.chmod(destination, mode)
+            os.write(fd, self._content[rel])
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def prepare(self):
+        self._content = dict(
+            (
+                os.path.normpath(k),
+                b''.join(_contentChunks(content=v, binary=self._binary)),
+            )
+            for k, v in self._source.items()
+        )
+        self._liveDirs, liveFiles = self._scan()
+
+        self._changes = []
+        for rel in sorted(set(self._content.keys()) | set(liveFiles.keys())):
+            st = liveFiles.get(rel)
+            if rel not in self._content:
+                if self._removeUnmanaged:
+                    self._changes.append(('remove', rel))
+            elif st is None:
+                self._changes.append(('add', rel))
+            elif self._differ(rel, st):
+                self._changes.append(('modify', rel))
+
+        if not self._changes:
+            self.logger.debug("tree '%s' already has content" % self._name)
+            return
+
+        self.logger.debug(
+            "tree '%s' changes: %s" % (
+                self._name,
+                self._changes,
+            )
+        )
+
+        parent = os.path.dirname(os.path.abspath(self._name))
+        if not os.path.exists(parent):
+            os.makedirs(parent, self._dmode)
+
+        self._stagename = tempfile.mkdtemp(
+            suffix=".tmp",
+            prefix=".%s." % os.path.basename(self._name),
+            dir=parent,
+        )
+        try:
+            self._setDirAttributes(
+                self._stagename,
+                self._liveDirs.get(os.curdir),
+            )
+            changed = set(rel for op, rel in self._changes)
+            if not self._removeUnmanaged:
+                for rel in self._liveDirs:
+                    self._mkdir(rel)
+            for rel, st in liveFiles.items():
+                if rel not in changed:
+                    self._mkdir(os.path.dirname(rel))
+                    self._carry(rel, st)
+            for op, rel in self._changes:
+                if op != 'remove':
+                    self._mkdir(os.path.dirname(rel))
+                    self._write(rel, liveFiles.get(rel))
+            self._prepared = True
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        try:
+            if (
+                self._stagename is not None and
+                os.path.exists(self._stagename)
+            ):
+                shutil.rmtree(self._stagename)
+        except OSError:
+            self.logger.debug('Exception during abort', exc_info=True)
+        self._stagename = None
+
+    def _commitPerFile(self):
+        os.mkdir(self._backup)
+        shutil.copystat(self._name, self._backup)
+        for op, rel in self._changes:
+            live = os.path.join(self._name, rel)
+            if op != 'add':
+                backup = os.path.join(self._backup, rel)
+                if not os.path.isdir(os.path.dirname(backup)):
+                    os.makedirs(os.path.dirname(backup))
                 try:
-                    self.logger.debug(
-                        'Executing restorecon for %s',
-                        what
-                    )
-                    p = subprocess.Popen(
-                        (RESTORECON, '-r', what),
-                        executable=RESTORECON,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE,
-                        close_fds=True,
+                    os.link(live, backup, follow_symlinks=False)
+                except OSError:
+                    shutil.copy2(live, backup, follow_symlinks=False)
+            if op == 'remove':
+                os.unlink(live)
+            else:
+                if not os.path.isdir(os.path.dirname(live)):
+                    os.makedirs(os.path.dirname(live), self._dmode)
+                FileTransaction._atomicMove(
+                    source=os.path.join(self._stagename, rel),
+                    destination=live,
+                )
+        shutil.rmtree(self._stagename)
+
+    def commit(self):
+        if self._prepared:
+            if not os.path.exists(self._name):
+                os.rename(self._stagename, self._name)
+            else:
+                backup = self._backup = "%s.%s" % (
+                    self._name,
+                    datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+                )
+                index = 0
+                while os.path.lexists(self._backup):
+                    index += 1
+                    self._backup = "%s.%s" % (backup, index)
+                self.logger.debug(
+                    "backup '%s'->'%s'" % (
+                        self._name,
+                        self._backup
                     )
-                    stdout, stderr = p.communicate()
+                )
+                try:
+                    _renameExchange(self._stagename, self._name)
+                except OSError:
                     self.logger.debug(
-                        'restorecon result rc=%s, stdout=%s, stderr=%s',
-                        p.returncode,
-                        stdout,
-                        stderr,
+                        'Cannot exchange trees, using per file rename',
+                        exc_info=True,
                     )
-                    if p.returncode != 0:
-                        self.logger.warning(
-                            _(
-                                "Failed to restore SELinux attributes "
-                                "for '{file}'"
-                            ).format(
-                                file=what,
-                            )
-                        )
-                except Exception:
-                    self.logger.warning(
-                        _(
-                            "Failed to restore SELinux attributes "
-                            "for '{file}'"
-                        ).format(
-                            file=what,
-                        )
-                    )
-                    self.logger.debug('Exception', exc_info=True)
-                    raise
+                    self._commitPerFile()
+                else:
+                    os.rename(self._stagename, self._backup)
+            self._stagename = None
+
+            if self._modifiedList is not None:
+                self._modifiedList.extend(
+                    os.path.join(self._name, rel)
+                    for op, rel in self._changes
+                )
+
+            _restorecon(logger=self.logger, what=self._name)
+
+
+journal.Journal.registerRecovery('file', FileTransaction.recover)
 
 
 # vim: expandtab tabstop=4 shiftwidth=4
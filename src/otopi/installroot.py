@@ -0,0 +1,182 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""Provision several installroots concurrently.
+
+Repository metadata is loaded once into a shared dnf cache, then an
+otopi sequence is executed per installroot using the cache without
+checking the repositories again. dnf locks the shared cache, so only
+the rpm transactions run in parallel.
+
+Usage:
+    python3 -m otopi.installroot --cache-dir=DIR ROOT... -- OTOPI_ARGS
+
+"""
+
+
+import argparse
+import concurrent.futures
+import gettext
+import os
+import subprocess
+import sys
+
+
+from . import base
+from . import constants
+from . import util
+
+
+def _(m):
+    return gettext.dgettext(message=m, domain='otopi')
+
+
+@util.export
+class InstallRootDriver(base.Base):
+    """Execute otopi against several installroots."""
+
+    def __init__(
+        self,
+        cacheDir,
+        command=('otopi',),
+        maxParallel=None,
+        outputDir=None,
+    ):
+        """Constructor.
+
+        Keyword arguments:
+        cacheDir -- shared dnf cache directory.
+        command -- otopi command.
+        maxParallel -- maximum concurrent executions, None for all.
+        outputDir -- directory for output of each execution, None to
+            inherit.
+
+        """
+        super(InstallRootDriver, self).__init__()
+        self._cacheDir = cacheDir
+        self._command = list(command)
+        self._maxParallel = maxParallel
+        self._outputDir = outputDir
+
+    def warmCache(self):
+        """Load fresh repository metadata into the shared cache."""
+        from . import minidnf
+
+        mini = minidnf.MiniDNF(cacheDir=self._cacheDir)
+        mini.setExpirePolicy(policy=mini.EXPIRE_AGE, age=0)
+        mini.clean(['expire-cache'])
+        self.logger.debug(mini.getConf())
+        self.logger.debug(
+            'metadata loaded in %.2f seconds',
+            mini.metadataLoadTime,
+        )
+        del mini
+
+    def _execute(self, root, args):
+        cmd = self._command + list(args) + [
+            '%s=str:%s' % (constants.PackEnv.INSTALL_ROOT, root),
+            '%s=str:%s' % (constants.PackEnv.DNF_CACHE_DIR, self._cacheDir),
+            '%s=str:never' % constants.PackEnv.DNF_EXPIRE_POLICY,
+        ]
+        self.logger.debug('executing %s', cmd)
+        if self._outputDir is None:
+            return subprocess.call(cmd)
+        with open(
+            os.path.join(
+                self._outputDir,
+                '%s.out' % os.path.basename(os.path.normpath(root)),
+            ),
+            'w',
+        ) as output:
+            return subprocess.call(
+                cmd,
+                stdout=output,
+                stderr=subprocess.STDOUT,
+            )
+
+    def run(self, roots, args=()):
+        """Execute otopi against installroots.
+
+        Keyword arguments:
+        roots -- installroots.
+        args -- otopi arguments.
+
+        Returns:
+        Dictionary of installroot to exit code.
+
+        """
+        roots = list(roots)
+        if not roots:
+            return {}
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._maxParallel or len(roots),
+        ) as executor:
+            futures = dict(
+                (root, executor.submit(self._execute, root, args))
+                for root in roots
+            )
+            return dict(
+                (root, future.result())
+                for root, future in futures.items()
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=_('Provision several installroots concurrently'),
+    )
+    parser.add_argument(
+        '--cache-dir',
+        required=True,
+        help=_('shared dnf cache directory'),
+    )
+    parser.add_argument(
+        '--parallel',
+        type=int,
+        default=None,
+        help=_('maximum concurrent executions'),
+    )
+    parser.add_argument(
+        '--output-dir',
+        default=None,
+        help=_('directory for output of each execution'),
+    )
+    parser.add_argument(
+        '--command',
+        default='otopi',
+        help=_('otopi command'),
+    )
+    parser.add_argument(
+        'roots',
+        nargs='+',
+        metavar='ROOT',
+        help=_('installroot'),
+    )
+    argv = sys.argv[1:]
+    args = []
+    if '--' in argv:
+        args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    options = parser.parse_args(argv)
+
+    driver = InstallRootDriver(
+        cacheDir=options.cache_dir,
+        command=(options.command,),
+        maxParallel=options.parallel,
+        outputDir=options.output_dir,
+    )
+    driver.warmCache()
+    ret = 0
+    for root, code in sorted(driver.run(options.roots, args).items()):
+        print('%s: %s' % (root, code))
+        ret = max(ret, code)
+    return ret
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
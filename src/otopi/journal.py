@@ -0,0 +1,216 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""Transaction write-ahead journal.
+
+The intent of each transaction element is recorded and synced to disk
+before the element is prepared, and updated before the element changes
+anything visible. A commit mark is synced before the first element is
+committed. An interrupted transaction is then rolled forward if the
+commit mark exists, and rolled back otherwise.
+
+"""
+
+
+import fcntl
+import gettext
+import glob
+import json
+import logging
+import os
+import tempfile
+
+
+from . import base
+from . import util
+
+
+def _(m):
+    return gettext.dgettext(message=m, domain='otopi')
+
+
+@util.export
+class Journal(base.Base):
+    """Transaction write-ahead journal."""
+
+    SUFFIX = '.journal'
+    TMP_SUFFIX = '.tmp'
+
+    _recovery = {}
+
+    @classmethod
+    def registerRecovery(clz, recordType, function):
+        """Register recovery function for record type.
+
+        Keyword arguments:
+        recordType -- type of records as returned by
+            TransactionElement.journal().
+        function -- function(record, commit), commit is True if the
+            element should be committed, False if it should be aborted.
+
+        """
+        clz._recovery[recordType] = function
+
+    @staticmethod
+    def _syncDirectory(directory):
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @property
+    def name(self):
+        return self._name
+
+    def __init__(self, directory):
+        """Constructor.
+
+        Keyword arguments:
+        directory -- journal directory, created if missing.
+
+        """
+        super(Journal, self).__init__()
+        self._directory = directory
+        if not os.path.exists(self._directory):
+            os.makedirs(self._directory, 0o700)
+        # lock before the journal is visible to recover()
+        fd, tmpname = tempfile.mkstemp(
+            suffix=self.SUFFIX + self.TMP_SUFFIX,
+            prefix='transaction.',
+            dir=self._directory,
+        )
+        self._file = os.fdopen(fd, 'w')
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        self._name = tmpname[:-len(self.TMP_SUFFIX)]
+        os.rename(tmpname, self._name)
+        self._syncDirectory(self._directory)
+
+    def __str__(self):
+        return _("Transaction journal '{name}'").format(name=self._name)
+
+    def _write(self, entry):
+        self._file.write('%s\n' % json.dumps(entry, sort_keys=True))
+
+    def sync(self):
+        """Flush records to disk."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record(self, element, record, sync=False):
+        """Append element record.
+
+        A later record of the same element replaces the former.
+
+        Keyword arguments:
+        element -- element index within transaction.
+        record -- record as returned by TransactionElement.journal().
+        sync -- sync to disk, otherwise not synced until sync().
+
+        """
+        self._write({'element': element, 'record': record})
+        if sync:
+            self.sync()
+
+    def commit(self):
+        """Mark transaction as committing."""
+        self._write({'state': 'commit'})
+        self.sync()
+
+    def close(self):
+        """Remove journal, transaction is done."""
+        if self._file is not None:
+            os.unlink(self._name)
+            self._syncDirectory(self._directory)
+            self._file.close()
+            self._file = None
+
+    @classmethod
+    def recover(clz, directory):
+        """Recover interrupted transactions.
+
+        Journals locked by running processes are skipped.
+
+        Keyword arguments:
+        directory -- journal directory.
+
+        Returns:
+        List of recovered journal names.
+
+        """
+        logger = logging.getLogger(__name__)
+        ret = []
+        for name in glob.glob(
+            os.path.join(directory, '*%s%s' % (clz.SUFFIX, clz.TMP_SUFFIX))
+        ):
+            # created but never became a journal
+            with open(name, 'r') as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                os.unlink(name)
+        for name in sorted(
+            glob.glob(os.path.join(directory, '*%s' % clz.SUFFIX))
+        ):
+            with open(name, 'r') as f:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    logger.debug("journal '%s' is in use", name)
+                    continue
+
+                records = {}
+                commit = False
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # torn write, nothing after it was synced
+                        break
+                    if entry.get('state') == 'commit':
+                        commit = True
+                    elif 'record' in entry:
+                        records[
+                            entry.get('element', len(records))
+                        ] = entry['record']
+
+                logger.debug(
+                    "recovering journal '%s' with %s records, %s",
+                    name,
+                    len(records),
+                    'commit' if commit else 'rollback',
+                )
+                for element, record in sorted(records.items()):
+                    function = clz._recovery.get(record.get('type'))
+                    if function is None:
+                        logger.warning(
+                            _(
+                                "Cannot recover unknown journal record "
+                                "{record}"
+                            ).format(
+                                record=record,
+                            )
+                        )
+                        continue
+                    try:
+                        function(record=record, commit=commit)
+                    except Exception:
+                        logger.debug('Exception', exc_info=True)
+                        logger.warning(
+                            _(
+                                "Cannot recover journal record {record}"
+                            ).format(
+                                record=record,
+                            )
+                        )
+                os.unlink(name)
+                ret.append(name)
+        if ret:
+            clz._syncDirectory(directory)
+        return ret
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
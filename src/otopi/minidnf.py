@@ -6,10 +6,19 @@
 """Minimalist dnf API interaction."""
 
 
+import concurrent.futures
+import contextlib
+import functools
 import gettext
+import hashlib
 import logging
 import os
+import queue
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
 
@@ -18,12 +27,20 @@ import traceback
 # This applies also to python3-hawkey, which is a dependency of dnf.
 import dnf
 import dnf.callback
+import dnf.lock
 import dnf.logging
+import dnf.repo
+import dnf.rpm
+import dnf.rpm.miscutils
+import dnf.rpm.transaction
+import dnf.selector
 import dnf.subject
+import dnf.util
 import dnf.yum.rpmtrans
 import dnf.transaction_sr
 from dnf.cli.cli import Cli
 import hawkey
+import librepo
 
 from . import packager
 
@@ -35,6 +52,14 @@ def _(m):
 class MiniDNFSinkBase(object):
     """Sink base."""
 
+    PHASE_BASE = 'base'
+    PHASE_SACK = 'sack'
+    PHASE_RESOLVE = 'resolve'
+    PHASE_DOWNLOAD = 'download'
+    PHASE_SIGNATURE = 'signature'
+    PHASE_TRANSACTION = 'transaction'
+    PHASE_ROLLBACK = 'rollback'
+
     @property
     def failed(self):
         return self._failed
@@ -94,11 +119,44 @@ class MiniDNFSinkBase(object):
         """Last chance before reexec."""
         pass
 
+    def phaseStart(self, phase):
+        """Phase started.
+
+        Keyword arguments:
+        phase -- phase name, one of PHASE_*.
+
+        """
+        pass
+
+    def phaseEnd(self, phase, elapsed, details):
+        """Phase ended.
+
+        Keyword arguments:
+        phase -- phase name, one of PHASE_*.
+        elapsed -- elapsed seconds.
+        details -- dictionary of phase metrics, for example files,
+            bytes and rate of download, counting only packages actually
+            downloaded, failed if phase failed.
+
+        """
+        pass
+
+    def packageProcessed(self, package, action, elapsed):
+        """Package processed within rpm transaction.
+
+        Keyword arguments:
+        package -- package name.
+        action -- action performed.
+        elapsed -- elapsed seconds.
+
+        """
+        pass
+
 
 # Copied from dnf:dnf/cli/commands/history.py and edited a bit
 # TODO: Revert to using an official API once available:
 # https://bugzilla.redhat.com/2010209
-def _revert_transaction(trans, base, skip_unavailable):
+def _revert_data(trans):
     action_map = {
         "Install": "Removed",
         "Removed": "Install",
@@ -128,6 +186,82 @@ def _revert_transaction(trans, base, skip_unavailable):
                 # actions from the @System repo
                 ti["repo_id"] = None
 
+    return data
+
+
+def _coalesce_rpms(rpms):
+    """Drop intermediate package versions.
+
+    A version brought in by reverting one transaction and taken out by
+    reverting another, e.g. installed and then removed, cancels out.
+    Only matched pairs cancel, an upgrade or downgrade whose other side
+    was cancelled becomes an install or a removal.
+
+    """
+    added = ("Install", "Upgrade", "Downgrade")
+    taken = ("Removed", "Upgraded", "Downgraded", "Obsoleted")
+
+    counts = {}
+    for ti in rpms:
+        if ti["action"] in added + taken:
+            c = counts.setdefault(ti["nevra"], {"added": 0, "taken": 0})
+            c["added" if ti["action"] in added else "taken"] += 1
+    cancel = dict(
+        (nevra, {"added": min(c.values()), "taken": min(c.values())})
+        for nevra, c in counts.items()
+    )
+
+    ret = []
+    for ti in rpms:
+        side = (
+            "added" if ti["action"] in added
+            else "taken" if ti["action"] in taken
+            else None
+        )
+        if side is not None and cancel[ti["nevra"]][side] > 0:
+            cancel[ti["nevra"]][side] -= 1
+        else:
+            ret.append(dict(ti))
+
+    def _name(ti):
+        return hawkey.split_nevra(ti["nevra"]).name
+
+    replacing = set(
+        _name(ti) for ti in ret if ti["action"] in ("Upgrade", "Downgrade")
+    )
+    replaced = set(
+        _name(ti) for ti in ret if ti["action"] in ("Upgraded", "Downgraded")
+    )
+    for ti in ret:
+        if (
+            ti["action"] in ("Upgraded", "Downgraded") and
+            _name(ti) not in replacing
+        ):
+            ti["action"] = "Removed"
+        elif (
+            ti["action"] in ("Upgrade", "Downgrade") and
+            _name(ti) not in replaced
+        ):
+            ti["action"] = "Install"
+    return ret
+
+
+def _revert_transactions(transactions, base, skip_unavailable):
+    """Revert transactions using a single replay."""
+    data = None
+    for trans in sorted(transactions, key=lambda t: t.tid, reverse=True):
+        reverted = _revert_data(trans)
+        if data is None:
+            data = reverted
+        else:
+            for content_type in ("rpms", "groups", "environments"):
+                data.setdefault(content_type, []).extend(
+                    reverted.get(content_type, [])
+                )
+    if data is None:
+        return None
+    data["rpms"] = _coalesce_rpms(data.get("rpms", []))
+
     replay = dnf.transaction_sr.TransactionReplay(
         base,
         data=data,
@@ -139,8 +273,33 @@ def _revert_transaction(trans, base, skip_unavailable):
     return replay
 
 
+def _locked(method):
+    """Serialize dnf access with the prefetch thread."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def _checkSignature(root, path):
+    """Check package signature, run within worker processes."""
+    ts = dnf.rpm.transaction.initReadOnlyTransaction(root)
+    try:
+        return dnf.rpm.miscutils.checkSig(ts, path)
+    finally:
+        del ts
+
+
 class MiniDNF():
 
+    EXPIRE_ALWAYS = 'always'
+    EXPIRE_AGE = 'age'
+    EXPIRE_CHECKSUM = 'checksum'
+    EXPIRE_NEVER = 'never'
+
+    BUNDLE_REPO = 'otopi-bundle'
+
     class _MyHandler(logging.Handler):
         def __init__(self, sink):
             logging.Handler.__init__(self)
@@ -207,6 +366,24 @@ class MiniDNF():
                 )
             )
 
+    class _PrefetchProgress(dnf.callback.DownloadProgress):
+
+        def __init__(self, sink, cancel):
+            super(MiniDNF._PrefetchProgress, self).__init__()
+            self._sink = sink
+            self._cancel = cancel
+
+        def progress(self, payload, done):
+            super(MiniDNF._PrefetchProgress, self).progress(payload, done)
+            if self._cancel.is_set():
+                raise RuntimeError(_('Package prefetch cancelled'))
+
+        def end(self, payload, status, msg):
+            super(MiniDNF._PrefetchProgress, self).end(payload, status, msg)
+            self._sink.verbose(
+                f'Prefetched {payload} status: {status} message: {msg}'
+            )
+
     class _MyTransactionDisplay(dnf.yum.rpmtrans.TransactionDisplay):
 
         _ACTION_TRANSLATION = {
@@ -246,6 +423,20 @@ class MiniDNF():
             self._sink = sink
             self._lastaction = None
             self._lastpackage = None
+            self._laststart = None
+
+        def finish(self):
+            """Report the package being processed, if any."""
+            if self._lastpackage and self._laststart is not None:
+                self._sink.packageProcessed(
+                    str(self._lastpackage),
+                    self._ACTION_TRANSLATION.get(
+                        self._lastaction,
+                        _('Unknown'),
+                    ),
+                    time.monotonic() - self._laststart,
+                )
+            self._laststart = None
 
         def event(
             self,
@@ -265,6 +456,8 @@ class MiniDNF():
                 ts_total,
             )
             if self._lastaction != action or package != self._lastpackage:
+                self.finish()
+                self._laststart = time.monotonic()
                 self._lastaction = action
                 self._lastpackage = package
 
@@ -350,6 +543,40 @@ class MiniDNF():
         def __init__(self):
             super(MiniDNF._VoidSink, self).__init__()
 
+    class _ThreadSink(object):
+        """Sink proxy delivering events of other threads on the owner.
+
+        Events of other threads are queued, and delivered on the next
+        event of the owner thread or flush().
+
+        """
+
+        def __init__(self, sink):
+            self._sink = sink
+            self._owner = threading.current_thread()
+            self._queue = queue.Queue()
+
+        def flush(self):
+            if threading.current_thread() is self._owner:
+                while True:
+                    try:
+                        name, args, kwargs = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    getattr(self._sink, name)(*args, **kwargs)
+
+        def __getattr__(self, name):
+            attr = getattr(self._sink, name)
+            if not callable(attr):
+                return attr
+
+            def _call(*args, **kwargs):
+                if threading.current_thread() is self._owner:
+                    self.flush()
+                    return attr(*args, **kwargs)
+                self._queue.put((name, args, kwargs))
+            return _call
+
     @classmethod
     def _getPackageName(clz, po):
         return f'{po.name}-{po.version}-{po.release}.{po.arch}'
@@ -368,7 +595,27 @@ class MiniDNF():
             info[f] = getattr(po, f)
         return info
 
-    def _createBase(self, offline=False):
+    @contextlib.contextmanager
+    def _phase(self, phase):
+        details = {}
+        self._sink.phaseStart(phase)
+        start = time.monotonic()
+        try:
+            yield details
+        except Exception:
+            details['failed'] = True
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            if 'bytes' in details and elapsed > 0:
+                details['rate'] = details['bytes'] / elapsed
+            self._sink.phaseEnd(phase, elapsed, details)
+
+    def _createBase(self, offline=False, expire=False):
+        with self._phase(self._sink.PHASE_BASE):
+            return self._newBase(offline=offline, expire=expire)
+
+    def _newBase(self, offline=False, expire=False):
         base = dnf.Base()
 
         # This avoid DNF trying to remove packages that were not touched by
@@ -382,6 +629,19 @@ class MiniDNF():
         base.conf.best = True
 
         base.conf.read(priority=dnf.conf.PRIO_MAINCONFIG)
+
+        # Repositories and cache are of the host, history and rpmdb
+        # are of the installroot.
+        if self._installRoot is not None:
+            releasever = base.conf.releasever
+            base.conf.installroot = self._installRoot
+            base.conf.prepend_installroot('persistdir')
+            base.conf.releasever = dnf.rpm.detect_releasever(
+                self._installRoot
+            ) or releasever
+        if self._cacheDir is not None:
+            base.conf.cachedir = self._cacheDir
+
         base.conf.substitutions.update_from_etc(
             base.conf.installroot,
             varsdir=base.conf.varsdir,
@@ -396,6 +656,8 @@ class MiniDNF():
 
         base.pre_configure_plugins()
         base.read_all_repos()
+        if self._bundleDir is not None:
+            self._addBundle(base)
         base.configure_plugins()
         base.repos.all().set_progress_bar(self._MyDownloadProgress(self._sink))
 
@@ -403,24 +665,264 @@ class MiniDNF():
         # if offline:
         #     base.repos.all().md_only_cached = True
 
-        base.fill_sack()
+        if expire:
+            self._expire(base)
+
+        self._fillSack(base)
         base.read_comps()
 
         return base
 
+    def _addBundle(self, base):
+        """Add bundle as a local repository.
+
+        The bundle is preferred over other repositories, which are
+        disabled if bundle only, otherwise only their cached metadata
+        is used, as dnf --cacheonly does, and they are skipped if not
+        cached.
+
+        """
+        for repo in base.repos.iter_enabled():
+            if self._bundleOnly:
+                repo.disable()
+            else:
+                repo._repo.setSyncStrategy(dnf.repo.SYNC_ONLY_CACHE)
+                repo.skip_if_unavailable = True
+        base.repos.add_new_repo(
+            self.BUNDLE_REPO,
+            base.conf,
+            baseurl=['file://%s' % os.path.abspath(self._bundleDir)],
+            priority=1,
+            cost=0,
+            metadata_expire=-1,
+            skip_if_unavailable=False,
+        )
+
+    @contextlib.contextmanager
+    def _cacheLock(self, base, build):
+        """Lock shared cache.
+
+        A shared cache is used by several processes, so it is locked the
+        same way dnf locks it.
+
+        """
+        if self._cacheDir is None:
+            yield
+        else:
+            with build(base.conf.cachedir, False):
+                yield
+
+    def _fillSack(self, base):
+        start = time.monotonic()
+        with self._phase(self._sink.PHASE_SACK) as details, self._cacheLock(
+            base,
+            dnf.lock.build_metadata_lock,
+        ):
+            base.fill_sack()
+            details['repositories'] = len(list(base.repos.iter_enabled()))
+        elapsed = time.monotonic() - start
+        self._metadataLoadTime += elapsed
+        self._sink.verbose(
+            f'Metadata loaded in {elapsed:.2f} seconds, '
+            f'total {self._metadataLoadTime:.2f} seconds'
+        )
+
+    def _repomdChanged(self, base, repo):
+        """Check if repomd.xml of repository changed.
+
+        Only repomd.xml is downloaded, using librepo with the
+        repository configuration, as dnf does.
+
+        Returns True if it changed or cannot be checked.
+
+        """
+        cached = os.path.join(
+            repo._repo.getCachedir(),
+            'repodata',
+            'repomd.xml',
+        )
+        if not os.path.exists(cached):
+            return True
+        destdir = tempfile.mkdtemp(prefix='otopi-repomd')
+        try:
+            h = librepo.Handle()
+            h.repotype = librepo.LR_YUMREPO
+            h.yumdlist = []
+            h.destdir = destdir
+            h.varsub = list(base.conf.substitutions.items())
+            if repo.metalink:
+                h.metalinkurl = repo.metalink
+            elif repo.mirrorlist:
+                h.mirrorlisturl = repo.mirrorlist
+            h.urls = list(repo.baseurl)
+            if repo.proxy:
+                h.proxy = repo.proxy
+                if repo.proxy_username:
+                    h.proxyuserpwd = '%s:%s' % (
+                        repo.proxy_username,
+                        repo.proxy_password,
+                    )
+            if repo.username:
+                h.userpwd = '%s:%s' % (repo.username, repo.password)
+            h.sslverifypeer = h.sslverifyhost = repo.sslverify
+            if repo.sslcacert:
+                h.sslcacert = repo.sslcacert
+            if repo.sslclientcert:
+                h.sslclientcert = repo.sslclientcert
+            if repo.sslclientkey:
+                h.sslclientkey = repo.sslclientkey
+            h.connecttimeout = repo.timeout
+            h.lowspeedtime = repo.timeout
+            h.perform()
+            digests = []
+            for path in (
+                cached,
+                os.path.join(destdir, 'repodata', 'repomd.xml'),
+            ):
+                with open(path, 'rb') as f:
+                    digests.append(hashlib.sha256(f.read()).hexdigest())
+            return digests[0] != digests[1]
+        except Exception as e:
+            self._sink.verbose(
+                f'Cannot compare repomd.xml of repository {repo.id}: {e}'
+            )
+            return True
+        finally:
+            shutil.rmtree(destdir, ignore_errors=True)
+
+    def _expire(self, base):
+        """Apply expire policy to repositories.
+
+        When applied before the sack is filled, metadata is loaded once.
+
+        Returns the repositories that should be checked for new metadata.
+
+        """
+        expired = []
+        for repo in base.repos.iter_enabled():
+            if (
+                self._bundleDir is not None and
+                repo.id != self.BUNDLE_REPO
+            ):
+                # used from cache only, see _addBundle()
+                continue
+            if self._expirePolicy == self.EXPIRE_ALWAYS or (
+                self._expirePolicy == self.EXPIRE_CHECKSUM and
+                self._repomdChanged(base, repo)
+            ):
+                repo.metadata_expire = 0
+                expired.append(repo.id)
+            elif self._expirePolicy == self.EXPIRE_AGE:
+                if repo.metadata_expire != self._expireAge:
+                    repo.metadata_expire = self._expireAge
+                    expired.append(repo.id)
+            else:
+                # never, or checksum of cached metadata is current
+                repo.metadata_expire = -1
+        self._sink.verbose(
+            f'Expire policy {self._expirePolicy}, '
+            f'expired repositories: {expired}'
+        )
+        return expired
+
     def _destroyBase(self, base):
         if base is not None:
             base._plugins._unload()
             base.close()
 
+    def _getBase(self):
+        """Get the managed base.
+
+        The base is created once, and its repositories, sack and comps
+        are reused. After a transaction modified the system the sack is
+        rebuilt, installed packages are loaded from rpmdb and available
+        packages from the cached repository metadata.
+
+        """
+        if self._managedBase is None:
+            self._managedBase = self._createBase(expire=self._expirePending)
+            self._managedBaseStale = False
+            self._expirePending = False
+            self._groups = None
+            self._groupsQuery = None
+        elif self._managedBaseStale:
+            self._waitSackUsers()
+            self._sink.verbose(_('Reloading package sack'))
+            self._managedBase.reset(sack=True, goal=True)
+            self._fillSack(self._managedBase)
+            self._managedBaseStale = False
+            # installed groups may have changed, comps did not
+            self._groupsQuery = None
+        return self._managedBase
+
+    def _waitSackUsers(self):
+        """Wait until the sack is not used outside the lock.
+
+        Must be called while dnf access is locked.
+
+        """
+        while self._sackUsers:
+            self._sackIdle.wait()
+
+    def _releaseBase(self):
+        """Destroy the managed base."""
+        self._waitSackUsers()
+        if self._managedBase is not None:
+            self._destroyBase(self._managedBase)
+            self._managedBase = None
+            self._groups = None
+            self._groupsQuery = None
+
+    def _packageIndex(self, packages):
+        """Index packages by name using a single sack query.
+
+        Patterns that are not plain package names, e.g. globs, versions
+        or provides, are missing from the index. Source packages are
+        excluded and modular filtering applies, as dnf does.
+
+        Returns:
+        Tuple of dictionary of name to query, and query of packages
+        obsoleting any of the indexed packages, None if obsoletes are
+        disabled.
+
+        """
+        index = {}
+        obsoleters = None
+        names = [p for p in packages if not dnf.util.is_glob_pattern(p)]
+        if names:
+            candidates = self._base.sack.query().filterm(
+                name=names,
+                arch__neq=['src', 'nosrc'],
+            ).apply()
+            for name in set(po.name for po in candidates):
+                index[name] = candidates.filter(name=name)
+            if self._base.conf.obsoletes:
+                obsoleters = self._base.sack.query().filterm(
+                    obsoletes=candidates,
+                ).apply()
+        return index, obsoleters
+
     def _queuePackages(
         self,
         action,
         call,
         packages,
         ignoreErrors=False,
+        queue=None,
     ):
         ret = True
+        packages = list(packages)
+
+        index = {}
+        obsoleters = None
+        # other policies install each architecture, leave it to dnf
+        if queue is not None and self._base.conf.multilib_policy == 'best':
+            try:
+                index, obsoleters = self._packageIndex(packages)
+            except dnf.exceptions.Error as e:
+                self._sink.verbose(
+                    f'Bulk package query failed, queueing one by one: {e}'
+                )
 
         for package in packages:
             try:
@@ -430,7 +932,10 @@ class MiniDNF():
                         action=action,
                     )
                 )
-                call(package)
+                if package in index:
+                    queue(package, index[package], obsoleters, call)
+                else:
+                    call(package)
             except dnf.exceptions.Error as e:
                 ret = False
                 msg = _("Cannot queue package '{package}': {error}").format(
@@ -453,6 +958,64 @@ class MiniDNF():
 
         return ret
 
+    def _selector(self, query):
+        sltr = dnf.selector.Selector(self._base.sack)
+        sltr.set(pkg=query)
+        return sltr
+
+    #
+    # The _queue* functions do what the dnf.Base functions do for a
+    # plain package name and multilib_policy best, with the queries
+    # resolved once for all packages by _packageIndex(). dnf has no
+    # public interface to queue a selector, so the goal is used as
+    # dnf.Base does.
+    #
+
+    def _queueInstall(self, package, query, obsoleters, call):
+        for po in query.installed():
+            self._sink.info(
+                _('Package {package} is already installed').format(
+                    package=po,
+                )
+            )
+        if obsoleters is not None:
+            query = query.union(obsoleters.filter(obsoletes=query))
+        self._base._goal.install(select=self._selector(query))
+
+    def _upgrade(self, query, obsoleters):
+        installed = query.installed()
+        if obsoleters is not None:
+            # only obsoletes of installed packages and their upgrades
+            query = query.union(
+                obsoleters.available().filterm(
+                    obsoletes=installed.union(query.upgrades())
+                )
+            )
+        self._base._goal.upgrade(
+            select=self._selector(query.union(installed.latest()))
+        )
+
+    def _queueUpgrade(self, package, query, obsoleters, call):
+        if not query.installed():
+            # let dnf report it, or upgrade installed obsoleted packages
+            call(package)
+        else:
+            self._upgrade(query, obsoleters)
+
+    def _queueInstallUpdate(self, package, query, obsoleters, call):
+        self._queueInstall(package, query, obsoleters, call)
+        if query.installed():
+            self._upgrade(query, obsoleters)
+
+    def _queueRemove(self, package, query, obsoleters, call):
+        installed = query.installed()
+        if not installed:
+            # let dnf report it
+            call(package)
+        else:
+            for po in installed:
+                self._base.package_remove(po)
+
     def _queueGroup(
         self,
         action,
@@ -467,14 +1030,17 @@ class MiniDNF():
                     action=action,
                 )
             )
-            groups = [g for g in self._base.comps.groups if g.id == group]
-            if not groups:
+            if self._groups is None:
+                self._groups = dict(
+                    (g.id, g) for g in self._base.comps.groups
+                )
+            if group not in self._groups:
                 raise dnf.exceptions.Error(
                     _('Group {group} cannot be resolved').format(
                         group=group,
                     )
                 )
-            call(groups[0].id)
+            call(group)
             return True
         except dnf.exceptions.Error as e:
             msg = _("Cannot queue group '{group}': {error}").format(
@@ -500,9 +1066,36 @@ class MiniDNF():
         self,
         sink=None,
         disabledPlugins=None,
+        installRoot=None,
+        cacheDir=None,
+        bundleDir=None,
+        bundleOnly=False,
     ):
+        """Constructor.
+
+        Keyword arguments:
+        sink -- sink for events.
+        disabledPlugins -- dnf plugins to disable.
+        installRoot -- root to install into, None for the host.
+        cacheDir -- cache directory, may be shared by several processes,
+            None for dnf default.
+        bundleDir -- bundle created by exportBundle() to use as a local
+            repository.
+        bundleOnly -- use only the bundle, for hosts without access to
+            repositories.
+
+        """
         self._base = None
         self._baseTransaction = None
+        self._managedBase = None
+        self._managedBaseStale = False
+        self._groups = None
+        self._groupsQuery = None
+        self._prefetches = []
+        self._expirePolicy = self.EXPIRE_ALWAYS
+        self._expireAge = None
+        self._expirePending = False
+        self._metadataLoadTime = 0.0
 
         if not packager.ok_to_use_dnf():
             raise RuntimeError('minidnf is disabled')
@@ -510,14 +1103,23 @@ class MiniDNF():
         if int(dnf.__version__.split('.')[0]) not in (2, 3, 4):
             raise RuntimeError(_('Incompatible DNF'))
 
-        self._sink = sink if sink else self._VoidSink()
+        self._sink = self._ThreadSink(sink if sink else self._VoidSink())
+        self._lock = threading.RLock()
+        self._sackIdle = threading.Condition(self._lock)
+        self._sackUsers = 0
         self._disabledPlugins = disabledPlugins if disabledPlugins else []
+        self._installRoot = installRoot
+        self._cacheDir = cacheDir
+        self._bundleDir = bundleDir
+        self._bundleOnly = bundleOnly
 
         self._handler = self._MyHandler(self._sink)
 
     def __del__(self):
+        self.cancelPrefetch()
         if self._base is not None:
             self.endTransaction(rollback=True)
+        self._releaseBase()
 
     def selinux_role(self):
         """Setup proper selinux role.
@@ -587,6 +1189,42 @@ class MiniDNF():
                 os.execv(sys.executable, [sys.executable] + sys.argv)
                 os._exit(1)
 
+    @property
+    def metadataLoadTime(self):
+        """Total seconds spent loading metadata."""
+        return self._metadataLoadTime
+
+    def setExpirePolicy(self, policy, age=None):
+        """Set metadata expire policy used by clean('expire-cache').
+
+        Keyword arguments:
+        policy -- EXPIRE_ALWAYS to always expire, EXPIRE_AGE to expire
+            metadata older than age seconds, EXPIRE_CHECKSUM to expire
+            repositories whose repomd.xml changed, EXPIRE_NEVER to use
+            cached metadata.
+        age -- maximum metadata age in seconds for EXPIRE_AGE.
+
+        """
+        if policy not in (
+            self.EXPIRE_ALWAYS,
+            self.EXPIRE_AGE,
+            self.EXPIRE_CHECKSUM,
+            self.EXPIRE_NEVER,
+        ):
+            raise RuntimeError(
+                _('Invalid metadata expire policy {policy}').format(
+                    policy=policy,
+                )
+            )
+        if policy == self.EXPIRE_AGE and age is None:
+            raise RuntimeError(
+                _('Metadata expire policy {policy} requires age').format(
+                    policy=policy,
+                )
+            )
+        self._expirePolicy = policy
+        self._expireAge = age
+
     def transaction(self, rollback=True):
         """Manage transaction.
 
@@ -596,6 +1234,7 @@ class MiniDNF():
         """
         return self._MyTransaction(self, rollback=rollback)
 
+    @_locked
     def clean(self, what):
         try:
             self._sink.verbose(
@@ -603,28 +1242,143 @@ class MiniDNF():
                     what=what,
                 )
             )
-            if 'expire-cache' in what or 'all' in what:
-                for repo in self._base.repos.iter_enabled():
-                    repo.metadata_expire = 0
+            if self._bundleDir is not None:
+                self._sink.verbose('Using bundle, not expiring cache')
+            elif 'expire-cache' in what or 'all' in what:
+                if self._managedBase is None:
+                    # applied before the first sack load
+                    self._expirePending = True
+                elif self._expire(self._managedBase):
+                    # metadata is checked again on next sack load
+                    self._managedBaseStale = True
         except Exception as e:
             self._sink.error(e)
             raise
 
+    def _prefetch(self, packages, cancel):
+        """Resolve packages on the managed sack and download them.
+
+        Only resolving locks dnf access, downloading runs along with the
+        main thread. The sack is kept until downloading is done.
+
+        """
+        with self._lock:
+            if cancel.is_set():
+                return
+            base = self._getBase()
+            goal = hawkey.Goal(base.sack)
+            for package in packages:
+                query = dnf.subject.Subject(package).get_best_query(
+                    base.sack,
+                ).filterm(arch__neq=['src', 'nosrc'])
+                if not query:
+                    self._sink.verbose(f'Cannot prefetch package {package}')
+                    continue
+                sltr = dnf.selector.Selector(base.sack)
+                sltr.set(pkg=query)
+                goal.install(select=sltr, optional=True)
+            if not goal.run(allow_uninstall=True):
+                self._sink.verbose(
+                    f'Cannot resolve prefetch packages: {goal.problems}'
+                )
+                return
+            pos = (
+                goal.list_installs() +
+                goal.list_upgrades() +
+                goal.list_downgrades() +
+                goal.list_reinstalls()
+            )
+            self._sackUsers += 1
+
+        try:
+            if not cancel.is_set():
+                with self._cacheLock(base, dnf.lock.build_download_lock):
+                    base.download_packages(
+                        pos,
+                        progress=self._PrefetchProgress(self._sink, cancel),
+                    )
+        finally:
+            with self._lock:
+                self._sackUsers -= 1
+                self._sackIdle.notify_all()
+
+    def _prefetchThread(self, packages, cancel):
+        try:
+            self._prefetch(packages, cancel)
+        except Exception as e:
+            self._sink.verbose(f'Package prefetch failed: {e}')
+            self._sink.verbose(traceback.format_exc())
+
+    def prefetch(self, packages):
+        """Download packages into the cache in the background.
+
+        Packages and their dependencies are resolved using the sack of
+        the managed base, and downloaded into the cache. Nothing is
+        queued in the current transaction, processing a transaction
+        waits for pending prefetches and then uses the cached packages.
+
+        Failures are ignored, the transaction downloads what is missing.
+
+        """
+        packages = list(packages)
+        self._sink.verbose(f'Prefetching packages: {packages}')
+        cancel = threading.Event()
+        t = threading.Thread(
+            target=self._prefetchThread,
+            args=(packages, cancel),
+            name='otopi-dnf-prefetch',
+        )
+        t.daemon = True
+        t.start()
+        self._prefetches.append((t, cancel))
+
+    def waitPrefetch(self):
+        """Wait for pending prefetches.
+
+        Must not be called while dnf access is locked.
+
+        """
+        while self._prefetches:
+            t, cancel = self._prefetches.pop(0)
+            if t.is_alive():
+                self._sink.verbose(_('Waiting for package prefetch'))
+                t.join()
+        self._sink.flush()
+
+    def cancelPrefetch(self):
+        """Cancel pending prefetches and wait for them to stop.
+
+        Must not be called while dnf access is locked.
+
+        """
+        if self._prefetches:
+            self._sink.verbose(_('Cancelling package prefetch'))
+            for t, cancel in self._prefetches:
+                cancel.set()
+            self.waitPrefetch()
+
+    @_locked
     def beginTransaction(self):
         try:
             logging.getLogger('dnf').addHandler(self._handler)
             self._sink.verbose(_('Creating transaction'))
-            self._base = self._createBase()
+            self._base = self._getBase()
+            self._base.reset(goal=True)
             lastTrans = self._base.history.last()
             self._baseTransaction = lastTrans.tid if lastTrans else 0
         except Exception as e:
-            if self._base is not None:
-                self._base.close()
-                self._base = None
+            self._base = None
+            self._releaseBase()
             self._sink.error(e)
             raise
 
     def endTransaction(self, rollback=False):
+        if rollback:
+            self.cancelPrefetch()
+        self._endTransaction(rollback=rollback)
+
+    @_locked
+    def _endTransaction(self, rollback):
         try:
             if self._base is None or self._baseTransaction is None:
                 raise RuntimeError(_('Illegal transaction state'))
@@ -640,45 +1394,62 @@ class MiniDNF():
             )
             currentTransaction = currTrans.tid if currTrans else 0
 
-            self._destroyBase(self._base)
+            self._base.reset(goal=True)
             self._base = None
 
             if rollback:
                 self._sink.info(_('Performing DNF transaction rollback'))
-                base = self._createBase(offline=True)
-                try:
-                    if self._baseTransaction < currentTransaction:
-                        for id_ in range(
-                            self._baseTransaction + 1,
-                            currentTransaction + 1,
-                        ):
-                            self._sink.verbose(f'Reverting transaction {id_}')
-                            _revert_transaction(
-                                trans=base.history.old([id_])[0],
+                with self._phase(self._sink.PHASE_ROLLBACK) as details:
+                    details['transactions'] = max(
+                        0,
+                        currentTransaction - self._baseTransaction,
+                    )
+                    if self._managedBase is not None:
+                        # metadata was loaded by this run, reload the
+                        # sack from cache without checking repositories
+                        for repo in self._managedBase.repos.iter_enabled():
+                            repo.metadata_expire = -1
+                    base = self._getBase()
+                    try:
+                        if self._baseTransaction < currentTransaction:
+                            ids = list(
+                                range(
+                                    self._baseTransaction + 1,
+                                    currentTransaction + 1,
+                                )
+                            )
+                            self._sink.verbose(f'Reverting transactions {ids}')
+                            _revert_transactions(
+                                transactions=base.history.old(ids),
                                 base=base,
                                 skip_unavailable=True,
                             )
-                        base.resolve(allow_erasing=True)
-                        self._processTransaction(base=base)
-                finally:
-                    self._destroyBase(base)
-                    base = None
+                            base.resolve(allow_erasing=True)
+                            details['cached'] = len([
+                                po for po in base.transaction.install_set
+                                if os.path.exists(po.localPkg())
+                            ])
+                            self._processTransaction(base=base)
+                    finally:
+                        base.reset(goal=True)
         except Exception as e:
+            self._releaseBase()
             self._sink.error(e)
             raise
         finally:
-            if self._base is not None:
-                self._destroyBase(self._base)
-                self._base = None
+            self._base = None
             self._baseTransaction = None
             handlers = logging.getLogger('dnf').handlers
             while self._handler in handlers:
                 handlers.remove(self._handler)
 
+    @_locked
     def buildTransaction(self):
         try:
             self._sink.verbose(_('Building transaction'))
-            ret = self._base.resolve(allow_erasing=True)
+            with self._phase(self._sink.PHASE_RESOLVE) as details:
+                ret = self._base.resolve(allow_erasing=True)
+                details['packages'] = len(self._base.transaction or ())
             self._sink.verbose(_('Transaction built'))
             if not ret:
                 self._sink.verbose(_('Empty transaction'))
@@ -700,34 +1471,162 @@ class MiniDNF():
             self._sink.error(e)
             raise
 
-    def _processTransaction(self, base=None):
+    def _checkSignatures(self, base):
+        """Check package signatures in parallel.
+
+        Returns:
+        Set of packages with a good signature. Other packages are
+        checked again by dnf, so key import and errors are handled
+        on the main thread as usual.
+
+        """
+        pos = [
+            po for po in base.transaction.install_set
+            if po.localPkg()
+        ]
+        if len(pos) < 2:
+            return set()
+
         try:
-            base.download_packages(
-                base.transaction.install_set,
-                progress=self._MyDownloadProgress(self._sink),
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=min(len(pos), os.cpu_count() or 1),
+            ) as executor:
+                results = list(
+                    executor.map(
+                        _checkSignature,
+                        [base.conf.installroot] * len(pos),
+                        [po.localPkg() for po in pos],
+                        chunksize=max(1, len(pos) // 32),
+                    )
+                )
+        except Exception as e:
+            self._sink.verbose(
+                f'Parallel signature check failed, checking serially: {e}'
             )
-            for po in base.transaction.install_set:
-                result, errmsg = base.package_signature_check(po)
-                if result == 0:
-                    pass
-                elif result == 1:
-                    def _askGPG(d):
-                        return self._sink.askForGPGKeyImport(
-                            d['userid'],
-                            d['hexkeyid'],
-                        )
-                    base.package_import_key(po, fullaskcb=_askGPG)
-                else:
-                    raise RuntimeError(errmsg)
+            return set()
 
-            base.do_transaction(display=self._MyTransactionDisplay(self._sink))
+        return set(
+            po for po, result in zip(pos, results)
+            if result == 0
+        )
+
+    def _processTransaction(self, base=None):
+        try:
+            # rpmdb is modified from this point
+            self._managedBaseStale = True
+            # installed groups change, also for the open transaction
+            self._groupsQuery = None
+            with self._phase(self._sink.PHASE_DOWNLOAD) as details:
+                # packages in the cache or local repositories are not
+                # downloaded
+                download = [
+                    po for po in base.transaction.install_set
+                    if not os.path.exists(po.localPkg())
+                ]
+                details['files'] = len(download)
+                details['cached'] = (
+                    len(base.transaction.install_set) - len(download)
+                )
+                details['bytes'] = sum(po.downloadsize or 0 for po in download)
+                with self._cacheLock(base, dnf.lock.build_download_lock):
+                    base.download_packages(
+                        base.transaction.install_set,
+                        progress=self._MyDownloadProgress(self._sink),
+                    )
+            with self._phase(self._sink.PHASE_SIGNATURE) as details:
+                verified = self._checkSignatures(base)
+                details['packages'] = len(base.transaction.install_set)
+                details['parallel'] = len(verified)
+                for po in base.transaction.install_set:
+                    if po in verified:
+                        continue
+                    result, errmsg = base.package_signature_check(po)
+                    if result == 0:
+                        pass
+                    elif result == 1:
+                        def _askGPG(d):
+                            return self._sink.askForGPGKeyImport(
+                                d['userid'],
+                                d['hexkeyid'],
+                            )
+                        base.package_import_key(po, fullaskcb=_askGPG)
+                    else:
+                        raise RuntimeError(errmsg)
+
+            with self._phase(self._sink.PHASE_TRANSACTION) as details:
+                display = self._MyTransactionDisplay(self._sink)
+                try:
+                    base.do_transaction(display=display)
+                finally:
+                    display.finish()
+                details['packages'] = len(base.transaction)
         except Exception as e:
             self._sink.error(e)
             raise
 
     def processTransaction(self):
-        self._processTransaction(base=self._base)
+        self.waitPrefetch()
+        with self._lock:
+            self._processTransaction(base=self._base)
+
+    @_locked
+    def exportBundle(self, directory, createrepo='createrepo_c'):
+        """Export packages of built transaction into a bundle.
+
+        Packages are downloaded and copied into directory, and
+        repository metadata of the directory is updated, so the bundle
+        can be used by other hosts as a local repository.
 
+        Only the install set of this host's transaction is exported,
+        packages already installed here are not, so the bundle is
+        complete only for hosts installed the same way as this one.
+
+        Keyword arguments:
+        directory -- bundle directory, created if missing.
+        createrepo -- createrepo_c command.
+
+        """
+        try:
+            # prefetch may be downloading the same packages
+            self._waitSackUsers()
+            pos = list(self._base.transaction.install_set)
+            self._sink.info(
+                _('Exporting {count} packages into {directory}').format(
+                    count=len(pos),
+                    directory=directory,
+                )
+            )
+            with self._cacheLock(self._base, dnf.lock.build_download_lock):
+                self._base.download_packages(
+                    pos,
+                    progress=self._MyDownloadProgress(self._sink),
+                )
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            for po in pos:
+                shutil.copy2(
+                    po.localPkg(),
+                    os.path.join(directory, os.path.basename(po.localPkg())),
+                )
+            self._sink.verbose(
+                subprocess.check_output(
+                    [createrepo, '--update', directory],
+                    stderr=subprocess.STDOUT,
+                    universal_newlines=True,
+                )
+            )
+        except subprocess.CalledProcessError as e:
+            self._sink.error(e.output)
+            raise RuntimeError(
+                _('Cannot create bundle repository {directory}').format(
+                    directory=directory,
+                )
+            )
+        except Exception as e:
+            self._sink.error(e)
+            raise
+
+    @_locked
     def queryTransaction(self):
         ret = []
         for op, set_ in (
@@ -744,6 +1643,7 @@ class MiniDNF():
         self._sink.verbose(f'queryTransaction ret: {ret}')
         return ret
 
+    @_locked
     def installGroup(self, group, **kwargs):
         return self._queueGroup(
             _('install'),
@@ -755,6 +1655,15 @@ class MiniDNF():
             **kwargs
         )
 
+    @_locked
+    def installGroups(self, groups, ignoreErrors=False):
+        ret = True
+        for group in groups:
+            if not self.installGroup(group, ignoreErrors=ignoreErrors):
+                ret = False
+        return ret
+
+    @_locked
     def removeGroup(self, group, **kwargs):
         return self._queueGroup(
             _('remove'),
@@ -763,6 +1672,7 @@ class MiniDNF():
             **kwargs
         )
 
+    @_locked
     def updateGroup(self, group, **kwargs):
         return self._queueGroup(
             _('update'),
@@ -771,14 +1681,17 @@ class MiniDNF():
             **kwargs
         )
 
+    @_locked
     def install(self, packages, **kwargs):
         return self._queuePackages(
             _('install'),
             self._base.install,
             packages,
+            queue=self._queueInstall,
             **kwargs
         )
 
+    @_locked
     def installUpdate(self, packages, **kwargs):
         def _installUpdate(p):
             self._base.install(p)
@@ -792,25 +1705,31 @@ class MiniDNF():
             _('install/update'),
             _installUpdate,
             packages,
+            queue=self._queueInstallUpdate,
             **kwargs
         )
 
+    @_locked
     def remove(self, packages, **kwargs):
         return self._queuePackages(
             _('erase'),
             self._base.remove,
             packages,
+            queue=self._queueRemove,
             **kwargs
         )
 
+    @_locked
     def update(self, packages, **kwargs):
         return self._queuePackages(
             _('update'),
             self._base.upgrade,
             packages,
+            queue=self._queueUpgrade,
             **kwargs
         )
 
+    @_locked
     def queryPackages(self, patterns=None, showdups=False):
         try:
             ret = []
@@ -819,39 +1738,31 @@ class MiniDNF():
             available = []
             reinstall_available = []
 
-            if self._base is None:
-                base = _base = self._createBase()
-            else:
-                base = self._base
-                _base = None
+            base = self._base if self._base is not None else self._getBase()
 
-            try:
-                for pattern in patterns:
-                    q = dnf.subject.Subject(pattern).get_best_query(
-                        base.sack,
-                        with_provides=True,
-                    )
+            for pattern in patterns:
+                q = dnf.subject.Subject(pattern).get_best_query(
+                    base.sack,
+                    with_provides=True,
+                )
+
+                # more or less copy from dnf
+                dinst = {}
+                ndinst = {}  # Newest versions by name.arch
+                for po in q.installed():
+                    dinst[po.pkgtup] = po
+                    if showdups:
+                        continue
+                    key = (po.name, po.arch)
+                    if key not in ndinst or po > ndinst[key]:
+                        ndinst[key] = po
+                installed = dinst.values()
 
-                    # more or less copy from dnf
-                    dinst = {}
-                    ndinst = {}  # Newest versions by name.arch
-                    for po in q.installed():
-                        dinst[po.pkgtup] = po
-                        if showdups:
-                            continue
-                        key = (po.name, po.arch)
-                        if key not in ndinst or po > ndinst[key]:
-                            ndinst[key] = po
-                    installed = dinst.values()
-
-                    for pkg in (q if showdups else q.latest()):
-                        available.append(pkg)
-
-                    for pkg in (q.available() if showdups else q.latest()):
-                        reinstall_available.append(pkg)
-            finally:
-                if _base is not None:
-                    self._destroyBase(_base)
+                for pkg in (q if showdups else q.latest()):
+                    available.append(pkg)
+
+                for pkg in (q.available() if showdups else q.latest()):
+                    reinstall_available.append(pkg)
 
             for op, l in (
                 ('available', available),
@@ -873,39 +1784,31 @@ class MiniDNF():
             self._sink.error(e)
             raise
 
+    @_locked
     def queryGroups(self):
-        if self._base is None:
-            base = _base = self._createBase()
-        else:
-            base = self._base
-            _base = None
+        base = self._base if self._base is not None else self._getBase()
 
         try:
-            return [
-                {
-                    'operation': 'installed'
-                    if base.history.group.get(group.id) is not None
-                    else 'available',
-                    'name': group.id,
-                    'description': group.name,
-                    'uservisible': group.visible
-                }
-                for group in base.comps.groups_iter()
-            ]
+            if self._groupsQuery is None:
+                self._groupsQuery = [
+                    {
+                        'operation': 'installed'
+                        if base.history.group.get(group.id) is not None
+                        else 'available',
+                        'name': group.id,
+                        'description': group.name,
+                        'uservisible': group.visible
+                    }
+                    for group in base.comps.groups_iter()
+                ]
+            return [dict(g) for g in self._groupsQuery]
         except Exception as e:
             self._sink.error(e)
             raise
-        finally:
-            if _base is not None:
-                self._destroyBase(_base)
 
+    @_locked
     def getConf(self):
-        we_created_base = False
-        if self._base is None:
-            base = self._createBase()
-            we_created_base = True
-        else:
-            base = self._base
+        base = self._base if self._base is not None else self._getBase()
 
         try:
             return 'DNF Conf dump:\n{conf}\n{repos}'.format(
@@ -918,10 +1821,8 @@ class MiniDNF():
         except Exception as e:
             self._sink.error(e)
             raise
-        finally:
-            if we_created_base and base is not None:
-                self._destroyBase(base)
 
+    @_locked
     def checkForSafeUpdate(self, packages):
         missingRollback = []
         upgradeAvailable = False
@@ -933,29 +1834,34 @@ class MiniDNF():
             if self.buildTransaction():
                 upgradeAvailable = True
 
-                for p in self.queryTransaction():
+                transaction = self.queryTransaction()
+                for p in transaction:
                     plist.append((p['display_name'], p['operation']))
 
-                # Verify all installed packages available in repos
-                for package in self.queryTransaction():
-                    installed = False
-                    reinstall_available = False
-                    for query in self.queryPackages(
-                        patterns=(package['display_name'],),
-                        showdups=True,
-                    ):
-                        self._sink.verbose(
-                            'dupes: operation [%s] package %s' % (
-                                query['operation'],
-                                query['display_name'],
-                            )
+                # Verify all installed packages available in repos,
+                # using a single query over all transaction packages
+                installed = set()
+                available = set()
+                for po in self._base.sack.query().filterm(
+                    name=list(set(p['name'] for p in transaction)),
+                ):
+                    name = self._getPackageName(po)
+                    if po.reponame == hawkey.SYSTEM_REPO_NAME:
+                        installed.add(name)
+                    else:
+                        available.add(name)
+
+                for package in transaction:
+                    name = package['display_name']
+                    self._sink.verbose(
+                        'dupes: package %s installed [%s] available [%s]' % (
+                            name,
+                            name in installed,
+                            name in available,
                         )
-                        if query['operation'] == 'installed':
-                            installed = True
-                        if query['operation'] == 'reinstall_available':
-                            reinstall_available = True
-                    if installed and not reinstall_available:
-                        missingRollback.append(package['display_name'])
+                    )
+                    if name in installed and name not in available:
+                        missingRollback.append(name)
         return {
             'upgradeAvailable': upgradeAvailable,
             'missingRollback': set(missingRollback),
@@ -6,6 +6,8 @@
 """Minimalist yum API interaction."""
 
 
+import contextlib
+import fnmatch
 import gettext
 import logging
 import os
@@ -31,6 +33,14 @@ def _(m):
 class MiniYumSinkBase(object):
     """Sink base."""
 
+    PHASE_BASE = 'base'
+    PHASE_SACK = 'sack'
+    PHASE_RESOLVE = 'resolve'
+    PHASE_DOWNLOAD = 'download'
+    PHASE_SIGNATURE = 'signature'
+    PHASE_TRANSACTION = 'transaction'
+    PHASE_ROLLBACK = 'rollback'
+
     @property
     def failed(self):
         return self._failed
@@ -90,6 +100,38 @@ class MiniYumSinkBase(object):
         """Last chance before reexec."""
         pass
 
+    def phaseStart(self, phase):
+        """Phase started.
+
+        Keyword arguments:
+        phase -- phase name, one of PHASE_*.
+
+        """
+        pass
+
+    def phaseEnd(self, phase, elapsed, details):
+        """Phase ended.
+
+        Keyword arguments:
+        phase -- phase name, one of PHASE_*.
+        elapsed -- elapsed seconds.
+        details -- dictionary of phase metrics, for example files,
+            bytes and rate of download, failed if phase failed.
+
+        """
+        pass
+
+    def packageProcessed(self, package, action, elapsed):
+        """Package processed within rpm transaction.
+
+        Keyword arguments:
+        package -- package name.
+        action -- action performed.
+        elapsed -- elapsed seconds.
+
+        """
+        pass
+
 
 class MiniYum(object):
     """Minimalist yum API interaction."""
@@ -343,6 +385,19 @@ class MiniYum(object):
                 ),
             )
 
+    @contextlib.contextmanager
+    def _phase(self, phase):
+        details = {}
+        self._sink.phaseStart(phase)
+        start = time.time()
+        try:
+            yield details
+        except Exception:
+            details['failed'] = True
+            raise
+        finally:
+            self._sink.phaseEnd(phase, time.time() - start, details)
+
     @classmethod
     def _get_package_name(clz, po):
         return '%s%s-%s-%s.%s' % (
@@ -426,22 +481,34 @@ class MiniYum(object):
 
         return ret
 
-    def _queryProvides(self, packages, showdups=None):
+    def _searchProvides(self, packages):
+        """Search provides of all packages in a single pass.
+
+        Returns:
+        Dictionary of package object to matched strings.
+
+        """
+        arches = list(self._yb.arch.legit_multi_arches) + ['noarch']
+        return dict(
+            (po, matched)
+            for po, matched in self._yb.searchPackageProvides(
+                args=packages,
+            ).items()
+            if po.arch in arches
+        )
+
+    def _selectProvides(self, pos, showdups=None):
         database = {}
         ret = []
 
-        for po in self._yb.searchPackageProvides(args=packages):
-            if po.arch in (
-                list(self._yb.arch.legit_multi_arches) +
-                ['noarch']
-            ):
-                database.setdefault(
-                    '%s%s' % (
-                        po.epoch,
-                        po.name,
-                    ),
-                    [],
-                ).append(po)
+        for po in pos:
+            database.setdefault(
+                '%s%s' % (
+                    po.epoch,
+                    po.name,
+                ),
+                [],
+            ).append(po)
 
         if showdups:
             ret = sum(database.values(), [])
@@ -475,6 +542,55 @@ class MiniYum(object):
 
         return ret
 
+    def _queryProvides(self, packages, showdups=None):
+        return self._selectProvides(
+            pos=self._searchProvides(packages=packages),
+            showdups=showdups,
+        )
+
+    @staticmethod
+    def _providesMatch(package, po, matched):
+        if package == po.name or fnmatch.fnmatch(po.name, package):
+            return True
+        for m in matched:
+            if isinstance(m, tuple):
+                m = m[0]
+            if m == package:
+                return True
+        return False
+
+    def _provideIndex(self, packages):
+        """Resolve provides of all packages at once.
+
+        searchPackageProvides() and doPackageLists() are each called
+        once for all packages, instead of once per package.
+
+        Returns:
+        Tuple of dictionary of package to selected package objects,
+        and the package list holder of all selected package objects.
+        Packages not resolved by the bulk query are missing.
+
+        """
+        matches = self._searchProvides(packages=packages)
+        provides = {}
+        for package in packages:
+            pos = [
+                po for po, matched in matches.items()
+                if self._providesMatch(package, po, matched)
+            ]
+            if pos:
+                provides[package] = self._selectProvides(pos=pos)
+
+        patterns = set()
+        for pos in provides.values():
+            patterns.update(self._get_package_name(po) for po in pos)
+
+        holder = None
+        if patterns:
+            holder = self._yb.doPackageLists(patterns=sorted(patterns))
+
+        return provides, holder
+
     def _queue(
         self,
         action,
@@ -484,28 +600,58 @@ class MiniYum(object):
         ignoreErrors=False,
     ):
         ret = True
+        packages = list(packages)
 
         with self._disableOutput:
+            try:
+                provides, holder = self._provideIndex(packages=packages)
+            except yum.Errors.YumBaseError as e:
+                self._sink.verbose(
+                    'bulk package query failed, queueing one by one: %s' % e
+                )
+                provides, holder = {}, None
+            listed = {}
+            if holder is not None:
+                for po in getpackages(holder):
+                    listed.setdefault(self._get_package_name(po), []).append(
+                        po
+                    )
+
             for package in packages:
                 try:
                     self._sink.verbose(
                         'queue package %s for %s' % (package, action)
                     )
 
-                    provides = self._queryProvides(packages=(package,))
+                    if package in provides:
+                        pos = sum(
+                            [
+                                listed.get(self._get_package_name(p), [])
+                                for p in provides[package]
+                            ],
+                            [],
+                        )
+                    else:
+                        # not matched by bulk query, resolve on its own
+                        resolved = self._queryProvides(packages=(package,))
+
+                        if not resolved:
+                            raise RuntimeError(
+                                _('Package {package} cannot be found').format(
+                                    package=package,
+                                )
+                            )
 
-                    if not provides:
-                        raise RuntimeError(
-                            _('Package {package} cannot be found').format(
-                                package=package,
+                        pos = getpackages(
+                            self._yb.doPackageLists(
+                                patterns=[
+                                    self._get_package_name(p)
+                                    for p in resolved
+                                ],
                             )
                         )
 
-                    holder = self._yb.doPackageLists(
-                        patterns=[self._get_package_name(p) for p in provides],
-                    )
-
-                    for po in getpackages(holder):
+                    for po in pos:
                         self._sink.verbose(
                             'processing package %s for %s' % (po, action)
                         )
@@ -804,6 +950,19 @@ class MiniYum(object):
             **kwargs
         )
 
+    def installGroups(self, groups, ignoreErrors=False):
+        """Install groups.
+
+        groups -- group names
+        ignoreErrors - to ignore errors, will return False
+
+        """
+        ret = True
+        for group in groups:
+            if not self.installGroup(group, ignoreErrors=ignoreErrors):
+                ret = False
+        return ret
+
     def updateGroup(self, group, **kwargs):
         """Update group.
 
@@ -910,7 +1069,9 @@ class MiniYum(object):
             with self._disableOutput:
                 ret = False
                 self._sink.verbose('Building transaction')
-                rc, msg = self._yb.buildTransaction()
+                with self._phase(self._sink.PHASE_RESOLVE) as details:
+                    rc, msg = self._yb.buildTransaction()
+                    details['packages'] = len(self._yb.tsInfo)
                 if rc == 0:
                     self._sink.verbose('Empty transaction')
                 elif rc == 2:
@@ -1034,11 +1195,13 @@ class MiniYum(object):
         try:
             with self._disableOutput:
                 self._sink.verbose('Processing transaction')
-                self._yb.processTransaction(
-                    callback=self._YumListener(sink=self._sink),
-                    rpmTestDisplay=self._RPMCallback(sink=self._sink),
-                    rpmDisplay=self._RPMCallback(sink=self._sink)
-                )
+                with self._phase(self._sink.PHASE_TRANSACTION) as details:
+                    details['packages'] = len(self._yb.tsInfo)
+                    self._yb.processTransaction(
+                        callback=self._YumListener(sink=self._sink),
+                        rpmTestDisplay=self._RPMCallback(sink=self._sink),
+                        rpmDisplay=self._RPMCallback(sink=self._sink)
+                    )
                 self._sink.verbose('Transaction processed')
 
         except Exception as e:
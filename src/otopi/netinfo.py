@@ -0,0 +1,293 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""Network information without external commands.
+
+Interface addresses are read using netlink, or /proc/net/if_inet6 and
+SIOCGIFCONF. Name resolution runs concurrently with a timeout, results
+are cached.
+
+"""
+
+
+import array
+import contextlib
+import fcntl
+import gettext
+import os
+import socket
+import struct
+import threading
+import time
+
+
+from . import base
+from . import util
+
+
+def _(m):
+    return gettext.dgettext(message=m, domain='otopi')
+
+
+# linux/netlink.h, linux/rtnetlink.h, linux/if_addr.h
+_NETLINK_ROUTE = 0
+_NLMSG_ERROR = 2
+_NLMSG_DONE = 3
+_NLM_F_REQUEST = 0x1
+_NLM_F_DUMP = 0x300
+_RTM_NEWADDR = 20
+_RTM_GETADDR = 22
+_IFA_ADDRESS = 1
+_IFA_LOCAL = 2
+_NLMSGHDR = '=LHHLL'
+_IFADDRMSG = '=BBBBL'
+_RTATTR = '=HH'
+
+# linux/sockios.h
+_SIOCGIFCONF = 0x8912
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _netlinkAddresses():
+    with contextlib.closing(
+        socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_ROUTE)
+    ) as s:
+        s.bind((0, 0))
+        s.send(
+            struct.pack(
+                _NLMSGHDR,
+                struct.calcsize(_NLMSGHDR) + struct.calcsize(_IFADDRMSG),
+                _RTM_GETADDR,
+                _NLM_F_REQUEST | _NLM_F_DUMP,
+                1,
+                0,
+            ) +
+            struct.pack(_IFADDRMSG, socket.AF_UNSPEC, 0, 0, 0, 0)
+        )
+        addresses = []
+        while True:
+            data = s.recv(65536)
+            offset = 0
+            while offset + struct.calcsize(_NLMSGHDR) <= len(data):
+                length, msgtype, flags, seq, pid = struct.unpack_from(
+                    _NLMSGHDR,
+                    data,
+                    offset,
+                )
+                if length < struct.calcsize(_NLMSGHDR):
+                    raise OSError(_('Invalid netlink message'))
+                if msgtype == _NLMSG_DONE:
+                    return addresses
+                if msgtype == _NLMSG_ERROR:
+                    error = -struct.unpack_from(
+                        '=i',
+                        data,
+                        offset + struct.calcsize(_NLMSGHDR),
+                    )[0]
+                    raise OSError(error, os.strerror(error))
+                if msgtype == _RTM_NEWADDR:
+                    family = struct.unpack_from(
+                        _IFADDRMSG,
+                        data,
+                        offset + struct.calcsize(_NLMSGHDR),
+                    )[0]
+                    attrs = {}
+                    attr = (
+                        offset +
+                        struct.calcsize(_NLMSGHDR) +
+                        struct.calcsize(_IFADDRMSG)
+                    )
+                    while attr + struct.calcsize(_RTATTR) <= offset + length:
+                        attrlen, attrtype = struct.unpack_from(
+                            _RTATTR,
+                            data,
+                            attr,
+                        )
+                        if attrlen < struct.calcsize(_RTATTR):
+                            break
+                        attrs[attrtype] = data[
+                            attr + struct.calcsize(_RTATTR):attr + attrlen
+                        ]
+                        attr += _align(attrlen)
+                    # local is the address of point to point interfaces
+                    address = attrs.get(_IFA_LOCAL, attrs.get(_IFA_ADDRESS))
+                    if address is not None:
+                        addresses.append(socket.inet_ntop(family, address))
+                offset += _align(length)
+
+
+def _procAddresses():
+    addresses = []
+    if os.path.exists('/proc/net/if_inet6'):
+        with open('/proc/net/if_inet6', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if fields:
+                    addresses.append(
+                        socket.inet_ntop(
+                            socket.AF_INET6,
+                            bytes.fromhex(fields[0]),
+                        )
+                    )
+
+    # struct ifreq is name and a union padded to the largest member
+    ifreqSize = 40 if struct.calcsize('P') == 8 else 32
+    buf = array.array('B', b'\0' * ifreqSize * 128)
+    with contextlib.closing(
+        socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    ) as s:
+        length = struct.unpack(
+            'iL',
+            fcntl.ioctl(
+                s.fileno(),
+                _SIOCGIFCONF,
+                struct.pack('iL', len(buf), buf.buffer_info()[0]),
+            ),
+        )[0]
+    data = buf.tobytes()
+    for offset in range(0, length, ifreqSize):
+        addresses.append(socket.inet_ntoa(data[offset + 20:offset + 24]))
+    return addresses
+
+
+@util.export
+def interfaceAddresses():
+    """Addresses of all interfaces, including loopback.
+
+    Raises OSError if addresses cannot be enumerated.
+
+    """
+    try:
+        return _netlinkAddresses()
+    except OSError:
+        return _procAddresses()
+
+
+@util.export
+class Resolver(base.Base):
+    """Concurrent name resolution with timeout and cache.
+
+    Lookups run in daemon threads, a lookup that did not finish within
+    the timeout keeps running and is cached once done.
+
+    """
+
+    def __init__(self, timeout=5):
+        """Constructor.
+
+        Keyword arguments:
+        timeout -- seconds to wait for lookups.
+
+        """
+        super(Resolver, self).__init__()
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._pending = {}
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+
+    @staticmethod
+    def _forward(name):
+        ret = []
+        for __, __, __, __, address in socket.getaddrinfo(name, None):
+            if address[0] not in ret:
+                ret.append(address[0])
+        return ret
+
+    @staticmethod
+    def _reverse(address):
+        name, aliases, __ = socket.gethostbyaddr(address)
+        return [name] + aliases
+
+    def _run(self, key, function, argument, event):
+        result = []
+        try:
+            result = function(argument)
+        except Exception as e:
+            self.logger.debug('lookup %s failed: %s', key, e)
+        finally:
+            with self._lock:
+                self._cache[key] = result
+                del self._pending[key]
+            event.set()
+
+    def _start(self, key, function, argument):
+        with self._lock:
+            if key in self._cache:
+                return None
+            event = self._pending.get(key)
+            if event is None:
+                event = self._pending[key] = threading.Event()
+                t = threading.Thread(
+                    target=self._run,
+                    args=(key, function, argument, event),
+                    name='resolve-%s-%s' % key,
+                )
+                t.daemon = True
+                t.start()
+            return event
+
+    def resolve(self, names=(), addresses=()):
+        """Resolve names and addresses concurrently.
+
+        Keyword arguments:
+        names -- names to resolve into addresses.
+        addresses -- addresses to resolve into names.
+
+        Returns:
+        Tuple of dictionaries of name to addresses and of address to
+        names. Failed lookups have an empty list, lookups that did not
+        finish within the timeout have None.
+
+        """
+        keys = (
+            [('forward', name) for name in names] +
+            [('reverse', address) for address in addresses]
+        )
+        events = [
+            self._start(
+                key,
+                self._forward if key[0] == 'forward' else self._reverse,
+                key[1],
+            )
+            for key in keys
+        ]
+        deadline = time.monotonic() + self._timeout
+        for event in events:
+            if event is not None:
+                event.wait(max(0, deadline - time.monotonic()))
+        with self._lock:
+            results = dict((key, self._cache.get(key)) for key in keys)
+        return (
+            dict(
+                (key[1], result) for key, result in results.items()
+                if key[0] == 'forward'
+            ),
+            dict(
+                (key[1], result) for key, result in results.items()
+                if key[0] == 'reverse'
+            ),
+        )
+
+    def forward(self, names):
+        """Resolve names, see resolve()."""
+        return self.resolve(names=names)[0]
+
+    def reverse(self, addresses):
+        """Resolve addresses, see resolve()."""
+        return self.resolve(addresses=addresses)[1]
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
@@ -86,6 +86,23 @@ class PackagerBase(object):
         """
         raise NotImplementedError(_('Packager installGroup not implemented'))
 
+    def installGroups(self, groups, ignoreErrors=False):
+        """Install groups.
+
+        Keyword arguments:
+        groups -- groups tuple to install.
+        ignoreErrors -- Do not raise exception packaging exception.
+
+        Returns:
+        True -- success.
+
+        """
+        ret = True
+        for group in groups:
+            if not self.installGroup(group=group, ignoreErrors=ignoreErrors):
+                ret = False
+        return ret
+
     def updateGroup(self, group, ignoreErrors=False):
         """Update a group.
 
@@ -177,6 +194,20 @@ class PackagerBase(object):
         """
         raise NotImplementedError(_('Packager remove not implemented'))
 
+    def prefetch(self, packages):
+        """Prefetch packages.
+
+        Keyword arguments:
+        packages -- packages tuple to prefetch.
+
+        Notes:
+        Packages are only downloaded, the transaction is not affected.
+        Prefetch support is optional, there should be no
+        exception if not supported.
+
+        """
+        pass
+
     def queryGroups(self):
         """Query groups.
 
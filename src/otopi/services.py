@@ -10,9 +10,154 @@ Services is the component responsible of intraction with system services.
 """
 
 
+import ctypes
+import errno
+import os
+import select
+import socket
+import time
+
+
 from . import util
 
 
+@util.export
+class Probe(object):
+    """Base class for service readiness probes."""
+
+    def check(self, services, name):
+        """Checks if service is ready"""
+        return False
+
+    def ready(self, services, names):
+        """Checks if services are ready
+
+        Returns the set of ready names.
+
+        """
+        return set(name for name in names if self.check(services, name))
+
+    def fileno(self):
+        """File descriptor readable when probing again is worthwhile
+
+        None if the probe can only be polled.
+
+        """
+        return None
+
+    def close(self):
+        """Release resources"""
+        pass
+
+
+@util.export
+class ActiveProbe(Probe):
+    """Service is ready when active, as reported by the provider."""
+
+    def ready(self, services, names):
+        return set(
+            name for name, active in services.activeMany(names).items()
+            if active
+        )
+
+
+@util.export
+class TCPProbe(Probe):
+    """Service is ready when accepting TCP connections."""
+
+    def __init__(self, port, host='localhost', timeout=1):
+        self._port = port
+        self._host = host
+        self._timeout = timeout
+
+    def check(self, services, name):
+        try:
+            socket.create_connection(
+                (self._host, self._port),
+                self._timeout,
+            ).close()
+            return True
+        except (socket.error, socket.timeout):
+            return False
+
+
+@util.export
+class UnixSocketProbe(Probe):
+    """Service is ready when accepting connections on a UNIX socket."""
+
+    def __init__(self, path, timeout=1):
+        self._path = path
+        self._timeout = timeout
+
+    def check(self, services, name):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.settimeout(self._timeout)
+            s.connect(self._path)
+            return True
+        except (socket.error, socket.timeout):
+            return False
+        finally:
+            s.close()
+
+
+@util.export
+class FileProbe(Probe):
+    """Service is ready when a file, such as a pid file, exists.
+
+    The directory is watched using inotify(7) if available, so
+    waiting ends as soon as the file is created.
+
+    """
+
+    # sys/inotify.h
+    _IN_ATTRIB = 0x00000004
+    _IN_MOVED_TO = 0x00000080
+    _IN_CREATE = 0x00000100
+
+    def __init__(self, path):
+        self._path = path
+        self._fd = None
+
+    def fileno(self):
+        if self._fd is None:
+            self._fd = -1
+            try:
+                libc = ctypes.CDLL(None, use_errno=True)
+                fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+                if fd >= 0:
+                    if libc.inotify_add_watch(
+                        fd,
+                        os.fsencode(
+                            os.path.dirname(os.path.abspath(self._path))
+                        ),
+                        self._IN_CREATE | self._IN_MOVED_TO | self._IN_ATTRIB,
+                    ) < 0:
+                        os.close(fd)
+                    else:
+                        self._fd = fd
+            except AttributeError:
+                # no inotify in libc, poll
+                pass
+        return self._fd if self._fd >= 0 else None
+
+    def check(self, services, name):
+        if self._fd is not None and self._fd >= 0:
+            # drain events, the file is checked anyway
+            try:
+                while os.read(self._fd, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        return os.path.exists(self._path)
+
+    def close(self):
+        if self._fd is not None and self._fd >= 0:
+            os.close(self._fd)
+        self._fd = None
+
+
 @util.export
 class ServicesBase(object):
     """Base class for services.
@@ -21,6 +166,9 @@ class ServicesBase(object):
 
     """
 
+    READY_MIN_DELAY = 0.05
+    READY_MAX_DELAY = 2.0
+
     @property
     def supportsDependency(self):
         """True if provider supports service dependency."""
@@ -46,6 +194,100 @@ class ServicesBase(object):
         """Sets service state"""
         pass
 
+    def existsMany(self, names):
+        """Checks if services exist
+
+        Returns a dictionary of name to result.
+
+        """
+        return dict((name, self.exists(name)) for name in names)
+
+    def statusMany(self, names):
+        """Checks status of services
+
+        Returns a dictionary of name to result.
+
+        """
+        return dict((name, self.status(name)) for name in names)
+
+    def startupMany(self, names, state):
+        """Sets services state after reboot"""
+        for name in names:
+            self.startup(name, state)
+
+    def stateMany(self, names, state):
+        """Sets services state"""
+        for name in names:
+            self.state(name, state)
+
+    def activeMany(self, names):
+        """Checks current status of services, bypassing any cache
+
+        Returns a dictionary of name to result.
+
+        """
+        return self.statusMany(names)
+
+    def waitReady(self, names, timeout=60, probe=None):
+        """Waits until services are ready
+
+        Services are probed together, the delay between probes grows
+        while none of them gets ready. Probes providing a file
+        descriptor end the delay early when it is readable.
+
+        Keyword arguments:
+        names -- service names.
+        timeout -- maximum seconds to wait.
+        probe -- Probe, or dictionary of name to Probe, default is
+            ActiveProbe. Probes are closed when done.
+
+        Returns a dictionary of name to True if ready.
+
+        """
+        names = list(names)
+        if probe is None:
+            probe = ActiveProbe()
+        if isinstance(probe, dict):
+            probes = probe
+        else:
+            probes = dict((name, probe) for name in names)
+        deadline = time.time() + timeout
+        delay = self.READY_MIN_DELAY
+        pending = set(names)
+        try:
+            while True:
+                groups = {}
+                for name in pending:
+                    groups.setdefault(
+                        id(probes[name]),
+                        (probes[name], []),
+                    )[1].append(name)
+                ready = set()
+                for p, group in groups.values():
+                    ready |= p.ready(self, group)
+                pending -= ready
+
+                remaining = deadline - time.time()
+                if not pending or remaining <= 0:
+                    break
+                if ready:
+                    delay = self.READY_MIN_DELAY
+                fds = [
+                    fd for fd in (
+                        p.fileno() for p, group in groups.values()
+                    )
+                    if fd is not None
+                ]
+                if fds:
+                    select.select(fds, [], [], min(delay, remaining))
+                else:
+                    time.sleep(min(delay, remaining))
+                delay = min(delay * 2, self.READY_MAX_DELAY)
+        finally:
+            for p in set(probes.values()):
+                p.close()
+        return dict((name, name not in pending) for name in names)
+
     def restart(self, name):
         """Restart service"""
         if self.exists(name):
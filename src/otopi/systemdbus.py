@@ -0,0 +1,185 @@
+#
+# otopi -- plugable installer
+#
+
+
+"""Minimalist systemd D-Bus API interaction."""
+
+
+import gettext
+
+# Users of systemdbus should import it inside a try/except clause and
+# handle failures gracefully, dbus-python and PyGObject are optional.
+import dbus
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+
+from . import base
+from . import util
+
+
+def _(m):
+    return gettext.dgettext(message=m, domain='otopi')
+
+
+# errors of broken connection, rather than of the request
+DISCONNECTED = (
+    'org.freedesktop.DBus.Error.Disconnected',
+    'org.freedesktop.DBus.Error.NoReply',
+    'org.freedesktop.DBus.Error.ServiceUnknown',
+)
+
+
+@util.export
+class SystemdBus(base.Base):
+    """systemd manager over a persistent D-Bus connection.
+
+    Jobs of several units are queued together, and completion is
+    tracked by JobRemoved signals.
+
+    """
+
+    SERVICE = 'org.freedesktop.systemd1'
+    PATH = '/org/freedesktop/systemd1'
+    MANAGER = 'org.freedesktop.systemd1.Manager'
+    UNIT = 'org.freedesktop.systemd1.Unit'
+    PROPERTIES = 'org.freedesktop.DBus.Properties'
+
+    JOB_TIMEOUT = 600
+
+    def __init__(self, bus=None):
+        """Constructor.
+
+        Keyword arguments:
+        bus -- bus to use, default is the system bus.
+
+        """
+        super(SystemdBus, self).__init__()
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        self._bus = bus if bus is not None else dbus.SystemBus()
+        self._manager = dbus.Interface(
+            self._bus.get_object(self.SERVICE, self.PATH),
+            self.MANAGER,
+        )
+        self._pending = set()
+        self._jobs = {}
+        self._loop = None
+        self._timeoutSource = None
+        self._bus.add_signal_receiver(
+            self._jobRemoved,
+            signal_name='JobRemoved',
+            dbus_interface=self.MANAGER,
+            bus_name=self.SERVICE,
+            path=self.PATH,
+        )
+        self._manager.Subscribe()
+
+    def _done(self):
+        return all(job in self._jobs for job in self._pending)
+
+    def _jobRemoved(self, jobid, job, unit, result):
+        if str(job) in self._pending:
+            self._jobs[str(job)] = str(result)
+            if self._loop is not None and self._done():
+                self._loop.quit()
+
+    def _timeout(self):
+        self._timeoutSource = None
+        self._loop.quit()
+        return False
+
+    def _wait(self, jobs):
+        """Wait for jobs.
+
+        The main loop runs until JobRemoved was received for all jobs,
+        or until timeout.
+
+        Returns dictionary of job to result.
+
+        """
+        self._pending.update(jobs)
+        self._loop = GLib.MainLoop()
+        self._timeoutSource = GLib.timeout_add_seconds(
+            self.JOB_TIMEOUT,
+            self._timeout,
+        )
+        try:
+            # dispatch signals received while queueing, as quit() before
+            # run() is lost
+            context = GLib.MainContext.default()
+            while not self._done() and context.iteration(False):
+                pass
+            if not self._done():
+                self._loop.run()
+            if not self._done():
+                raise RuntimeError(_('Timeout waiting for systemd jobs'))
+            return dict((job, self._jobs.pop(job)) for job in jobs)
+        finally:
+            if self._timeoutSource is not None:
+                GLib.source_remove(self._timeoutSource)
+                self._timeoutSource = None
+            self._loop = None
+            self._pending.difference_update(jobs)
+
+    def _unitProperty(self, name, prop):
+        unit = self._bus.get_object(self.SERVICE, self._manager.LoadUnit(name))
+        return str(
+            dbus.Interface(unit, self.PROPERTIES).Get(self.UNIT, prop)
+        )
+
+    def properties(self, names, props=('Id', 'LoadState', 'ActiveState')):
+        """Get unit properties.
+
+        Returns dictionary of unit name to dictionary of properties.
+
+        """
+        return dict(
+            (
+                name,
+                dict((p, self._unitProperty(name, p)) for p in props),
+            )
+            for name in names
+        )
+
+    def jobs(self, method, names):
+        """Queue a job per unit and wait for all of them.
+
+        Keyword arguments:
+        method -- StartUnit, StopUnit or RestartUnit.
+        names -- unit names.
+
+        Returns dictionary of unit name to job result, 'done' on success.
+
+        """
+        queued = dict(
+            (name, str(getattr(self._manager, method)(name, 'replace')))
+            for name in names
+        )
+        results = self._wait(list(queued.values()))
+        return dict((name, results[job]) for name, job in queued.items())
+
+    def enable(self, names, state):
+        """Enable or disable unit files and reload the manager.
+
+        Units generated from SysV init scripts have no unit file, they
+        are left to systemctl, which runs systemd-sysv-install.
+
+        Returns list of names of units that were not handled.
+
+        """
+        sysv = [
+            name for name in names
+            if self._unitProperty(name, 'SourcePath')
+        ]
+        native = [name for name in names if name not in sysv]
+        if native:
+            if state:
+                self._manager.EnableUnitFiles(native, False, False)
+            else:
+                self._manager.DisableUnitFiles(native, False)
+            self._manager.Reload()
+        return sysv
+
+
+# vim: expandtab tabstop=4 shiftwidth=4
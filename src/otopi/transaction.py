@@ -21,6 +21,8 @@ def _(m):
 class TransactionElement(base.Base):
     """Base for transaction element."""
 
+    _journalFunction = None
+
     def __init__(self):
         """Constructor."""
         super(TransactionElement, self).__init__()
@@ -50,6 +52,41 @@ class TransactionElement(base.Base):
         """Commit transaction element."""
         pass
 
+    def journal(self):
+        """Journal record of prepared element.
+
+        Returns:
+        A dictionary with 'type' and any json serializable information
+        required by the recovery function registered for the type at
+        journal.Journal.registerRecovery(), None if element cannot be
+        recovered.
+
+        The record is taken before prepare(), at journalUpdate() calls,
+        and after prepare(), so it should reflect the current state.
+
+        """
+        return None
+
+    def setJournalFunction(self, function):
+        """Set function recording journal records.
+
+        Keyword arguments:
+        function -- function(record), None to disable.
+
+        """
+        self._journalFunction = function
+
+    def journalUpdate(self):
+        """Record current journal record synced to disk.
+
+        Called by prepare() before changing anything visible.
+
+        """
+        if self._journalFunction is not None:
+            record = self.journal()
+            if record is not None:
+                self._journalFunction(record)
+
 
 @util.export
 class Transaction(base.Base):
@@ -57,9 +94,25 @@ class Transaction(base.Base):
     def _prepare(self, element):
         if not self._failed:
             try:
+                index = len(self._prepared)
                 self._prepared.append(element)
                 self.logger.debug("preparing '%s'", element)
+                if self._journal is not None:
+                    # write-ahead intent
+                    element.setJournalFunction(
+                        lambda record: self._journal.record(
+                            element=index,
+                            record=record,
+                            sync=True,
+                        )
+                    )
+                    element.journalUpdate()
                 element.prepare()
+                if self._journal is not None:
+                    element.setJournalFunction(None)
+                    record = element.journal()
+                    if record is not None:
+                        self._journal.record(element=index, record=record)
             except Exception:
                 self.logger.debug(
                     'exception during prepare phase',
@@ -68,14 +121,17 @@ class Transaction(base.Base):
                 self._failed = True
                 raise
 
-    def __init__(self, elements=()):
+    def __init__(self, elements=(), journal=None):
         """Constructor.
 
         Keyword arguments:
         elements -- transaction elements.
+        journal -- journal.Journal to record prepared elements at, the
+            journal is closed when transaction is committed or aborted.
 
         """
         super(Transaction, self).__init__()
+        self._journal = journal
         self._failed = False
         self._postPrepare = False
         self._elements = []
@@ -83,6 +139,18 @@ class Transaction(base.Base):
         for element in elements:
             self.append(element)
 
+    def _closeJournal(self):
+        if self._journal is not None:
+            try:
+                self._journal.close()
+            except Exception:
+                self.logger.debug(
+                    "Cannot close journal '%s'",
+                    self._journal,
+                    exc_info=True
+                )
+            self._journal = None
+
     def __del__(self):
         """Destructor."""
         self.abort()
@@ -109,12 +177,16 @@ class Transaction(base.Base):
 
         if self._postPrepare:
             self._prepare(element=element)
+            if self._journal is not None:
+                self._journal.sync()
 
     def prepare(self):
         """Prepare transaction elements."""
         self._postPrepare = True
         for element in self._elements:
             self._prepare(element=element)
+        if self._journal is not None:
+            self._journal.sync()
 
     def abort(self):
         """Abort transaction."""
@@ -130,6 +202,7 @@ class Transaction(base.Base):
                     exc_info=True
                 )
         self._prepared = []
+        self._closeJournal()
 
     def commit(self):
         """Commit transaction."""
@@ -144,6 +217,9 @@ class Transaction(base.Base):
                 _('Cannot commit transaction as one of the elements failed')
             )
 
+        if self._journal is not None:
+            self._journal.commit()
+
         # remove elements from list
         # so that if we fail we won't
         # abort committed
@@ -152,6 +228,8 @@ class Transaction(base.Base):
             self.logger.debug("committing '%s'", element)
             element.commit()
 
+        self._closeJournal()
+
     def __enter__(self):
         self.prepare()
         return self
@@ -9,6 +9,7 @@
 import gettext
 
 
+from otopi import common
 from otopi import config
 from otopi import constants
 from otopi import plugin
@@ -39,6 +40,10 @@ class Plugin(plugin.PluginBase):
         self.environment[
             constants.CoreEnv.PACKAGE_VERSION
         ] = config.PACKAGE_VERSION
+        self.environment.setdefault(
+            constants.CoreEnv.TIMING_REPORT,
+            []
+        )
 
         self.context.dumpSequence()
 
@@ -69,10 +74,47 @@ class Plugin(plugin.PluginBase):
         # of something before validation
         self.context.dumpEnvironment()
 
+    @plugin.event(
+        stage=plugin.Stages.STAGE_INTERNAL_PACKAGES,
+        priority=plugin.Stages.PRIORITY_LAST + 10,
+    )
+    def _internal_packages_end(self):
+        # packages may have added users and groups
+        common.clearNSSCache()
+
+    @plugin.event(
+        stage=plugin.Stages.STAGE_PACKAGES,
+        priority=plugin.Stages.PRIORITY_LAST + 10,
+    )
+    def _packages_end(self):
+        # packages may have added users and groups
+        common.clearNSSCache()
+
     @plugin.event(
         stage=plugin.Stages.STAGE_PRE_TERMINATE,
     )
     def _preTerminate(self):
+        totals = {}
+        for entry in self.environment[constants.CoreEnv.TIMING_REPORT]:
+            key = (entry['component'], entry['phase'])
+            count, elapsed = totals.get(key, (0, 0))
+            totals[key] = (
+                count + entry.get('count', 1),
+                elapsed + entry['elapsed'],
+            )
+        if totals:
+            self.logger.debug('Timing report:')
+            for (component, phase), (count, elapsed) in sorted(
+                totals.items()
+            ):
+                self.logger.debug(
+                    '    %-10s %-15s %5d %10.2fs',
+                    component,
+                    phase,
+                    count,
+                    elapsed,
+                )
+
         # as we want full dump and not delta
         # of something before termination
         self.context.dumpEnvironment()
@@ -6,12 +6,22 @@
 """Transaction plugin."""
 
 
+import gettext
+
+
+from otopi import backupstore
 from otopi import constants
+from otopi import filetransaction
+from otopi import journal
 from otopi import plugin
 from otopi import transaction
 from otopi import util
 
 
+def _(m):
+    return gettext.dgettext(message=m, domain='otopi')
+
+
 @util.export
 class Plugin(plugin.PluginBase):
     """Transaction provider.
@@ -22,9 +32,21 @@ class Plugin(plugin.PluginBase):
 
     Listen for error notification and rollback transaction in this case.
 
+    Main transaction is recorded in a journal, interrupted transactions
+    of previous runs are recovered at STAGE_INIT.
+
+    Register backup store for file transactions at STAGE_SETUP and
+    apply its retention policy at STAGE_CLEANUP.
+
     Environment:
         CoreEnv.INTERNAL_PACKAGES_TRANSACTION -- transaction object.
         CoreEnv.MAIN_TRANSACTION -- transaction object.
+        CoreEnv.TRANSACTION_JOURNAL_DIR -- journal directory, None to
+            disable journal.
+        CoreEnv.BACKUP_LEGACY -- backup next to files instead of store.
+        CoreEnv.BACKUP_DIR -- backup store directory.
+        CoreEnv.BACKUP_KEEP -- backups to keep per file, 0 for all.
+        CoreEnv.BACKUP_MAX_BYTES -- backup store size, 0 for unlimited.
 
     Users of this module can acquire transaction object
     out of the environment at CoreEnv.MAIN_TRANSACTION.
@@ -32,6 +54,7 @@ class Plugin(plugin.PluginBase):
     """
     def __init__(self, context):
         super(Plugin, self).__init__(context=context)
+        self._backupStore = None
 
     def _notify(self, event):
         if event == self.context.NOTIFY_ERROR:
@@ -42,13 +65,47 @@ class Plugin(plugin.PluginBase):
                 self._mainTransaction.abort()
                 self._mainTransaction = None
 
+    def _createJournal(self):
+        directory = self.environment[
+            constants.CoreEnv.TRANSACTION_JOURNAL_DIR
+        ]
+        if not directory:
+            return None
+        try:
+            for name in journal.Journal.recover(directory=directory):
+                self.logger.warning(
+                    _(
+                        "Recovered interrupted transaction "
+                        "from '{journal}'"
+                    ).format(
+                        journal=name,
+                    )
+                )
+            return journal.Journal(directory=directory)
+        except OSError:
+            self.logger.debug('Cannot create journal', exc_info=True)
+            self.logger.warning(
+                _(
+                    "Cannot use transaction journal at '{directory}'"
+                ).format(
+                    directory=directory,
+                )
+            )
+            return None
+
     @plugin.event(
         stage=plugin.Stages.STAGE_INIT,
         name=constants.Stages.TRANSACTIONS_INIT,
     )
     def _init(self):
+        self.environment.setdefault(
+            constants.CoreEnv.TRANSACTION_JOURNAL_DIR,
+            constants.Defaults.TRANSACTION_JOURNAL_DIR
+        )
         self._internalPackageTransaction = transaction.Transaction()
-        self._mainTransaction = transaction.Transaction()
+        self._mainTransaction = transaction.Transaction(
+            journal=self._createJournal(),
+        )
         self.environment[
             constants.CoreEnv.INTERNAL_PACKAGES_TRANSACTION
         ] = self._internalPackageTransaction
@@ -58,8 +115,54 @@ class Plugin(plugin.PluginBase):
         self.environment[
             constants.CoreEnv.MODIFIED_FILES
         ] = []
+        self.environment.setdefault(
+            constants.CoreEnv.BACKUP_LEGACY,
+            False
+        )
+        self.environment.setdefault(
+            constants.CoreEnv.BACKUP_DIR,
+            constants.Defaults.BACKUP_DIR
+        )
+        self.environment.setdefault(
+            constants.CoreEnv.BACKUP_KEEP,
+            constants.Defaults.BACKUP_KEEP
+        )
+        self.environment.setdefault(
+            constants.CoreEnv.BACKUP_MAX_BYTES,
+            0
+        )
         self.context.registerNotification(self._notify)
 
+    @plugin.event(
+        stage=plugin.Stages.STAGE_SETUP,
+        priority=plugin.Stages.PRIORITY_LAST,
+        condition=lambda self: not self.environment[
+            constants.CoreEnv.BACKUP_LEGACY
+        ],
+    )
+    def _setup_backup(self):
+        try:
+            self._backupStore = backupstore.BackupStore(
+                directory=self.environment[constants.CoreEnv.BACKUP_DIR],
+                keep=self.environment[constants.CoreEnv.BACKUP_KEEP] or None,
+                maxBytes=self.environment[
+                    constants.CoreEnv.BACKUP_MAX_BYTES
+                ] or None,
+            )
+            filetransaction.FileTransaction.registerBackupStore(
+                self._backupStore
+            )
+        except OSError:
+            self.logger.debug('Cannot create backup store', exc_info=True)
+            self.logger.warning(
+                _(
+                    "Cannot use backup store at '{directory}', "
+                    "backing up files next to them"
+                ).format(
+                    directory=self.environment[constants.CoreEnv.BACKUP_DIR],
+                )
+            )
+
     @plugin.event(
         stage=plugin.Stages.STAGE_INTERNAL_PACKAGES,
         priority=plugin.Stages.PRIORITY_FIRST,
@@ -98,5 +201,16 @@ class Plugin(plugin.PluginBase):
         finally:
             self._mainTransaction = None
 
+    @plugin.event(
+        stage=plugin.Stages.STAGE_CLEANUP,
+        condition=lambda self: self._backupStore is not None,
+    )
+    def _cleanup_backup(self):
+        try:
+            self._backupStore.prune()
+        except Exception:
+            self.logger.debug('Cannot prune backup store', exc_info=True)
+            self.logger.warning(_('Cannot apply backup retention policy'))
+
 
 # vim: expandtab tabstop=4 shiftwidth=4
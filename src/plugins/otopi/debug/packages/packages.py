@@ -54,6 +54,15 @@ class Plugin(plugin.PluginBase):
     def _debug_packages_validation(self):
         action = self.environment[constants.DebugEnv.PACKAGES_ACTION]
         if action in (
+            'install',
+            'update',
+            'installUpdate',
+        ):
+            # downloaded in the background until STAGE_PACKAGES
+            self.packager.prefetch(
+                self.environment[constants.DebugEnv.PACKAGES].split(',')
+            )
+        elif action in (
             'checkForSafeUpdate',
         ):
             # A single param that is a tuple (iterable).
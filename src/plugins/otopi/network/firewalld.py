@@ -8,7 +8,8 @@
 
 import gettext
 import os
-import re
+
+from xml.etree import ElementTree
 
 
 from otopi import constants
@@ -30,6 +31,7 @@ class Plugin(plugin.PluginBase):
         NetEnv.FIREWALLD_ENABLE -- enable firewalld update
         NetEnv.FIREWALLD_SERVICE_PREFIX -- services key=service value=content
         NetEnv.FIREWALLD_DISABLE_SERVICES -- list of services to be disabled
+        NetEnv.FIREWALLD_ZONE_FILES -- write zone files directly
 
     """
 
@@ -46,73 +48,54 @@ class Plugin(plugin.PluginBase):
             pass
 
         def abort(self):
-            for (
-                zone,
-                services,
-            ) in self._parent._disabled_zones_services.items():
-                for service in services:
-                    rc, stdout, stderr = self._parent.execute(
-                        args=(
-                            self._parent.command.get('firewall-cmd'),
-                            '--zone', zone,
-                            '--permanent',
-                            '--add-service', service,
-                        ),
-                        raiseOnError=False,
-                    )
-                    if rc != 0:
-                        self._parent.logger.debug(
-                            'Error during firewalld restore',
-                        )
+            if not self._parent._configure(
+                self._parent._disabled_zones_services,
+                add=True,
+                raiseOnError=False,
+            ):
+                self._parent.logger.debug(
+                    'Error during firewalld restore',
+                )
 
         def commit(self):
             pass
 
     FIREWALLD_SERVICES_DIR = '/etc/firewalld/services'
-    _ZONE_RE = re.compile(
-        flags=re.VERBOSE,
-        pattern=r"""
-            ^
-            (?P<zone>\w+)
-        """
-    )
-    _INTERFACE_RE = re.compile(
-        flags=re.VERBOSE,
-        pattern=r"""
-            \s+
-            interfaces:
-            \s+
-            (?P<interfaces>[\w,]+)
-        """
-    )
-    _SERVICE_RE = re.compile(
-        flags=re.VERBOSE,
-        pattern=r"""
-            \s+
-            services:
-            \s+
-            (?P<services>.+)
-        """
-    )
+    FIREWALLD_ZONES_DIR = '/etc/firewalld/zones'
+    FIREWALLD_DEFAULT_ZONES_DIR = '/usr/lib/firewalld/zones'
+
+    def _get_firewalld_version_string(self):
+        """firewalld version from the package database."""
+        try:
+            import rpm
+            for header in rpm.TransactionSet().dbMatch('name', 'firewalld'):
+                version = header['version']
+                if isinstance(version, bytes):
+                    version = version.decode('utf-8')
+                return version
+        except ImportError:
+            pass
+        try:
+            from firewall import config
+            return config.VERSION
+        except ImportError:
+            pass
+        rc, stdout, stderr = self.execute(
+            (
+                self.command.get('rpm'),
+                '-q',
+                '--queryformat=%{VERSION}',
+                'firewalld',
+            ),
+        )
+        return stdout[0]
 
     def _get_firewalld_cmd_version(self):
         version = 0
 
         if self.services.exists('firewalld'):
             try:
-                try:
-                    from firewall import config
-                    versionOutput = config.VERSION
-                except ImportError:
-                    rc, stdout, stderr = self.execute(
-                        (
-                            self.command.get('python3'),
-                            '-c',
-                            'from firewall import config;'
-                            'print(config.VERSION)',
-                        )
-                    )
-                    versionOutput = stdout[0]
+                versionOutput = self._get_firewalld_version_string()
                 self.logger.debug('firewalld version: %s', versionOutput)
                 version = int(
                     '%02x%02x%02x' % tuple([
@@ -128,64 +111,223 @@ class Plugin(plugin.PluginBase):
                 )
         return version
 
+    def _invalidate(self):
+        self._zones = None
+
+    def _discover(self):
+        """Zones of running firewalld from a single --list-all-zones.
+
+        Cached until invalidated by our own changes.
+
+        Returns a dictionary of zone name to a dictionary of interfaces
+        and services.
+
+        """
+        if self._zones is None:
+            rc, stdout, stderr = self.execute(
+                (
+                    self.command.get('firewall-cmd'),
+                    '--list-all-zones',
+                ),
+            )
+            zones = {}
+            zone = None
+            for line in stdout:
+                if not line.strip():
+                    continue
+                if not line[0].isspace():
+                    zone = zones[line.split()[0]] = {
+                        'interfaces': [],
+                        'services': [],
+                    }
+                elif zone is not None:
+                    key, sep, value = line.strip().partition(':')
+                    if sep and key in zone:
+                        zone[key] = value.split()
+            self._zones = zones
+        return self._zones
+
     def _get_active_zones(self):
-        rc, stdout, stderr = self.execute(
-            (
-                self.command.get('firewall-cmd'),
-                '--get-active-zones',
-            ),
-        )
-        zones = {}
         if self._firewalld_version < 0x000303:
+            # old output format without active marker
+            rc, stdout, stderr = self.execute(
+                (
+                    self.command.get('firewall-cmd'),
+                    '--get-active-zones',
+                ),
+            )
+            zones = {}
             for line in stdout:
                 zone_name, devices = line.split(':')
                 zones[zone_name] = devices.split()
-        else:
-            # 0.3.3 has changed output
-            zone_name = None
-            for line in stdout:
-                zoneMatch = self._ZONE_RE.match(line)
-                if zoneMatch is not None:
-                    zone_name = zoneMatch.group('zone')
-                else:
-                    interfacesMatch = self._INTERFACE_RE.match(line)
-                    if interfacesMatch is not None:
-                        zones[zone_name] = interfacesMatch.group(
-                            'interfaces'
-                        ).split()
+            return zones
 
-        return zones
+        # zones bound to interfaces, as --get-active-zones reports them
+        return dict(
+            (name, zone['interfaces'])
+            for name, zone in self._discover().items()
+            if zone['interfaces']
+        )
 
     def _get_zones(self):
-        rc, stdout, stderr = self.execute(
+        return list(self._discover().keys())
+
+    def _get_zones_services(self):
+        return dict(
+            (name, zone['services'])
+            for name, zone in self._discover().items()
+        )
+
+    def _reload(self):
+        self._invalidate()
+        self.execute(
             (
                 self.command.get('firewall-cmd'),
-                '--get-zones',
-            ),
+                '--reload'
+            )
         )
-        return ' '.join(stdout).split()
 
-    def _get_zones_services(self):
+    def _get_permanent_services(self):
         rc, stdout, stderr = self.execute(
             (
                 self.command.get('firewall-cmd'),
-                '--list-all-zones',
+                '--permanent',
+                '--get-services',
             ),
+            raiseOnError=False,
+        )
+        return ' '.join(stdout).split() if rc == 0 else []
+
+    def _add_new_services(self):
+        """Add newly written services to permanent configuration.
+
+        A running firewalld does not know services written since it was
+        loaded, so they cannot be added to zones. They are added from
+        their files, so that all changes are loaded by a single reload.
+
+        """
+        if not self.services.status('firewalld'):
+            # firewall-offline-cmd reads the service files
+            return
+        known = self._get_permanent_services()
+        for service in self._enabled_services:
+            if service in known:
+                continue
+            if self._firewalld_version < 0x000400:
+                # no --new-service-from-file, load all files
+                self._reload()
+                return
+            self.execute(
+                (
+                    self.command.get('firewall-cmd'),
+                    '--permanent',
+                    '--new-service-from-file=%s' % os.path.join(
+                        self.FIREWALLD_SERVICES_DIR,
+                        '%s.xml' % service,
+                    ),
+                    '--name=%s' % service,
+                ),
+            )
+
+    def _configure(self, zones_services, add, raiseOnError=True):
+        """Add or remove services of zones in permanent configuration.
+
+        All services of a zone are set in a single invocation, using
+        firewall-offline-cmd if firewalld is not running. Reload is
+        left to the caller.
+
+        Returns True if all invocations succeeded.
+
+        """
+        self._invalidate()
+        online = (
+            self.services.status('firewalld') or
+            self.command.get('firewall-offline-cmd', optional=True) is None
+        )
+        ret = True
+        for zone, services in sorted(zones_services.items()):
+            if not services:
+                continue
+            args = [
+                self.command.get(
+                    'firewall-cmd' if online else 'firewall-offline-cmd'
+                ),
+                '--zone', zone,
+            ]
+            if online:
+                args.append('--permanent')
+            for service in services:
+                args.extend(
+                    ('--add-service' if add else '--remove-service', service)
+                )
+            rc, stdout, stderr = self.execute(
+                args=args,
+                raiseOnError=raiseOnError,
+            )
+            ret = ret and rc == 0
+        return ret
+
+    def _get_zone_content(self, zone, add, remove):
+        """Zone file content with services added and removed.
+
+        The zone file is read from the default zones if it was never
+        customized.
+
+        """
+        name = os.path.join(self.FIREWALLD_ZONES_DIR, '%s.xml' % zone)
+        if not os.path.exists(name):
+            name = os.path.join(
+                self.FIREWALLD_DEFAULT_ZONES_DIR,
+                '%s.xml' % zone,
+            )
+        try:
+            parser = ElementTree.XMLParser(
+                target=ElementTree.TreeBuilder(insert_comments=True),
+            )
+        except TypeError:
+            # python < 3.8, comments are dropped
+            parser = None
+        root = ElementTree.parse(name, parser=parser).getroot()
+        if root.tag != 'zone':
+            raise RuntimeError(
+                _("Invalid firewalld zone file '{file}'").format(
+                    file=name,
+                )
+            )
+
+        for i, element in reversed(list(enumerate(root))):
+            if element.tag == 'service' and element.get('name') in remove:
+                # what followed the element now follows the previous one
+                if i:
+                    root[i - 1].tail = element.tail
+                else:
+                    root.text = element.tail
+                root.remove(element)
+        present = [element.get('name') for element in root.findall('service')]
+
+        # keep services together, after short and description
+        index = 0
+        for i, element in enumerate(root):
+            if element.tag in ('short', 'description', 'service'):
+                index = i + 1
+        for service in add:
+            if service not in present:
+                element = ElementTree.Element('service', name=service)
+                if index and index == len(root):
+                    # new last child, the previous one is now inner
+                    element.tail = root[index - 1].tail
+                    root[index - 1].tail = (
+                        root[index - 2].tail if index > 1 else root.text
+                    )
+                else:
+                    element.tail = root[index - 1].tail if index else root.text
+                root.insert(index, element)
+                index += 1
+
+        return '%s\n%s\n' % (
+            '<?xml version="1.0" encoding="utf-8"?>',
+            ElementTree.tostring(root, encoding='unicode'),
         )
-        zones = {}
-        zone_name = None
-        for line in stdout:
-            zoneMatch = self._ZONE_RE.match(line)
-            if zoneMatch is not None:
-                zone_name = zoneMatch.group('zone')
-            else:
-                servicesMatch = self._SERVICE_RE.match(line)
-                if servicesMatch is not None:
-                    zones[zone_name] = servicesMatch.group(
-                        'services'
-                    ).split()
-
-        return zones
 
     def __init__(self, context):
         super(Plugin, self).__init__(context=context)
@@ -193,6 +335,7 @@ class Plugin(plugin.PluginBase):
         self._enabled_services = []
         self._disabled_zones_services = {}
         self._firewalld_version = 0
+        self._zones = None
 
     @plugin.event(
         stage=plugin.Stages.STAGE_INIT,
@@ -210,6 +353,10 @@ class Plugin(plugin.PluginBase):
             constants.NetEnv.FIREWALLD_DISABLE_SERVICES,
             []
         )
+        self.environment.setdefault(
+            constants.NetEnv.FIREWALLD_ZONE_FILES,
+            False
+        )
 
     @plugin.event(
         stage=plugin.Stages.STAGE_SETUP,
@@ -217,7 +364,8 @@ class Plugin(plugin.PluginBase):
     )
     def _setup(self):
         self.command.detect(command='firewall-cmd')
-        self.command.detect(command='python3')
+        self.command.detect(command='firewall-offline-cmd')
+        self.command.detect(command='rpm')
 
     @plugin.event(
         stage=plugin.Stages.STAGE_CUSTOMIZATION,
@@ -245,11 +393,12 @@ class Plugin(plugin.PluginBase):
         condition=lambda self: self._enabled,
     )
     def _early_misc(self):
-        self.environment[constants.CoreEnv.MAIN_TRANSACTION].append(
-            self.FirewalldTransaction(
-                parent=self,
+        if not self.environment[constants.NetEnv.FIREWALLD_ZONE_FILES]:
+            self.environment[constants.CoreEnv.MAIN_TRANSACTION].append(
+                self.FirewalldTransaction(
+                    parent=self,
+                )
             )
-        )
 
         #
         # avoid conflicts, disable iptables
@@ -263,6 +412,7 @@ class Plugin(plugin.PluginBase):
             state=True,
         )
         self.services.startup(name='firewalld', state=True)
+        self._invalidate()
 
         #
         # Disabling existing services before configuration reload
@@ -280,14 +430,8 @@ class Plugin(plugin.PluginBase):
                         zone,
                         []
                     ).append(service)
-                    self.execute(
-                        (
-                            self.command.get('firewall-cmd'),
-                            '--zone', zone,
-                            '--permanent',
-                            '--remove-service', service,
-                        ),
-                    )
+        if not self.environment[constants.NetEnv.FIREWALLD_ZONE_FILES]:
+            self._configure(self._disabled_zones_services, add=False)
 
     @plugin.event(
         stage=plugin.Stages.STAGE_MISC,
@@ -318,37 +462,51 @@ class Plugin(plugin.PluginBase):
                 )
             )
 
+        if self.environment[constants.NetEnv.FIREWALLD_ZONE_FILES]:
+            #
+            # Zone files are restored by the transaction on abort, and
+            # loaded together with the service files by the reload at
+            # closeup.
+            #
+            zones = set(self._disabled_zones_services)
+            if self._enabled_services:
+                zones.update(self._get_active_zones())
+            for zone in sorted(zones):
+                self.environment[constants.CoreEnv.MAIN_TRANSACTION].append(
+                    filetransaction.FileTransaction(
+                        name=os.path.join(
+                            self.FIREWALLD_ZONES_DIR,
+                            '%s.xml' % zone,
+                        ),
+                        content=self._get_zone_content(
+                            zone=zone,
+                            add=self._enabled_services,
+                            remove=self._disabled_zones_services.get(
+                                zone,
+                                [],
+                            ),
+                        ),
+                        modifiedList=self.environment[
+                            constants.CoreEnv.MODIFIED_FILES
+                        ],
+                    )
+                )
+
     @plugin.event(
         stage=plugin.Stages.STAGE_CLOSEUP,
         condition=lambda self: self._enabled,
     )
     def _closeup(self):
-        #
-        # Ensure to load the newly written services if firewalld was already
-        # running.
-        #
-        self.execute(
-            (
-                self.command.get('firewall-cmd'),
-                '--reload'
-            )
-        )
-        for zone in self._get_active_zones():
-            for service in self._enabled_services:
-                self.execute(
-                    (
-                        self.command.get('firewall-cmd'),
-                        '--zone', zone,
-                        '--permanent',
-                        '--add-service', service,
-                    ),
-                )
-        self.execute(
-            (
-                self.command.get('firewall-cmd'),
-                '--reload'
+        if not self.environment[constants.NetEnv.FIREWALLD_ZONE_FILES]:
+            self._add_new_services()
+            self._configure(
+                dict(
+                    (zone, self._enabled_services)
+                    for zone in self._get_active_zones()
+                ),
+                add=True,
             )
-        )
+        self._reload()
 
 
 # vim: expandtab tabstop=4 shiftwidth=4
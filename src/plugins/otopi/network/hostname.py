@@ -7,10 +7,12 @@
 
 
 import gettext
-import re
+import ipaddress
 import socket
 
 
+from otopi import constants
+from otopi import netinfo
 from otopi import plugin
 from otopi import util
 
@@ -27,25 +29,20 @@ class Plugin(plugin.PluginBase):
     to one of the interfaces address except of loopback.
 
     """
-    _ADDRESS_RE = re.compile(
-        flags=re.VERBOSE,
-        pattern=r"""
-            ^\s*inet\s+(?P<ipv4>[0-9.]+)/.*
-            |
-            ^\s*inet6\s+(?P<ipv6>[0-9a-f:]+)/.*
-        """
-    )
-
     MSG_PREFIX = _('Cannot validate host name settings, reason: {reason}')
 
     def __init__(self, context):
         super(Plugin, self).__init__(context=context)
 
     @plugin.event(
-        stage=plugin.Stages.STAGE_SETUP,
+        stage=plugin.Stages.STAGE_INIT,
     )
-    def _setup(self):
-        self.command.detect('ip')
+    def _init(self):
+        self.environment.setdefault(constants.NetEnv.RESOLVE_TIMEOUT, 5)
+        self.environment.setdefault(
+            constants.NetEnv.RESOLVER,
+            netinfo.Resolver(),
+        )
 
     @plugin.event(
         stage=plugin.Stages.STAGE_VALIDATION,
@@ -54,63 +51,40 @@ class Plugin(plugin.PluginBase):
         myname = socket.gethostname()
         self.logger.debug('my name: %s', myname)
         try:
-            ip_cmd = self.command.get('ip', optional=True)
-            if not ip_cmd:
-                self.logger.warning(
-                    self.MSG_PREFIX.format(
-                        reason=_("Command 'ip' not found")
-                    )
-                )
-                return
-            myaddresses = [
-                address[0] for __, __, __, __, address in
-                socket.getaddrinfo(
-                    myname,
-                    None
+            addresses = netinfo.interfaceAddresses()
+        except OSError:
+            self.logger.debug('cannot enumerate addresses', exc_info=True)
+            self.logger.warning(
+                self.MSG_PREFIX.format(
+                    reason=_('cannot enumerate interface addresses')
                 )
-            ]
-
-            (rc, stdout, stderr) = self.execute(
-                (
-                    ip_cmd,
-                    'addr',
-                    'show'
-                ),
-                raiseOnError=False,
             )
-            if rc != 0:
-                self.logger.warning(
-                    self.MSG_PREFIX.format(
-                        reason=_('cannot enumerate interface addresses')
+            return
+        # link local addresses are not used to reach the host
+        addresses = [
+            address for address in addresses
+            if not ipaddress.ip_address(address).is_loopback and
+            not ipaddress.ip_address(address).is_link_local
+        ]
+
+        resolver = self.environment[constants.NetEnv.RESOLVER]
+        resolver.timeout = self.environment[
+            constants.NetEnv.RESOLVE_TIMEOUT
+        ]
+        myaddresses = resolver.forward(names=(myname,))[myname]
+        self.logger.debug('my addresses: %s', myaddresses)
+        self.logger.debug('local addresses: %s', addresses)
+        if myaddresses is None:
+            self.logger.warning(
+                self.MSG_PREFIX.format(
+                    reason=_(
+                        "timeout resolving own name '{name}'"
+                    ).format(
+                        name=myname
                     )
                 )
-            else:
-                addresses = []
-                for line in stdout:
-                    m = self._ADDRESS_RE.match(line)
-                    if m is not None:
-                        for g in ('ipv4', 'ipv6'):
-                            if m.group(g) is not None:
-                                addresses.append(m.group(g))
-                addresses = [
-                    address for address in addresses
-                    if not address.startswith('127.') and not address == '::1'
-                ]
-
-                self.logger.debug('my addresses: %s', myaddresses)
-                self.logger.debug('local addresses: %s', addresses)
-                if not set(addresses) & set(myaddresses):
-                    self.logger.warning(
-                        self.MSG_PREFIX.format(
-                            reason=_(
-                                'resolved host does not match any of the '
-                                'local addresses'
-                            )
-                        )
-                    )
-
-        except socket.error:
-            self.logger.debug('exception during resolve', exc_info=True)
+            )
+        elif not myaddresses:
             self.logger.warning(
                 self.MSG_PREFIX.format(
                     reason=_("cannot resolve own name '{name}'").format(
@@ -118,6 +92,14 @@ class Plugin(plugin.PluginBase):
                     )
                 )
             )
-
+        elif not set(addresses) & set(myaddresses):
+            self.logger.warning(
+                self.MSG_PREFIX.format(
+                    reason=_(
+                        'resolved host does not match any of the '
+                        'local addresses'
+                    )
+                )
+            )
 
 # vim: expandtab tabstop=4 shiftwidth=4
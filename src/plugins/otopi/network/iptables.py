@@ -13,6 +13,7 @@ import gettext
 from otopi import constants
 from otopi import filetransaction
 from otopi import plugin
+from otopi import transaction
 from otopi import util
 
 
@@ -27,10 +28,64 @@ class Plugin(plugin.PluginBase):
     Environment:
         NetEnv.IPTABLES_ENABLE -- enable iptables update
         NetEnv.IPTABLES_RULES -- iptables rules (multi-string)
+        NetEnv.IPTABLES_RESTORE -- apply rules using iptables-restore
 
     """
+
+    class IptablesTransaction(transaction.TransactionElement):
+        """iptables rules validation transaction element."""
+
+        def __init__(self, parent):
+            self._parent = parent
+
+        def __str__(self):
+            return _('iptables Transaction')
+
+        def prepare(self):
+            iptablesRestore = self._parent.command.get(
+                'iptables-restore',
+                optional=True,
+            )
+            if iptablesRestore is None:
+                raise RuntimeError(
+                    _(
+                        "Cannot validate iptables rules, command "
+                        "'iptables-restore' is missing, set {key} to "
+                        "False to skip validation"
+                    ).format(
+                        key=constants.NetEnv.IPTABLES_RESTORE,
+                    )
+                )
+            rc, stdout, stderr = self._parent.execute(
+                (
+                    iptablesRestore,
+                    '--test',
+                ),
+                # terminate the last line, COMMIT must be a whole line
+                stdin=self._parent._rules() + [''],
+                raiseOnError=False,
+            )
+            if rc != 0:
+                raise RuntimeError(
+                    _('Invalid iptables rules: {error}').format(
+                        error='\n'.join(stderr),
+                    )
+                )
+
+        def abort(self):
+            pass
+
+        def commit(self):
+            pass
+
     REDHAT_IPTABLES = '/etc/sysconfig/iptables'
 
+    def _rules(self):
+        rules = self.environment[constants.NetEnv.IPTABLES_RULES]
+        if isinstance(rules, str):
+            rules = rules.splitlines()
+        return list(rules)
+
     def __init__(self, context):
         super(Plugin, self).__init__(context=context)
         self._distribution = distro.linux_distribution(
@@ -44,6 +99,7 @@ class Plugin(plugin.PluginBase):
     def _init(self):
         self.environment.setdefault(constants.NetEnv.IPTABLES_ENABLE, False)
         self.environment.setdefault(constants.NetEnv.IPTABLES_RULES, None)
+        self.environment.setdefault(constants.NetEnv.IPTABLES_RESTORE, True)
 
     @plugin.event(
         stage=plugin.Stages.STAGE_VALIDATION,
@@ -64,6 +120,11 @@ class Plugin(plugin.PluginBase):
             )
         else:
             self._enabled = True
+            if self.environment[constants.NetEnv.IPTABLES_RESTORE]:
+                # installed by the iptables package if missing, detected
+                # again before the transaction
+                self.command.detect('iptables-restore')
+            self.packager.prefetch(('iptables-services',))
 
     @plugin.event(
         stage=plugin.Stages.STAGE_PACKAGES,
@@ -81,6 +142,12 @@ class Plugin(plugin.PluginBase):
         condition=lambda self: self._enabled,
     )
     def _store_iptables(self):
+        if self.environment[constants.NetEnv.IPTABLES_RESTORE]:
+            self.environment[constants.CoreEnv.MAIN_TRANSACTION].append(
+                self.IptablesTransaction(
+                    parent=self,
+                )
+            )
         self.environment[constants.CoreEnv.MAIN_TRANSACTION].append(
             filetransaction.FileTransaction(
                 name=self.REDHAT_IPTABLES,
@@ -106,8 +173,21 @@ class Plugin(plugin.PluginBase):
             self.services.startup('firewalld', False)
             self.services.state('firewalld', False)
         self.services.startup('iptables', True)
-        self.services.state('iptables', False)
-        self.services.state('iptables', True)
+        if (
+            self.environment[constants.NetEnv.IPTABLES_RESTORE] and
+            self.services.status('iptables')
+        ):
+            # replace all rules in a single commit, without the window
+            # of flushed rules a restart has
+            self.execute(
+                (
+                    self.command.get('iptables-restore'),
+                    self.REDHAT_IPTABLES,
+                ),
+            )
+        else:
+            self.services.state('iptables', False)
+            self.services.state('iptables', True)
 
 
 # vim: expandtab tabstop=4 shiftwidth=4
@@ -44,6 +44,7 @@ class Plugin(plugin.PluginBase, packager.PackagerBase):
             self._parent.beginTransaction()
 
         def abort(self):
+            self._parent._minidnf.cancelPrefetch()
             self._parent.endTransaction(
                 rollback=self._parent.environment[
                     constants.PackEnv.DNF_ROLLBACK
@@ -56,6 +57,10 @@ class Plugin(plugin.PluginBase, packager.PackagerBase):
     def _getMiniDNF(
         self,
         disabledPlugins=(),
+        installRoot=None,
+        cacheDir=None,
+        bundleDir=None,
+        bundleOnly=False,
     ):
         from otopi import minidnf
 
@@ -107,9 +112,69 @@ class Plugin(plugin.PluginBase, packager.PackagerBase):
                 super(_MyMiniDNFSink, self).reexec()
                 self._parent.context.notify(self._parent.context.NOTIFY_REEXEC)
 
+            def _record(self, phase, elapsed, **details):
+                """Aggregate phase into its timing report record.
+
+                Returns the record.
+
+                """
+                report = self._parent.environment.setdefault(
+                    constants.CoreEnv.TIMING_REPORT,
+                    []
+                )
+                for record in report:
+                    if (
+                        record['component'] == 'dnf' and
+                        record['phase'] == phase
+                    ):
+                        break
+                else:
+                    record = {
+                        'component': 'dnf',
+                        'phase': phase,
+                        'count': 0,
+                        'elapsed': 0.0,
+                    }
+                    report.append(record)
+                record['count'] += 1
+                record['elapsed'] += elapsed
+                for key, value in details.items():
+                    if isinstance(value, bool):
+                        record[key] = record.get(key, False) or value
+                    elif isinstance(value, (int, float)) and key != 'rate':
+                        record[key] = record.get(key, 0) + value
+                if 'bytes' in record and record['elapsed'] > 0:
+                    record['rate'] = record['bytes'] / record['elapsed']
+                return record
+
+            def phaseEnd(self, phase, elapsed, details):
+                super(_MyMiniDNFSink, self).phaseEnd(phase, elapsed, details)
+                self._parent.logger.debug(
+                    'DNF phase %s took %.2f seconds %s',
+                    phase,
+                    elapsed,
+                    details,
+                )
+                self._record(phase, elapsed, **details)
+
+            def packageProcessed(self, package, action, elapsed):
+                super(_MyMiniDNFSink, self).packageProcessed(
+                    package,
+                    action,
+                    elapsed,
+                )
+                record = self._record('package', elapsed)
+                if elapsed >= record.get('slowestElapsed', 0):
+                    record['slowest'] = '%s %s' % (action, package)
+                    record['slowestElapsed'] = elapsed
+
         return minidnf.MiniDNF(
             sink=_MyMiniDNFSink(parent=self),
             disabledPlugins=disabledPlugins,
+            installRoot=installRoot,
+            cacheDir=cacheDir,
+            bundleDir=bundleDir,
+            bundleOnly=bundleOnly,
         )
 
     def __init__(self, context):
@@ -145,10 +210,42 @@ class Plugin(plugin.PluginBase, packager.PackagerBase):
             constants.PackEnv.DNFPACKAGER_EXPIRE_CACHE,
             True
         )
+        self.environment.setdefault(
+            constants.PackEnv.DNF_EXPIRE_POLICY,
+            constants.Defaults.PACKAGER_DNF_EXPIRE_POLICY
+        )
+        self.environment.setdefault(
+            constants.PackEnv.DNF_EXPIRE_AGE,
+            constants.Defaults.PACKAGER_DNF_EXPIRE_AGE
+        )
         self.environment.setdefault(
             constants.PackEnv.DNF_ROLLBACK,
             True
         )
+        self.environment.setdefault(
+            constants.PackEnv.DNF_PREFETCH,
+            True
+        )
+        self.environment.setdefault(
+            constants.PackEnv.INSTALL_ROOT,
+            None
+        )
+        self.environment.setdefault(
+            constants.PackEnv.DNF_CACHE_DIR,
+            None
+        )
+        self.environment.setdefault(
+            constants.PackEnv.DNF_BUNDLE,
+            None
+        )
+        self.environment.setdefault(
+            constants.PackEnv.DNF_BUNDLE_ONLY,
+            False
+        )
+        self.environment.setdefault(
+            constants.PackEnv.DNF_BUNDLE_EXPORT,
+            None
+        )
 
         try:
             if self.environment[constants.PackEnv.DNFPACKAGER_ENABLED]:
@@ -156,6 +253,18 @@ class Plugin(plugin.PluginBase, packager.PackagerBase):
                     disabledPlugins=self.environment[
                         constants.PackEnv.DNF_DISABLED_PLUGINS
                     ],
+                    installRoot=self.environment[
+                        constants.PackEnv.INSTALL_ROOT
+                    ],
+                    cacheDir=self.environment[
+                        constants.PackEnv.DNF_CACHE_DIR
+                    ],
+                    bundleDir=self.environment[
+                        constants.PackEnv.DNF_BUNDLE
+                    ],
+                    bundleOnly=self.environment[
+                        constants.PackEnv.DNF_BUNDLE_ONLY
+                    ],
                 )
 
                 # the following will trigger the NOTIFY_REEXEC
@@ -201,15 +310,27 @@ class Plugin(plugin.PluginBase, packager.PackagerBase):
         condition=lambda self: self._enabled,
     )
     def _setup(self):
+        if self.environment[constants.PackEnv.DNF_BUNDLE_EXPORT]:
+            self.command.detect('createrepo_c')
         if self.environment[constants.PackEnv.DNFPACKAGER_EXPIRE_CACHE]:
-            with self._minidnf.transaction():
-                self._minidnf.clean(['expire-cache'])
+            self._minidnf.setExpirePolicy(
+                policy=self.environment[
+                    constants.PackEnv.DNF_EXPIRE_POLICY
+                ],
+                age=self.environment[constants.PackEnv.DNF_EXPIRE_AGE],
+            )
+            # applied when metadata is first loaded by getConf() below
+            self._minidnf.clean(['expire-cache'])
         self.environment[constants.CoreEnv.MAIN_TRANSACTION].append(
             self.DNFTransaction(
                 parent=self,
             )
         )
         self.logger.debug(self._minidnf.getConf())
+        self.logger.debug(
+            'DNF metadata loading took %.2f seconds',
+            self._minidnf.metadataLoadTime,
+        )
         self.environment[
             constants.CoreEnv.INTERNAL_PACKAGES_TRANSACTION
         ].append(
@@ -252,6 +373,13 @@ class Plugin(plugin.PluginBase, packager.PackagerBase):
                     p['operation'],
                     p['display_name'],
                 )
+            if self.environment[constants.PackEnv.DNF_BUNDLE_EXPORT]:
+                self._minidnf.exportBundle(
+                    directory=self.environment[
+                        constants.PackEnv.DNF_BUNDLE_EXPORT
+                    ],
+                    createrepo=self.command.get('createrepo_c'),
+                )
             self._minidnf.processTransaction()
 
     def installGroup(self, group, ignoreErrors=False):
@@ -260,6 +388,12 @@ class Plugin(plugin.PluginBase, packager.PackagerBase):
             ignoreErrors=ignoreErrors,
         )
 
+    def installGroups(self, groups, ignoreErrors=False):
+        return self._minidnf.installGroups(
+            groups=groups,
+            ignoreErrors=ignoreErrors,
+        )
+
     def updateGroup(self, group, ignoreErrors=False):
         return self._minidnf.updateGroup(
             group=group,
@@ -296,6 +430,10 @@ class Plugin(plugin.PluginBase, packager.PackagerBase):
             ignoreErrors=ignoreErrors,
         )
 
+    def prefetch(self, packages):
+        if self.environment[constants.PackEnv.DNF_PREFETCH]:
+            self._minidnf.prefetch(packages=packages)
+
     def queryGroups(self):
         return self._minidnf.queryGroups()
 
@@ -275,6 +275,12 @@ class Plugin(plugin.PluginBase, packager.PackagerBase):
             ignoreErrors=ignoreErrors
         )
 
+    def installGroups(self, groups, ignoreErrors=False):
+        return self._miniyum.installGroups(
+            groups=groups,
+            ignoreErrors=ignoreErrors,
+        )
+
     def updateGroup(self, group, ignoreErrors=False):
         return self._miniyum.updateGroup(
             group=group,
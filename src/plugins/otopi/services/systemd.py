@@ -7,6 +7,7 @@
 
 
 import gettext
+import time
 
 
 from otopi import constants
@@ -23,14 +24,29 @@ def _(m):
 class Plugin(plugin.PluginBase, services.ServicesBase):
     """systemd services provider."""
 
+    _SETTLED_STATES = ('active', 'inactive', 'failed')
+    # units may be changed by others, snapshot is used for bulk checks
+    # within a short period only
+    _SNAPSHOT_LIFETIME = 5
+
     def __init__(self, context):
         super(Plugin, self).__init__(context=context)
+        self._enabled = False
+        self._units = None
+        self._unitsTime = 0
+        self._bus = None
+        self._busError = None
+        self._busDisconnected = ()
 
     @plugin.event(
         stage=plugin.Stages.STAGE_SETUP,
     )
     def _setup(self):
         self.command.detect('systemctl')
+        self.environment.setdefault(
+            constants.SysEnv.SYSTEMD_DBUS,
+            False
+        )
 
     @plugin.event(
         stage=plugin.Stages.STAGE_PROGRAMS,
@@ -48,6 +64,27 @@ class Plugin(plugin.PluginBase, services.ServicesBase):
             if ret == 0:
                 self.logger.debug('registering systemd provider')
                 self.context.registerServices(services=self)
+                self._enabled = True
+                if self.environment[constants.SysEnv.SYSTEMD_DBUS]:
+                    self._connectBus()
+
+    @plugin.event(
+        stage=plugin.Stages.STAGE_INTERNAL_PACKAGES,
+        priority=plugin.Stages.PRIORITY_LAST + 10,
+        condition=lambda self: self._enabled,
+    )
+    def _internal_packages_end(self):
+        # packages may have added or removed units
+        self._invalidate()
+
+    @plugin.event(
+        stage=plugin.Stages.STAGE_PACKAGES,
+        priority=plugin.Stages.PRIORITY_LAST + 10,
+        condition=lambda self: self._enabled,
+    )
+    def _packages_end(self):
+        # packages may have added or removed units
+        self._invalidate()
 
     #
     # ServicesBase
@@ -77,12 +114,204 @@ class Plugin(plugin.PluginBase, services.ServicesBase):
             raiseOnError=raiseOnError
         )
 
+    def _connectBus(self):
+        try:
+            import dbus
+            from otopi import systemdbus
+            self._bus = systemdbus.SystemdBus()
+            self._busError = dbus.exceptions.DBusException
+            self._busDisconnected = systemdbus.DISCONNECTED
+            self.logger.debug('using systemd D-Bus interface')
+        except Exception:
+            self.logger.debug(
+                'systemd D-Bus interface is not available, using systemctl',
+                exc_info=True,
+            )
+
+    def _withBus(self, function):
+        """Call function with the D-Bus backend.
+
+        Returns a tuple of True and the function result, or False and
+        None if systemctl should be used instead. The backend is
+        dropped if the connection is broken.
+
+        """
+        if self._bus is None:
+            return False, None
+        try:
+            return True, function(self._bus)
+        except self._busError as e:
+            self.logger.debug('D-Bus request failed: %s', e)
+            if e.get_dbus_name() in self._busDisconnected:
+                self._bus = None
+            return False, None
+
+    def _busUnits(self, names, props):
+        """Unit properties of services using the D-Bus backend."""
+        def _get(bus):
+            units = bus.properties(
+                ['%s.service' % name for name in names],
+                props=props,
+            )
+            return dict(
+                (name, units['%s.service' % name])
+                for name in names
+            )
+        return self._withBus(_get)
+
+    def _busJobs(self, method, names, failure):
+        """Run unit jobs using the D-Bus backend.
+
+        Returns True if done, raises RuntimeError with the message
+        returned by failure for the first failed service.
+
+        """
+        found, results = self._withBus(
+            lambda bus: bus.jobs(
+                method,
+                ['%s.service' % name for name in names],
+            )
+        )
+        if found:
+            for name in names:
+                if results['%s.service' % name] != 'done':
+                    raise RuntimeError(failure(name))
+        return found
+
+    def _invalidate(self):
+        self._units = None
+
+    def _settled(self, name):
+        """Active state of service if settled within the snapshot.
+
+        Transitional states such as activating are not served from the
+        snapshot, as the unit is expected to change.
+
+        Returns True if active, False if inactive, None if unknown.
+
+        """
+        unit = self._snapshot().get(name)
+        if unit is not None and unit[1] in self._SETTLED_STATES:
+            return unit[1] == 'active'
+        return None
+
+    def _snapshot(self):
+        """Unit state snapshot.
+
+        Taken lazily from one list-unit-files and one list-units call,
+        and taken again once older than _SNAPSHOT_LIFETIME seconds.
+
+        Returns a dictionary of service name to a tuple of exists and
+        active state, services not in the snapshot are unknown. The
+        snapshot is empty if it cannot be taken.
+
+        """
+        if (
+            self._units is None or
+            time.monotonic() - self._unitsTime > self._SNAPSHOT_LIFETIME
+        ):
+            self._units = {}
+            self._unitsTime = time.monotonic()
+            systemctl = self.command.get('systemctl')
+            rc, files, stderr = self.execute(
+                (
+                    systemctl,
+                    'list-unit-files',
+                    '--type=service',
+                    '--no-legend',
+                    '--no-pager',
+                ),
+                raiseOnError=False,
+            )
+            if rc != 0:
+                return self._units
+            rc, units, stderr = self.execute(
+                (
+                    systemctl,
+                    'list-units',
+                    '--all',
+                    '--type=service',
+                    '--no-legend',
+                    '--no-pager',
+                    '--plain',
+                ),
+                raiseOnError=False,
+            )
+            if rc != 0:
+                return self._units
+
+            for line in files:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0].endswith('.service'):
+                    self._units[fields[0][:-len('.service')]] = (
+                        not fields[1].startswith('masked'),
+                        'inactive',
+                    )
+            for line in units:
+                fields = line.split()
+                if len(fields) >= 3 and fields[0].endswith('.service'):
+                    self._units[fields[0][:-len('.service')]] = (
+                        fields[1] == 'loaded',
+                        fields[2],
+                    )
+        return self._units
+
     @property
     def supportsDependency(self):
         return True
 
+    def _showMany(self, names):
+        """Show unit properties of services with a single invocation.
+
+        Returns a dictionary of name to properties, None on failure.
+
+        """
+        names = list(names)
+        rc, stdout, stderr = self.execute(
+            (
+                self.command.get('systemctl'),
+                'show',
+                '-p',
+                'Id,LoadState,ActiveState',
+            ) + tuple('%s.service' % name for name in names),
+            raiseOnError=False,
+        )
+        if rc != 0:
+            return None
+
+        units = [{}]
+        for line in stdout:
+            line = line.strip()
+            if not line:
+                if units[-1]:
+                    units.append({})
+            else:
+                key, value = line.split('=', 1)
+                units[-1][key] = value
+        if not units[-1]:
+            units.pop()
+        if len(units) != len(names):
+            return None
+        return dict(zip(names, units))
+
+    def _resolveMany(self, names):
+        found, units = self._busUnits(names, ('Id',))
+        if not found:
+            units = self._showMany(names)
+        return [
+            (
+                units[name].get('Id', name).replace('.service', '')
+                if units is not None
+                else name
+            )
+            for name in names
+        ]
+
     def exists(self, name):
         self.logger.debug('check if service %s exists', name)
+        found, units = self._busUnits([name], ('LoadState',))
+        if found:
+            return units[name]['LoadState'] == 'loaded'
         rc, stdout, stderr = self._executeServiceCommand(
             name,
             (
@@ -100,6 +329,9 @@ class Plugin(plugin.PluginBase, services.ServicesBase):
 
     def status(self, name):
         self.logger.debug('check service %s status', name)
+        found, units = self._busUnits([name], ('ActiveState',))
+        if found:
+            return units[name]['ActiveState'] == 'active'
         rc, stdout, stderr = self._executeServiceCommand(
             name,
             'status',
@@ -109,6 +341,18 @@ class Plugin(plugin.PluginBase, services.ServicesBase):
 
     def startup(self, name, state):
         self.logger.debug('set service %s startup to %s', name, state)
+        self._invalidate()
+
+        found, sysv = self._withBus(
+            lambda bus: bus.enable(
+                ['%s.service' % n for n in self._resolveMany([name])],
+                state,
+            )
+        )
+        if found and not sysv:
+            return
+
+        # systemctl runs systemd-sysv-install for SysV services
 
         # resolve service name
         rc, stdout, stderr = self._executeServiceCommand(
@@ -137,6 +381,7 @@ class Plugin(plugin.PluginBase, services.ServicesBase):
 
     def startupSocket(self, name, state):
         self.logger.debug('set socket %s startup to %s', name, state)
+        self._invalidate()
 
         # resolve service name
         rc, stdout, stderr = self._executeSocketCommand(
@@ -169,6 +414,16 @@ class Plugin(plugin.PluginBase, services.ServicesBase):
             'starting' if state else 'stopping',
             name
         )
+        self._invalidate()
+        if self._busJobs(
+            'StartUnit' if state else 'StopUnit',
+            [name],
+            lambda name: _("Failed to {do} service '{service}'").format(
+                do=_('start') if state else _('stop'),
+                service=name,
+            ),
+        ):
+            return
         rc, stdout, stderr = self._executeServiceCommand(
             name,
             'start' if state else 'stop',
@@ -182,11 +437,127 @@ class Plugin(plugin.PluginBase, services.ServicesBase):
                 )
             )
 
+    def existsMany(self, names):
+        names = list(names)
+        self.logger.debug('check if services %s exist', names)
+        snapshot = self._snapshot()
+        if all(name in snapshot for name in names):
+            return dict((name, snapshot[name][0]) for name in names)
+        found, units = self._busUnits(names, ('LoadState',))
+        if not found:
+            units = self._showMany(names)
+        if units is None:
+            return super(Plugin, self).existsMany(names)
+        return dict(
+            (name, units[name].get('LoadState') == 'loaded')
+            for name in names
+        )
+
+    def statusMany(self, names):
+        names = list(names)
+        self.logger.debug('check services %s status', names)
+        settled = dict((name, self._settled(name)) for name in names)
+        if None not in settled.values():
+            return settled
+        found, units = self._busUnits(names, ('ActiveState',))
+        if not found:
+            units = self._showMany(names)
+        if units is None:
+            return super(Plugin, self).statusMany(names)
+        return dict(
+            (name, units[name].get('ActiveState') == 'active')
+            for name in names
+        )
+
+    def activeMany(self, names):
+        names = list(names)
+        found, units = self._busUnits(names, ('ActiveState',))
+        if not found:
+            units = self._showMany(names)
+        if units is None:
+            self._invalidate()
+            return self.statusMany(names)
+        return dict(
+            (name, units[name].get('ActiveState') == 'active')
+            for name in names
+        )
+
+    def startupMany(self, names, state):
+        names = list(names)
+        if not names:
+            return
+        self.logger.debug('set services %s startup to %s', names, state)
+        self._invalidate()
+        names = self._resolveMany(names)
+        found, sysv = self._withBus(
+            lambda bus: bus.enable(
+                ['%s.service' % name for name in names],
+                state,
+            )
+        )
+        if found:
+            # systemctl runs systemd-sysv-install for SysV services
+            names = [name for name in names if '%s.service' % name in sysv]
+            if not names:
+                return
+        rc, stdout, stderr = self.execute(
+            (
+                self.command.get('systemctl'),
+                'enable' if state else 'disable',
+            ) + tuple(
+                '%s.service' % name
+                for name in names
+            ),
+            raiseOnError=False,
+        )
+        if rc != 0:
+            # find out which one failed
+            super(Plugin, self).startupMany(names, state)
+
+    def stateMany(self, names, state):
+        names = list(names)
+        if not names:
+            return
+        self.logger.debug(
+            '%s services %s',
+            'starting' if state else 'stopping',
+            names,
+        )
+        self._invalidate()
+        if self._busJobs(
+            'StartUnit' if state else 'StopUnit',
+            names,
+            lambda name: _("Failed to {do} service '{service}'").format(
+                do=_('start') if state else _('stop'),
+                service=name,
+            ),
+        ):
+            return
+        rc, stdout, stderr = self.execute(
+            (
+                self.command.get('systemctl'),
+                'start' if state else 'stop',
+            ) + tuple('%s.service' % name for name in names),
+            raiseOnError=False,
+        )
+        if rc != 0:
+            # find out which one failed
+            super(Plugin, self).stateMany(names, state)
+
     def restart(self, name):
         self.logger.debug(
             'restarting service %s',
             name
         )
+        self._invalidate()
+        if self._busJobs(
+            'RestartUnit',
+            [name],
+            lambda name: _("Failed to restart service '{service}'").format(
+                service=name,
+            ),
+        ):
+            return
         rc, stdout, stderr = self._executeServiceCommand(
             name,
             'restart',